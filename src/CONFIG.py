@@ -1,16 +1,434 @@
-""" 
+"""
 CONFIG.py
 A file containing constants loaded from a configuration file,
 default = ./config.ini
+
+The raw ConfigParser is kept in `config` for backwards compatibility, but
+modules should read the typed, validated `Settings` returned by
+`get_settings()`. It is parsed once by `setup_config` and is immutable, so
+tuning a deployment only means editing the .ini or passing
+`--set Section.key=value` on the command line.
 """
 import configparser
+import os
+import typing
+from dataclasses import dataclass, fields
+from typing import Optional
+
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.ini')
+
 config = configparser.ConfigParser()
+settings = None
+
+
+def _require(condition, message):
+    if not condition:
+        raise ValueError(message)
+
+
+CAMERA_BACKENDS = ('oak', 'realsense')
+
+
+@dataclass(frozen=True)
+class CameraConfig:
+    # Which camera SDK to use, see utils.cameras.open_camera
+    backend: str = 'oak'
+    dfov: float = 86
+    hfov: float = 73
+    vfov: float = 58
+    width: int = 640
+    height: int = 480
+    # Seperation between the stereo cameras in millimeters
+    distance: float = 100
+    rgb_framerate: int = 30
+    stereo_framerate: int = 30
+
+    def __post_init__(self):
+        _require(self.backend in CAMERA_BACKENDS, f'Camera.backend must be one of {CAMERA_BACKENDS}')
+        for name in ('dfov', 'hfov', 'vfov'):
+            _require(0 < getattr(self, name) < 180, f'Camera.{name} must be in (0, 180) degrees')
+        _require(self.width > 0 and self.height > 0, 'Camera.width and Camera.height must be positive')
+        _require(self.distance > 0, 'Camera.distance must be positive')
+        _require(self.rgb_framerate > 0 and self.stereo_framerate > 0, 'Camera framerates must be positive')
+
+    @property
+    def resolution(self):
+        return (self.width, self.height)
+
+
+@dataclass(frozen=True)
+class SimulationConfig:
+    width: int = 640
+    height: int = 480
+    trail_length: int = 0
+
+    def __post_init__(self):
+        _require(self.width > 0 and self.height > 0, 'Simulation.width and Simulation.height must be positive')
+        _require(self.trail_length >= 0, 'Simulation.trail_length must not be negative')
+
+    @property
+    def resolution(self):
+        return (self.width, self.height)
+
+
+@dataclass(frozen=True)
+class ModelConfig:
+    architecture: str = 'cpu'
+    weights: str = 'yolov8x-pose.pt'
+    confidence: float = 0.7
+    max_detections: int = 6
+    keypoint_threshold: float = 0.6
+
+    def __post_init__(self):
+        _require(0 <= self.confidence <= 1, 'YOLOv8.confidence must be in [0, 1]')
+        _require(0 <= self.keypoint_threshold <= 1, 'YOLOv8.keypoint_threshold must be in [0, 1]')
+        _require(self.max_detections > 0, 'YOLOv8.max_detections must be positive')
+
+
+@dataclass(frozen=True)
+class TrackerConfig:
+    min_frames: int = 3
+    max_missed: int = 3
+    # Association gates, empty disables the gate
+    max_dist: Optional[float] = None
+    max_vel: Optional[float] = None
+    process_noise: float = 0.1
+    measurement_noise: float = 0.01
+    initial_covariance: float = 0.2
+    # Recursive least-squares polynomial fit kept per target for derivatives
+    rls_degree: int = 2
+    rls_forgetting: float = 0.9
+    # Clutter suppression: merge detections closer than dedup_dist and start no track
+    # closer than birth_dist to an existing one, empty disables either
+    dedup_dist: Optional[float] = None
+    birth_dist: Optional[float] = None
+    # Association backend, see association.hungarian_association.associate_positions
+    association: str = 'auto'
+    # 'cv': constant velocity UKF per track, 'imm': batched CV/CA/stationary IMM, see utils.imm
+    motion_model: str = 'cv'
+    # IMM acceleration, jerk and position noise densities of its constant velocity, constant
+    # acceleration and stationary models, and the probability of staying in each per frame
+    imm_q_cv: float = 200.0
+    imm_q_ca: float = 5000.0
+    imm_q_stationary: float = 0.5
+    imm_stay_cv: float = 0.95
+    imm_stay_ca: float = 0.7
+    imm_stay_stationary: float = 0.95
+
+    def __post_init__(self):
+        _require(self.min_frames >= 2, 'Tracker.min_frames must be at least 2')
+        _require(self.max_missed >= 1, 'Tracker.max_missed must be at least 1')
+        _require(self.max_dist is None or self.max_dist > 0, 'Tracker.max_dist must be positive')
+        _require(self.max_vel is None or self.max_vel > 0, 'Tracker.max_vel must be positive')
+        _require(self.process_noise > 0 and self.measurement_noise > 0 and self.initial_covariance > 0,
+                 'Tracker noise values must be positive')
+        _require(self.rls_degree >= 1, 'Tracker.rls_degree must be at least 1')
+        _require(0 < self.rls_forgetting <= 1, 'Tracker.rls_forgetting must be in (0, 1]')
+        _require(self.dedup_dist is None or self.dedup_dist > 0, 'Tracker.dedup_dist must be positive')
+        _require(self.birth_dist is None or self.birth_dist > 0, 'Tracker.birth_dist must be positive')
+        _require(self.association in ('auto', 'dense', 'gated', 'kdtree'),
+                 'Tracker.association must be one of auto, dense, gated, kdtree')
+        _require(self.motion_model in ('cv', 'imm'), 'Tracker.motion_model must be cv or imm')
+        _require(self.imm_q_cv > 0 and self.imm_q_ca > 0 and self.imm_q_stationary > 0,
+                 'Tracker IMM noise values must be positive')
+        for name in ('imm_stay_cv', 'imm_stay_ca', 'imm_stay_stationary'):
+            _require(0 < getattr(self, name) < 1, f'Tracker.{name} must be in (0, 1)')
+
+    @property
+    def imm_stay(self):
+        return (self.imm_stay_cv, self.imm_stay_ca, self.imm_stay_stationary)
+
+
+@dataclass(frozen=True)
+class TurretConfig:
+    # Muzzle speed in m/s and gravity drop compensation (0 disables)
+    projectile_speed: float = 30.0
+    gravity: float = 9.81
+    # Radius in meters of the region counted as a hit
+    target_radius: float = 0.25
+    # Seconds between a state estimate and the shot leaving the barrel
+    latency: float = 0.0
+    # Slew limits in degrees per second (squared)
+    pan_speed: float = 180.0
+    tilt_speed: float = 90.0
+    acceleration: float = 720.0
+    # Seconds a target is deprioritized after being engaged
+    engagement_cooldown: float = 2.0
+
+    def __post_init__(self):
+        _require(self.projectile_speed > 0, 'Turret.projectile_speed must be positive')
+        _require(self.gravity >= 0, 'Turret.gravity must not be negative')
+        _require(self.target_radius > 0, 'Turret.target_radius must be positive')
+        _require(self.latency >= 0, 'Turret.latency must not be negative')
+        _require(self.pan_speed > 0 and self.tilt_speed > 0 and self.acceleration > 0,
+                 'Turret slew limits must be positive')
+        _require(self.engagement_cooldown >= 0, 'Turret.engagement_cooldown must not be negative')
+
+
+@dataclass(frozen=True)
+class DepthConfig:
+    max_k_size: int = 100
+    max_pos_size: int = 5
+    # Sensor depths (mm) beyond this use the monocular height model, empty trusts any depth
+    max_stereo_depth: Optional[float] = 8000
+    huber: float = 1.345
+    # Lift every confident keypoint into 3D and aim at the torso centroid (utils.skeleton)
+    skeleton: bool = False
+    patch_radius: int = 2
+    # Temporal filter and hole filling over the sampled regions (utils.depth_filter)
+    filter: bool = False
+    filter_alpha: float = 0.4
+    filter_delta: float = 250
+    filter_persistence: int = 3
+    fill_levels: int = 3
+
+    def __post_init__(self):
+        _require(self.patch_radius >= 0, 'Depth.patch_radius must not be negative')
+        _require(self.max_stereo_depth is None or self.max_stereo_depth > 0, 'Depth.max_stereo_depth must be positive')
+        _require(self.huber > 0, 'Depth.huber must be positive')
+        _require(0 < self.filter_alpha <= 1, 'Depth.filter_alpha must be in (0, 1]')
+        _require(self.filter_delta > 0, 'Depth.filter_delta must be positive')
+        _require(self.filter_persistence >= 0 and self.fill_levels >= 0,
+                 'Depth.filter_persistence and Depth.fill_levels must not be negative')
+        _require(self.max_k_size > 0 and self.max_pos_size > 0, 'Depth window sizes must be positive')
+
+
+@dataclass(frozen=True)
+class PipelineConfig:
+    # Host side size of each device output queue
+    queue_size: int = 4
+
+    def __post_init__(self):
+        _require(self.queue_size > 0, 'Pipeline.queue_size must be positive')
+
+
+@dataclass(frozen=True)
+class MetricsConfig:
+    enabled: bool = True
+    dump_path: str = ''
+    dump_interval: float = 10
+    http_port: int = 0
+
+    def __post_init__(self):
+        _require(self.dump_interval > 0, 'Metrics.dump_interval must be positive')
+        _require(0 <= self.http_port <= 65535, 'Metrics.http_port must be a valid port')
+
+
+@dataclass(frozen=True)
+class FusionConfig:
+    # JSON file with the world pose of every camera, see association.fusion.load_extrinsics
+    extrinsics: str = ''
+    # Detections of different cameras closer than this (m) are the same person
+    merge_dist: float = 0.3
+    # Measurements within `window` seconds form one frame, released `delay` seconds after the newest one
+    window: float = 0.015
+    delay: float = 0.1
+
+    def __post_init__(self):
+        _require(self.merge_dist > 0, 'Fusion.merge_dist must be positive')
+        _require(self.window >= 0 and self.delay >= 0, 'Fusion.window and Fusion.delay must not be negative')
+
+
+@dataclass(frozen=True)
+class RecordingConfig:
+    # Session directory for association.data_tools.TrajectoryRecorder, empty disables recording
+    path: str = ''
+    chunk_rows: int = 65536
+    queue_size: int = 256
+
+    def __post_init__(self):
+        _require(self.chunk_rows > 0, 'Recording.chunk_rows must be positive')
+        _require(self.queue_size > 0, 'Recording.queue_size must be positive')
+
+
+@dataclass(frozen=True)
+class CheckpointConfig:
+    # File the tracker and depth calibration are checkpointed to, empty disables checkpoints
+    path: str = ''
+    # Seconds between checkpoints
+    interval: float = 1.0
+    # Tracks of an older checkpoint are not restored, the calibration always is
+    max_age: float = 10.0
+
+    def __post_init__(self):
+        _require(self.interval > 0, 'Checkpoint.interval must be positive')
+        _require(self.max_age >= 0, 'Checkpoint.max_age must not be negative')
+
+
+@dataclass(frozen=True)
+class RuntimeConfig:
+    # Run the vision loop on the utils.runtime asyncio runtime instead of the blocking loop
+    asyncio: bool = False
+    # TCP endpoint streaming track snapshots as JSON lines, port 0 disables it
+    stream_host: str = '127.0.0.1'
+    stream_port: int = 0
+    # Snapshots buffered per client before its oldest are dropped
+    stream_queue: int = 4
+    # Binary track table for other processes, see utils.track_publisher. Empty name and
+    # port 0 disable the shared memory block and the TCP stream
+    shared_memory: str = ''
+    shared_capacity: int = 64
+    binary_port: int = 0
+
+    def __post_init__(self):
+        _require(0 <= self.stream_port <= 65535, 'Runtime.stream_port must be a valid port')
+        _require(0 <= self.binary_port <= 65535, 'Runtime.binary_port must be a valid port')
+        _require(self.stream_queue > 0, 'Runtime.stream_queue must be positive')
+        _require(self.shared_capacity > 0, 'Runtime.shared_capacity must be positive')
+
+
+@dataclass(frozen=True)
+class DebugConfig:
+    show_graphs: bool = False
+    show_video: bool = False
+    show_output: bool = True
+    output_log_file: str = ''
+    headless: bool = False
+    render_rate: float = 0
+    debug_level: int = 0
+    debug_log_file: str = ''
+
+    def __post_init__(self):
+        _require(self.render_rate >= 0, 'Debug.render_rate must not be negative')
+        _require(0 <= self.debug_level <= 3, 'Debug.debug_level must be between 0 and 3')
+
+
+@dataclass(frozen=True)
+class Settings:
+    camera: CameraConfig = CameraConfig()
+    simulation: SimulationConfig = SimulationConfig()
+    model: ModelConfig = ModelConfig()
+    tracker: TrackerConfig = TrackerConfig()
+    turret: TurretConfig = TurretConfig()
+    depth: DepthConfig = DepthConfig()
+    pipeline: PipelineConfig = PipelineConfig()
+    metrics: MetricsConfig = MetricsConfig()
+    fusion: FusionConfig = FusionConfig()
+    recording: RecordingConfig = RecordingConfig()
+    checkpoint: CheckpointConfig = CheckpointConfig()
+    runtime: RuntimeConfig = RuntimeConfig()
+    debug: DebugConfig = DebugConfig()
+
+
+# Settings field -> .ini section
+SECTIONS = {
+    'camera': 'Camera',
+    'simulation': 'Simulation',
+    'model': 'YOLOv8',
+    'tracker': 'Tracker',
+    'turret': 'Turret',
+    'depth': 'Depth',
+    'pipeline': 'Pipeline',
+    'metrics': 'Metrics',
+    'fusion': 'Fusion',
+    'recording': 'Recording',
+    'checkpoint': 'Checkpoint',
+    'runtime': 'Runtime',
+    'debug': 'Debug',
+}
+
+
+def _parse_value(section, key, raw, field_type):
+    if typing.get_origin(field_type) is typing.Union:
+        if raw.strip() == '':
+            return None
+        field_type = next(t for t in typing.get_args(field_type) if t is not type(None))
+    try:
+        if field_type is bool:
+            if raw.lower() not in configparser.ConfigParser.BOOLEAN_STATES:
+                raise ValueError(raw)
+            return configparser.ConfigParser.BOOLEAN_STATES[raw.lower()]
+        if field_type is int:
+            return int(raw)
+        if field_type is float:
+            return float(raw)
+        return raw
+    except ValueError:
+        raise ValueError(f'{section}.{key} must be of type {field_type.__name__}; got {raw!r}') from None
+
+
+def _parse_section(parser, section, section_type):
+    if not parser.has_section(section):
+        return section_type()
+    types = typing.get_type_hints(section_type)
+    known = {f.name for f in fields(section_type)}
+    defaults = parser.defaults()
+    values = {}
+    for key, raw in parser.items(section):
+        if key in defaults and key not in known:
+            continue
+        if key not in known:
+            raise ValueError(f'Unknown option {section}.{key}')
+        values[key] = _parse_value(section, key, raw, types[key])
+    return section_type(**values)
+
+
+def parse_settings(parser):
+    """
+    Converts and validates a ConfigParser into an immutable Settings object.
+    Raises ValueError on unknown sections or options, wrong types or out of range values.
+    """
+    unknown = sorted(set(parser.sections()) - set(SECTIONS.values()))
+    if unknown:
+        raise ValueError(f'Unknown section(s) {", ".join(unknown)}; expected one of {", ".join(SECTIONS.values())}')
+    types = typing.get_type_hints(Settings)
+    return Settings(**{name: _parse_section(parser, section, types[name]) for name, section in SECTIONS.items()})
 
 
 def setup_config(config_path=None, cmdline_config=None):
-    global config
-    config.read('./config.ini')
+    """
+    Reads `config_path` (default: the config.ini next to this file), applies the
+    {section: {key: value}} overrides in `cmdline_config` and parses the result
+    into the cached Settings, which is returned.
+    """
+    global config, settings
+    config_path = DEFAULT_CONFIG_PATH if config_path is None else config_path
+    parser = configparser.ConfigParser()
+    if not parser.read(config_path):
+        raise FileNotFoundError(f'Could not read config file {config_path}')
     if cmdline_config != None:
-        config.read_dict(cmdline_config)
+        parser.read_dict(cmdline_config)
+    parsed = parse_settings(parser)
+    config = parser
+    settings = parsed
+    return settings
+
+
+def get_settings():
+    """
+    Returns the cached Settings, loading the default config file on first use.
+    """
+    if settings is None:
+        setup_config()
+    return settings
+
+
+def add_config_arguments(parser):
+    """
+    Adds --config and repeatable --set Section.key=value options to an argparse parser.
+    """
+    parser.add_argument('--config', default=None, metavar='PATH',
+                        help=f'configuration file (default: {DEFAULT_CONFIG_PATH})')
+    parser.add_argument('--set', dest='overrides', action='append', default=[], metavar='SECTION.KEY=VALUE',
+                        help='override a configuration value, may be given multiple times')
+
+
+def overrides_from_args(overrides):
+    """
+    Converts a list of 'Section.key=value' strings into the dict form accepted by setup_config.
+    """
+    cmdline_config = {}
+    for override in overrides:
+        name, sep, value = override.partition('=')
+        section, dot, key = name.partition('.')
+        if not sep or not dot or not section or not key:
+            raise ValueError(f'Overrides must look like Section.key=value; got {override!r}')
+        cmdline_config.setdefault(section, {})[key] = value
+    return cmdline_config
 
 
+def setup_from_args(args):
+    """
+    Calls setup_config with the options added by add_config_arguments.
+    """
+    return setup_config(args.config, overrides_from_args(args.overrides))
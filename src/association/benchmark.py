@@ -0,0 +1,89 @@
+"""
+benchmark.py
+Times the association backends of hungarian_association over growing scenes.
+
+Each scene has n tracks spread over a cube sized for a constant density, a noisy
+detection of most of them and `clutter` false detections per track. Every backend
+solves the same scenes; the table reports the median time per solve, and how many
+pairs the approximate kdtree backend assigns differently from the exact ones. The
+crossover it prints between the exact backends is what select_backend's GATED_MIN_PAIRS
+is set from.
+
+Usage, from src/:
+    python -m association.benchmark --sizes 10 30 100 300 1000 3000 --radius 0.3
+"""
+import argparse
+from time import perf_counter
+
+import numpy as np
+
+from association import hungarian_association as HA
+
+
+def make_scene(rng, n, clutter=1.0, density=0.5, noise=0.03, detection_probability=0.95):
+    """
+    Track positions and shuffled detections for `n` tracks, `density` tracks per cubic meter.
+    """
+    side = (n / density) ** (1 / 3)
+    tracks = rng.uniform(0, side, (n, 3))
+    seen = tracks[rng.random(n) < detection_probability]
+    detections = np.vstack([seen + rng.normal(0, noise, seen.shape),
+                            rng.uniform(0, side, (int(clutter * n), 3))])
+    return tracks, detections[rng.permutation(len(detections))]
+
+
+def time_backend(backend, scenes, radius):
+    times, results = [], []
+    for tracks, detections in scenes:
+        start = perf_counter()
+        rows, cols = HA.associate_positions(tracks, detections, radius, backend)
+        times.append(perf_counter() - start)
+        results.append(set(zip(rows.tolist(), cols.tolist())))
+    return float(np.median(times)), results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the association backends.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 30, 100, 300, 1000, 3000],
+                        help='numbers of tracks')
+    parser.add_argument('--clutter', type=float, default=1.0, help='false detections per track')
+    parser.add_argument('--radius', type=float, default=0.3, help='association gate in meters')
+    parser.add_argument('--repeats', type=int, default=5, help='scenes per size')
+    parser.add_argument('--max-dense', type=int, default=3000, help='largest size the dense solve is run on')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    rng = np.random.default_rng(args.seed)
+    backends = [b for b in HA.BACKENDS if b != 'auto']
+    print(f'{"tracks":>8} {"pairs":>12} ' + ' '.join(f'{b + "_ms":>12}' for b in backends)
+          + f' {"kdtree_diff":>12} {"auto":>8}')
+    fastest = []
+    for n in args.sizes:
+        scenes = [make_scene(rng, n, args.clutter) for _ in range(args.repeats)]
+        pairs = n * len(scenes[0][1])
+        timings = {}
+        exact = None
+        for backend in backends:
+            if backend == 'dense' and n > args.max_dense:
+                continue
+            timings[backend], results = time_backend(backend, scenes, args.radius)
+            if backend == 'gated':
+                exact = results
+            elif backend == 'kdtree':
+                diff = sum(len(a ^ b) for a, b in zip(exact, results))
+        exact_timings = {b: t for b, t in timings.items() if b != 'kdtree'}
+        fastest.append((pairs, min(exact_timings, key=exact_timings.get)))
+        cells = [f'{timings[b] * 1e3:>12.3f}' if b in timings else f'{"-":>12}' for b in backends]
+        print(f'{n:>8} {pairs:>12} ' + ' '.join(cells) + f' {diff:>12} '
+              f'{HA.select_backend(n, len(scenes[0][1]), args.radius):>8}')
+
+    for (_, previous), (pairs, backend) in zip(fastest, fastest[1:]):
+        if backend != previous:
+            print(f'{backend} overtakes {previous} at about {pairs} pairs')
+
+
+if __name__ == '__main__':
+    main()
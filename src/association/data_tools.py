@@ -1,5 +1,11 @@
-import numpy as np
+import bisect
+import json
 import os
+import queue
+import threading
+from time import monotonic
+
+import numpy as np
 
 def midpoint(p1, p2):
     midp = []
@@ -41,7 +47,299 @@ def load_datafile(path):
     
 
 
+# Session layout: <path>/index.json plus one preallocated .npy chunk per stream
+# every `chunk_rows` rows. Row offsets in the frame table are global across chunks.
+FRAME_DTYPE = np.dtype([('frame', '<i8'), ('time', '<f8'),
+                        ('detection_start', '<i8'), ('detection_count', '<i4'),
+                        ('track_start', '<i8'), ('track_count', '<i4')])
+DETECTION_DTYPE = np.dtype([('frame', '<i8'), ('position', '<f8', (3,))])
+TRACK_DTYPE = np.dtype([('frame', '<i8'), ('track', '<i4'), ('state', '<f8', (6,))])
+STREAMS = {'frames': FRAME_DTYPE, 'detections': DETECTION_DTYPE, 'tracks': TRACK_DTYPE}
+INDEX_FILE = 'index.json'
+INDEX_VERSION = 1
+
+
+class _ChunkWriter:
+    """
+    Appends rows of one stream into fixed size memory-mapped chunks, opening a
+    new preallocated chunk whenever the current one is full.
+    """
+    def __init__(self, directory, name, dtype, chunk_rows):
+        self.directory = directory
+        self.name = name
+        self.dtype = dtype
+        self.chunk_rows = chunk_rows
+        self.chunks = []
+        self.total = 0
+        self._map = None
+        self._used = 0
+
+    def _open_chunk(self):
+        if self._map is not None:
+            self._map.flush()
+        file = f'{self.name}_{len(self.chunks):05d}.npy'
+        self._map = np.lib.format.open_memmap(os.path.join(self.directory, file), mode='w+',
+                                              dtype=self.dtype, shape=(self.chunk_rows,))
+        self._used = 0
+        self.chunks.append({'file': file, 'start': self.total, 'rows': 0})
+
+    def append(self, rows):
+        done = 0
+        while done < len(rows):
+            if self._map is None or self._used == self.chunk_rows:
+                self._open_chunk()
+            n = min(len(rows) - done, self.chunk_rows - self._used)
+            self._map[self._used:self._used + n] = rows[done:done + n]
+            self._used += n
+            done += n
+            self.total += n
+            self.chunks[-1]['rows'] = self._used
+
+    def flush(self):
+        if self._map is not None:
+            self._map.flush()
+
+    def close(self):
+        self.flush()
+        self._map = None
+
+
+class TrajectoryRecorder(threading.Thread):
+    """
+    Streams per-frame detections and track states to a session directory at `path`.
+
+    `record` only copies the frame into a bounded queue; a background thread
+    converts track uids to small integer ids and writes everything into chunked,
+    preallocated memory-mapped files, so recording hours of tracking never grows
+    an array in memory. The index is rewritten atomically every `index_interval`
+    seconds and on `close`, so a TrajectoryReader can open a session that is
+    still being recorded. Frames arriving while the queue is full are counted in
+    `dropped` instead of blocking the caller.
+    """
+    def __init__(self, path, chunk_rows=65536, queue_size=256, index_interval=1.0, overwrite=False):
+        super().__init__(daemon=True)
+        if os.path.exists(os.path.join(path, INDEX_FILE)) and not overwrite:
+            raise FileExistsError(f'{path} already contains a recording')
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.index_interval = index_interval
+        self.dropped = 0
+        self.n_frames = 0
+        self._queue = queue.Queue(queue_size)
+        self._writers = {name: _ChunkWriter(path, name, dtype, chunk_rows) for name, dtype in STREAMS.items()}
+        self._uids = {}
+        self.start()
+
+    def record(self, time, detections=None, uids=(), states=None):
+        """
+        Queues one frame: its capture `time`, (k, 3) `detections` and the (n, 6) `states`
+        of the tracks `uids`. Returns False if the frame was dropped.
+        """
+        detections = np.empty((0, 3)) if detections is None else np.array(detections, dtype=np.float64).reshape(-1, 3)
+        states = np.empty((0, 6)) if states is None else np.array(states, dtype=np.float64).reshape(-1, 6)
+        try:
+            self._queue.put_nowait((time, detections, list(uids), states))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def _track_ids(self, uids):
+        ids = np.empty(len(uids), dtype=np.int32)
+        for i, uid in enumerate(uids):
+            ids[i] = self._uids.setdefault(uid, len(self._uids))
+        return ids
+
+    def _write(self, time, detections, uids, states):
+        frame = self.n_frames
+        detection_rows = np.empty(len(detections), DETECTION_DTYPE)
+        detection_rows['frame'] = frame
+        detection_rows['position'] = detections
+        track_rows = np.empty(len(states), TRACK_DTYPE)
+        track_rows['frame'] = frame
+        track_rows['track'] = self._track_ids(uids)
+        track_rows['state'] = states
+        frame_row = np.array([(frame, time, self._writers['detections'].total, len(detection_rows),
+                               self._writers['tracks'].total, len(track_rows))], FRAME_DTYPE)
+        self._writers['detections'].append(detection_rows)
+        self._writers['tracks'].append(track_rows)
+        self._writers['frames'].append(frame_row)
+        self.n_frames += 1
+
+    def _write_index(self):
+        for writer in self._writers.values():
+            writer.flush()
+        index = {
+            'version': INDEX_VERSION,
+            'chunk_rows': self.chunk_rows,
+            'n_frames': self.n_frames,
+            'streams': {name: {'dtype': np.lib.format.dtype_to_descr(writer.dtype), 'chunks': writer.chunks}
+                        for name, writer in self._writers.items()},
+            'uids': [str(uid) for uid in self._uids],
+        }
+        tmp_path = os.path.join(self.path, INDEX_FILE + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, os.path.join(self.path, INDEX_FILE))
+
+    def run(self):
+        next_index = monotonic() + self.index_interval
+        while True:
+            try:
+                item = self._queue.get(timeout=self.index_interval)
+            except queue.Empty:
+                item = False
+            if item is None:
+                break
+            if item:
+                self._write(*item)
+            if monotonic() >= next_index:
+                self._write_index()
+                next_index = monotonic() + self.index_interval
+        for writer in self._writers.values():
+            writer.close()
+        self._write_index()
+
+    def close(self):
+        """
+        Writes everything still queued, then the final index.
+        """
+        self._queue.put(None)
+        self.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _ChunkReader:
+    def __init__(self, directory, chunks, dtype):
+        self.directory = directory
+        self.chunks = chunks
+        self.dtype = dtype
+        self.starts = [chunk['start'] for chunk in chunks]
+        self._maps = {}
+
+    def chunk(self, i):
+        if i not in self._maps:
+            self._maps[i] = np.load(os.path.join(self.directory, self.chunks[i]['file']), mmap_mode='r')
+        return self._maps[i][:self.chunks[i]['rows']]
+
+    def rows(self, start, stop):
+        """
+        Returns rows [start, stop) of the stream; a view into the memory map when they lie in one chunk.
+        """
+        if stop <= start:
+            # A stream that was never written to, e.g. the tracks of a detections only session
+            return np.empty(0, self.dtype)
+        parts = []
+        i = bisect.bisect_right(self.starts, start) - 1
+        while start < stop:
+            offset = start - self.starts[i]
+            part = self.chunk(i)[offset:offset + stop - start]
+            parts.append(part)
+            start += len(part)
+            i += 1
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+
+class TrajectoryReader:
+    """
+    Read-only view of a session written by TrajectoryRecorder. Chunks are memory-mapped
+    on first access, so slicing a time range only touches the chunks it overlaps.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.refresh()
+
+    def refresh(self):
+        """
+        Re-reads the index, picking up frames recorded since the reader was opened.
+        """
+        with open(os.path.join(self.path, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        if self.index['version'] != INDEX_VERSION:
+            raise ValueError(f'Unsupported recording version {self.index["version"]}')
+        self.uids = self.index['uids']
+        self._streams = {name: _ChunkReader(self.path, stream['chunks'], STREAMS[name])
+                         for name, stream in self.index['streams'].items()}
+        frames = self._streams['frames']
+        # First time of every frame chunk, to find a time without touching the other chunks
+        self._chunk_times = [frames.chunk(i)['time'][0] for i in range(len(frames.chunks)) if frames.chunks[i]['rows']]
+
+    def __len__(self):
+        return self.index['n_frames']
+
+    def uid(self, track_id):
+        return self.uids[track_id]
+
+    def _frame_at(self, t, side):
+        # Index of the first frame with time >= t (side='left') or > t (side='right')
+        if not self._chunk_times:
+            return 0
+        i = max(bisect.bisect_right(self._chunk_times, t) - 1, 0)
+        frames = self._streams['frames']
+        return frames.chunks[i]['start'] + int(np.searchsorted(frames.chunk(i)['time'], t, side=side))
+
+    def frame_range(self, t_start=None, t_end=None):
+        """
+        Returns the [start, stop) frame numbers captured within [t_start, t_end].
+        """
+        start = 0 if t_start is None else self._frame_at(t_start, 'left')
+        stop = len(self) if t_end is None else self._frame_at(t_end, 'right')
+        return start, max(start, stop)
+
+    def read(self, t_start=None, t_end=None):
+        """
+        Returns the (frames, detections, tracks) structured arrays of the frames captured
+        within [t_start, t_end]. Each frame row holds the global offsets of its
+        detections and tracks.
+        """
+        start, stop = self.frame_range(t_start, t_end)
+        frames = self._streams['frames'].rows(start, stop)
+        if len(frames) == 0:
+            return frames, np.empty(0, DETECTION_DTYPE), np.empty(0, TRACK_DTYPE)
+        first, last = frames[0], frames[-1]
+        detections = self._streams['detections'].rows(first['detection_start'],
+                                                      last['detection_start'] + last['detection_count'])
+        tracks = self._streams['tracks'].rows(first['track_start'], last['track_start'] + last['track_count'])
+        return frames, detections, tracks
 
+    @property
+    def start_time(self):
+        return float(self._chunk_times[0]) if self._chunk_times else None
 
+    @property
+    def end_time(self):
+        if len(self) == 0:
+            return None
+        return float(self._streams['frames'].rows(len(self) - 1, len(self))['time'][0])
 
+    def iter_frames(self, t_start=None, t_end=None, batch=1024):
+        """
+        Yields (time, detections (k, 3), track ids (n,), states (n, 6)) per frame captured
+        within [t_start, t_end], reading `batch` frames at a time.
+        """
+        start, stop = self.frame_range(t_start, t_end)
+        return self.iter_frame_range(start, stop, batch)
 
+    def iter_frame_range(self, start, stop, batch=1024):
+        """
+        Same as iter_frames for the frame numbers [start, stop).
+        """
+        frame_stream = self._streams['frames']
+        for batch_start in range(start, stop, batch):
+            frames = frame_stream.rows(batch_start, min(batch_start + batch, stop))
+            first, last = frames[0], frames[-1]
+            detections = self._streams['detections'].rows(first['detection_start'],
+                                                          last['detection_start'] + last['detection_count'])
+            tracks = self._streams['tracks'].rows(first['track_start'], last['track_start'] + last['track_count'])
+            for frame in frames:
+                d = frame['detection_start'] - first['detection_start']
+                k = frame['track_start'] - first['track_start']
+                frame_tracks = tracks[k:k + frame['track_count']]
+                yield (float(frame['time']), detections[d:d + frame['detection_count']]['position'],
+                       frame_tracks['track'], frame_tracks['state'])
@@ -0,0 +1,204 @@
+"""
+fusion.py
+Fuses the detections of several cameras into one set of tracks.
+
+Each camera's detections are moved into a shared world frame with its
+extrinsics, detections of the same person seen by overlapping cameras are
+merged, and the merged points are fed to a single FrameHandler. Cameras
+report asynchronously: measurements are buffered by timestamp and only
+released once the newest timestamp seen is `delay` seconds past them, so the
+tracker always sees frames in time order even when measurements arrive out
+of order, within and across streams. A measurement older than the last
+released frame is too late for the filter and is counted in `late`.
+
+The world frame follows the camera convention (x right, y down, z forward,
+meters); a camera at the origin with no rotation is the identity transform.
+"""
+import heapq
+import itertools
+import json
+import threading
+
+import numpy as np
+
+
+def rotation_from_angles(yaw=0.0, pitch=0.0, roll=0.0):
+    """
+    Camera to world rotation for a camera turned by `yaw` (towards +x), `pitch`
+    (upwards) and `roll` (about its optical axis), in degrees.
+    """
+    yaw, pitch, roll = np.radians([yaw, pitch, roll])
+    cy, sy = np.cos(yaw), np.sin(yaw)
+    cp, sp = np.cos(pitch), np.sin(pitch)
+    cr, sr = np.cos(roll), np.sin(roll)
+    r_yaw = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    r_pitch = np.array([[1, 0, 0], [0, cp, -sp], [0, sp, cp]])
+    r_roll = np.array([[cr, -sr, 0], [sr, cr, 0], [0, 0, 1]])
+    return r_yaw @ r_pitch @ r_roll
+
+
+class CameraExtrinsics:
+    """
+    Rigid transform from a camera's frame into the world frame: p_world = R p_camera + t.
+    """
+    def __init__(self, rotation=None, translation=None):
+        self.rotation = np.eye(3) if rotation is None else np.asarray(rotation, dtype=np.float64).reshape(3, 3)
+        self.translation = np.zeros(3) if translation is None else np.asarray(translation, dtype=np.float64).reshape(3)
+
+    @classmethod
+    def from_dict(cls, entry):
+        """
+        Reads {"position": [x, y, z]} plus either "rotation" (3x3, row major) or
+        "yaw"/"pitch"/"roll" in degrees.
+        """
+        if 'rotation' in entry:
+            rotation = entry['rotation']
+        else:
+            rotation = rotation_from_angles(entry.get('yaw', 0.0), entry.get('pitch', 0.0), entry.get('roll', 0.0))
+        return cls(rotation, entry.get('position'))
+
+    def to_world(self, points):
+        """
+        Transforms (n, 3) camera points into the world frame.
+        """
+        return np.asarray(points, dtype=np.float64).reshape(-1, 3) @ self.rotation.T + self.translation
+
+
+def load_extrinsics(path):
+    """
+    Loads {camera name: CameraExtrinsics} from a JSON file mapping each camera name
+    to the dict read by CameraExtrinsics.from_dict.
+    """
+    with open(path) as f:
+        entries = json.load(f)
+    return {name: CameraExtrinsics.from_dict(entry) for name, entry in entries.items()}
+
+
+def merge_detections(points, cameras, max_dist=0.3):
+    """
+    Merges world frame `points` (n, 3) seen by `cameras` (n,) integer camera ids
+    into one point per person. Detections from different cameras closer than
+    `max_dist` are joined closest pair first, and a merged group never holds two
+    detections from the same camera. Returns the (m, 3) group centroids.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    cameras = np.asarray(cameras)
+    n = len(points)
+    if n < 2:
+        return points.copy()
+    distances = np.linalg.norm(points[:, None] - points[None], axis=2)
+    i, j = np.nonzero(np.triu((distances < max_dist) & (cameras[:, None] != cameras[None]), 1))
+    groups = np.arange(n)
+    if len(i):
+        order = np.argsort(distances[i, j], kind='stable')
+        members = {k: {cameras[k]} for k in range(n)}
+
+        def find(k):
+            while groups[k] != k:
+                groups[k] = groups[groups[k]]
+                k = groups[k]
+            return k
+
+        for a, b in zip(i[order], j[order]):
+            ra, rb = find(a), find(b)
+            if ra == rb or members[ra] & members[rb]:
+                continue
+            groups[rb] = ra
+            members[ra] |= members.pop(rb)
+        groups = np.array([find(k) for k in range(n)])
+    _, labels = np.unique(groups, return_inverse=True)
+    counts = np.bincount(labels)
+    centroids = np.zeros((len(counts), 3))
+    np.add.at(centroids, labels, points)
+    return centroids / counts[:, None]
+
+
+class MultiCameraFusion:
+    """
+    Collects timestamped detections from several cameras and feeds merged,
+    time-ordered frames to one FrameHandler.
+
+    Measurements whose timestamps lie within `window` seconds of each other (at
+    most one per camera) make up one frame at their mean time. add_detections is
+    safe to call from each camera's thread; process() is called from the
+    tracking thread and returns the number of frames it fed to the handler.
+    """
+    def __init__(self, handler, extrinsics, merge_dist=0.3, window=0.015, delay=0.1):
+        self.handler = handler
+        self.extrinsics = extrinsics
+        self.camera_ids = {name: i for i, name in enumerate(extrinsics)}
+        self.merge_dist = merge_dist
+        self.window = window
+        self.delay = delay
+        self.late = 0
+        self.last_time = None
+        self.frame_time = None
+        self.newest_time = None
+        self._pending = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, handler, fusion, extrinsics=None):
+        """
+        Creates the fusion layer from a CONFIG.FusionConfig, loading its extrinsics file
+        unless `extrinsics` is given.
+        """
+        extrinsics = load_extrinsics(fusion.extrinsics) if extrinsics is None else extrinsics
+        return cls(handler, extrinsics, merge_dist=fusion.merge_dist, window=fusion.window,
+                   delay=fusion.delay)
+
+    def add_detections(self, camera, timestamp, points):
+        """
+        Queues the (k, 3) detections `camera` captured at `timestamp` (seconds, one clock for all cameras).
+        """
+        world = self.extrinsics[camera].to_world(points)
+        with self._lock:
+            if self.last_time is not None and timestamp <= self.last_time:
+                self.late += 1
+                return False
+            self.newest_time = timestamp if self.newest_time is None else max(self.newest_time, timestamp)
+            heapq.heappush(self._pending, (timestamp, next(self._sequence), self.camera_ids[camera], world))
+        return True
+
+    def _pop_frame(self, watermark, flush):
+        first = self._pending[0][0]
+        # A frame is only complete once nothing within its window can still arrive
+        if not flush and first + self.window > watermark:
+            return None
+        measurements = []
+        seen = set()
+        while self._pending and self._pending[0][0] <= first + self.window and self._pending[0][2] not in seen:
+            timestamp, _, camera, points = heapq.heappop(self._pending)
+            seen.add(camera)
+            measurements.append((timestamp, camera, points))
+        return measurements
+
+    def process(self, flush=False):
+        """
+        Feeds every complete frame to the handler in time order. `flush` releases
+        everything still buffered, e.g. at shutdown.
+        """
+        frames = []
+        with self._lock:
+            if not self._pending:
+                return 0
+            watermark = self.newest_time - self.delay
+            while self._pending:
+                measurements = self._pop_frame(watermark, flush)
+                if measurements is None:
+                    break
+                timestamp = float(np.mean([m[0] for m in measurements]))
+                self.last_time = max(m[0] for m in measurements)
+                frames.append((timestamp, measurements))
+
+        for timestamp, measurements in frames:
+            points = np.vstack([m[2] for m in measurements])
+            cameras = np.concatenate([np.full(len(m[2]), m[1]) for m in measurements])
+            merged = merge_detections(points, cameras, self.merge_dist)
+            dt = None if self.frame_time is None else timestamp - self.frame_time
+            self.frame_time = timestamp
+            self.handler.add_frame(merged, dt=dt)
+            self.handler.associate_real_targets()
+            self.handler.associate_potential_targets()
+        return len(frames)
@@ -1,6 +1,7 @@
 import numpy as np
 from scipy.optimize import linear_sum_assignment
-from scipy.spatial import distance
+from scipy.spatial import cKDTree, distance
+from association.spatial_hash import SpatialHash, components
 #from target import Target
 
 def compute_velocity(target_pos, detection, dt):
@@ -76,3 +77,162 @@ def associate(targets, old_positions, detections, return_type='list', cost_type=
     associations = associate_detections(targets, detections, cost_matrix, return_type=return_type, dt=dt)
     return associations
 
+
+def associate_indices(old_positions, detections):
+    """
+    Minimum total distance assignment between the (n, 3) `old_positions` and the
+    (m, 3) `detections`. Returns the matched (row, column) index arrays; with
+    n != m the surplus rows or columns stay unmatched.
+    """
+    old_positions = np.asarray(old_positions, dtype=np.float64).reshape(-1, 3)
+    detections = np.asarray(detections, dtype=np.float64).reshape(-1, 3)
+    if len(old_positions) == 0 or len(detections) == 0:
+        empty = np.empty(0, dtype=int)
+        return empty, empty
+    return linear_sum_assignment(distance.cdist(old_positions, detections))
+
+
+# Backends of associate_positions. 'dense' and 'gated' are exact, 'kdtree' may give up
+# a match in contested clusters. 'auto' uses 'dense' without a gate or below
+# GATED_MIN_PAIRS track-detection pairs, where gated overtakes it (crossover measured
+# with association/benchmark.py), and 'gated' up to KDTREE_MIN_PAIRS. Only past that,
+# thousands of tracks, is the approximate 'kdtree' worth its dropped pairs
+BACKENDS = ('auto', 'dense', 'gated', 'kdtree')
+GATED_MIN_PAIRS = 250000
+KDTREE_MIN_PAIRS = 10000000
+
+
+def _empty_match():
+    empty = np.empty(0, dtype=int)
+    return empty, empty, np.empty(0)
+
+
+def _solve_components(n, m, rows, cols, costs, radius):
+    """
+    Optimal assignment over the candidate edges (rows, cols, costs) between n tracks and
+    m detections, solved separately on each connected component of the candidate graph.
+    Single-edge components are matched directly.
+    """
+    if len(rows) == 0:
+        return _empty_match()
+    # Bipartite graph: rows are nodes 0..n-1, columns n..n+m-1
+    labels = components(n + m, rows, cols + n)[rows]
+    edges_per_component = np.bincount(labels)
+    single = edges_per_component[labels] == 1
+    matched_rows, matched_cols, matched_costs = [rows[single]], [cols[single]], [costs[single]]
+
+    order = np.flatnonzero(~single)
+    order = order[np.argsort(labels[order], kind='stable')]
+    bounds = np.flatnonzero(np.diff(labels[order])) + 1
+    for edges in np.split(order, bounds) if len(order) else []:
+        r_ids, r = np.unique(rows[edges], return_inverse=True)
+        c_ids, c = np.unique(cols[edges], return_inverse=True)
+        cost = np.full((len(r_ids), len(c_ids)), np.inf)
+        cost[r, c] = costs[edges]
+        # Pairs outside the gate are allowed to the solver but never kept
+        big = 2 * radius * (len(r_ids) + len(c_ids)) + 1
+        rr, cc = linear_sum_assignment(np.where(np.isinf(cost), big, cost))
+        ok = np.isfinite(cost[rr, cc])
+        matched_rows.append(r_ids[rr[ok]])
+        matched_cols.append(c_ids[cc[ok]])
+        matched_costs.append(cost[rr[ok], cc[ok]])
+    return np.concatenate(matched_rows), np.concatenate(matched_cols), np.concatenate(matched_costs)
+
+
+def associate_gated(old_positions, detections, radius):
+    """
+    Same assignment as associate_indices restricted to pairs closer than `radius`.
+    Candidate pairs come from a spatial hash and the assignment is solved separately
+    on each connected component of the candidate graph, so clutter far from any
+    track costs next to nothing. Returns the matched (row, column, distance) arrays.
+    """
+    old_positions = np.asarray(old_positions, dtype=np.float64).reshape(-1, 3)
+    detections = np.asarray(detections, dtype=np.float64).reshape(-1, 3)
+    rows, cols, costs = SpatialHash(detections, radius).query_pairs(old_positions)
+    return _solve_components(len(old_positions), len(detections), rows, cols, costs, radius)
+
+
+def associate_kdtree(old_positions, detections, radius, k=4):
+    """
+    Approximate gated assignment for very large scenes. The `k` nearest detections
+    within `radius` of every track come from one cKDTree query. A track and detection
+    that are each other's nearest neighbour are matched right away, and only the
+    tracks and detections left contested go to associate_gated's per-component
+    Hungarian solve, over their k-nearest candidate edges. Returns the matched
+    (row, column, distance) arrays.
+    """
+    old_positions = np.asarray(old_positions, dtype=np.float64).reshape(-1, 3)
+    detections = np.asarray(detections, dtype=np.float64).reshape(-1, 3)
+    n, m = len(old_positions), len(detections)
+    if n == 0 or m == 0:
+        return _empty_match()
+    k = min(k, m)
+    costs, cols = cKDTree(detections).query(old_positions, k=k, distance_upper_bound=radius)
+    costs, cols = costs.reshape(n, k), cols.reshape(n, k)
+    # Missing neighbours come back as index m and distance inf
+    found = cols < m
+    if not found.any():
+        return _empty_match()
+
+    # Nearest track of every detection some track reached
+    reached = np.unique(cols[found])
+    _, nearest_track = cKDTree(old_positions).query(detections[reached], k=1, distance_upper_bound=radius)
+    best_track = np.full(m, -1)
+    best_track[reached] = nearest_track
+    first = np.flatnonzero(found[:, 0])
+    mutual = first[best_track[cols[first, 0]] == first]
+
+    matched_track = np.zeros(n, dtype=bool)
+    matched_track[mutual] = True
+    taken = np.zeros(m + 1, dtype=bool)
+    taken[cols[mutual, 0]] = True
+    # Edges among what is left
+    edges = found & ~matched_track[:, None] & ~taken[cols]
+    rows, rest_cols = np.nonzero(edges)
+    rest_rows, rest_cols, rest_costs = _solve_components(n, m, rows, cols[rows, rest_cols],
+                                                         costs[rows, rest_cols], radius)
+    return (np.concatenate([mutual, rest_rows]), np.concatenate([cols[mutual, 0], rest_cols]),
+            np.concatenate([costs[mutual, 0], rest_costs]))
+
+
+def select_backend(n_tracks, n_detections, radius=None):
+    """
+    The backend associate_positions uses for 'auto' on a problem of this size.
+    """
+    pairs = n_tracks * n_detections
+    if radius is None or pairs < GATED_MIN_PAIRS:
+        return 'dense'
+    if pairs < KDTREE_MIN_PAIRS:
+        return 'gated'
+    return 'kdtree'
+
+
+def associate_positions(old_positions, detections, radius=None, backend='auto'):
+    """
+    Assigns detections to tracks with one of BACKENDS, only keeping pairs closer than
+    `radius`. Without a `radius` the dense backend is used whatever `backend` is.
+    Returns the matched (row, column) index arrays.
+    """
+    old_positions = np.asarray(old_positions, dtype=np.float64).reshape(-1, 3)
+    detections = np.asarray(detections, dtype=np.float64).reshape(-1, 3)
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown association backend {backend!r}, expected one of {BACKENDS}')
+    if backend == 'auto' or radius is None:
+        # Without a gate every pair is a candidate, which only the dense solve handles
+        backend = select_backend(len(old_positions), len(detections), radius)
+    if backend == 'dense':
+        if radius is None:
+            return associate_indices(old_positions, detections)
+        if len(old_positions) == 0 or len(detections) == 0:
+            return _empty_match()[:2]
+        cost = distance.cdist(old_positions, detections)
+        outside = cost >= radius
+        cost[outside] = 2 * radius * sum(cost.shape) + 1
+        rows, cols = linear_sum_assignment(cost)
+        keep = ~outside[rows, cols]
+        return rows[keep], cols[keep]
+    if backend == 'gated':
+        rows, cols, _ = associate_gated(old_positions, detections, radius)
+    else:
+        rows, cols, _ = associate_kdtree(old_positions, detections, radius)
+    return rows, cols
@@ -0,0 +1,257 @@
+"""
+retrack.py
+Offline re-tracking of recorded sessions, for tuning the tracker.
+
+Every recording written by association.data_tools.TrajectoryRecorder is replayed
+through a fresh FrameHandler for each parameter set of a grid, and the tracks it
+produces are scored against the recording's reference tracks (the live tracker's
+output as recorded by turretMain, or the ground truth of a sim.harness --record
+scenario) with the CLEAR MOT metrics: MOTA, MOTP, ID switches, false positives and misses. Tracker latency
+is reported as the time per frame and the delay until a new reference track is
+first matched.
+
+Replays run on a process pool. Workers memory-map the recordings themselves, so
+only file paths and frame ranges are sent to them, and --segment splits long
+recordings into independent pieces so a day of data spreads over all cores.
+Each segment starts with an empty tracker, which costs a few frames of
+initiation per segment.
+
+Usage, from src/:
+    python -m association.retrack recordings/day1 recordings/day2 \
+        --grid Tracker.max_dist=0.3,0.5,1 --grid Tracker.min_frames=2,3 --segment 300
+"""
+import argparse
+import csv
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import perf_counter, perf_counter_ns
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+import CONFIG
+from association.data_tools import TrajectoryReader
+from frame_handler import FrameHandler
+from utils import metrics
+
+
+def match_frame(ref_ids, ref_positions, hyp_ids, hyp_positions, previous, threshold):
+    """
+    Matches reference and hypothesis tracks of one frame the CLEAR MOT way: a pair
+    from `previous` (reference id -> hypothesis id) is kept while it is closer than
+    `threshold`, the remaining tracks are assigned by minimum total distance.
+    Returns the matched (reference indices, hypothesis indices, distances).
+    """
+    if len(ref_ids) == 0 or len(hyp_ids) == 0:
+        empty = np.empty(0, dtype=int)
+        return empty, empty, np.empty(0)
+    distances = np.linalg.norm(ref_positions[:, None] - hyp_positions[None], axis=2)
+    hyp_index = {uid: j for j, uid in enumerate(hyp_ids)}
+    kept_rows, kept_cols = [], []
+    for i, ref_id in enumerate(ref_ids):
+        j = hyp_index.get(previous.get(ref_id))
+        if j is not None and distances[i, j] < threshold:
+            kept_rows.append(i)
+            kept_cols.append(j)
+
+    free_rows = np.setdiff1d(np.arange(len(ref_ids)), kept_rows)
+    free_cols = np.setdiff1d(np.arange(len(hyp_ids)), kept_cols)
+    rows, cols = np.array(kept_rows, dtype=int), np.array(kept_cols, dtype=int)
+    if len(free_rows) and len(free_cols):
+        cost = distances[np.ix_(free_rows, free_cols)]
+        r, c = linear_sum_assignment(np.where(cost < threshold, cost, 1e6))
+        valid = cost[r, c] < threshold
+        rows = np.concatenate([rows, free_rows[r[valid]]])
+        cols = np.concatenate([cols, free_cols[c[valid]]])
+    return rows, cols, distances[rows, cols]
+
+
+class TrackingStats:
+    """
+    CLEAR MOT counts and tracker timings, accumulated per frame and mergeable across replays.
+    """
+    def __init__(self, threshold=0.5):
+        self.threshold = threshold
+        self.frames = 0
+        self.references = 0
+        self.matches = 0
+        self.misses = 0
+        self.false_positives = 0
+        self.id_switches = 0
+        self.distance_sum = 0.0
+        self.initiation_delay_sum = 0.0
+        self.initiated = 0
+        self.frame_times = metrics.LatencyHistogram('retrack')
+        self._previous = {}
+        self._last_match = {}
+        self._first_seen = {}
+
+    def update(self, time, ref_ids, ref_positions, hyp_ids, hyp_positions):
+        rows, cols, distances = match_frame(ref_ids, ref_positions, hyp_ids, hyp_positions,
+                                            self._previous, self.threshold)
+        self.frames += 1
+        self.references += len(ref_ids)
+        self.matches += len(rows)
+        self.misses += len(ref_ids) - len(rows)
+        self.false_positives += len(hyp_ids) - len(cols)
+        self.distance_sum += float(distances.sum())
+        for ref_id in ref_ids:
+            self._first_seen.setdefault(ref_id, time)
+        self._previous = {}
+        for i, j in zip(rows, cols):
+            ref_id, hyp_id = ref_ids[i], hyp_ids[j]
+            self._previous[ref_id] = hyp_id
+            last = self._last_match.get(ref_id)
+            if last is None:
+                self.initiation_delay_sum += time - self._first_seen[ref_id]
+                self.initiated += 1
+            elif last != hyp_id:
+                self.id_switches += 1
+            self._last_match[ref_id] = hyp_id
+
+    def merge(self, other):
+        for name in ('frames', 'references', 'matches', 'misses', 'false_positives', 'id_switches',
+                     'distance_sum', 'initiation_delay_sum', 'initiated'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.frame_times.merge(other.frame_times)
+
+    def summary(self):
+        errors = self.misses + self.false_positives + self.id_switches
+        timing = self.frame_times.summary()
+        return {
+            'mota': 1 - errors / self.references if self.references else float('nan'),
+            'motp_m': self.distance_sum / self.matches if self.matches else float('nan'),
+            'id_switches': self.id_switches,
+            'false_positives': self.false_positives,
+            'misses': self.misses,
+            'references': self.references,
+            'frame_mean_ms': timing['mean_ms'],
+            'frame_p95_ms': timing['p95_ms'],
+            'initiation_s': self.initiation_delay_sum / self.initiated if self.initiated else float('nan'),
+        }
+
+    def __getstate__(self):
+        # Per-replay matching state doesn't need to travel back from the workers
+        state = self.__dict__.copy()
+        for name in ('_previous', '_last_match', '_first_seen'):
+            state[name] = {}
+        return state
+
+
+def replay(path, start, stop, config_path=None, overrides=None, threshold=0.5):
+    """
+    Replays frames [start, stop) of the recording at `path` through a FrameHandler
+    configured from `config_path` and `overrides` and returns its TrackingStats.
+    """
+    metrics.METRICS.enabled = False
+    settings = CONFIG.setup_config(config_path, overrides)
+    handler = FrameHandler.from_config(settings.tracker)
+    reader = TrajectoryReader(path)
+    stats = TrackingStats(threshold)
+    previous_time = None
+    default_dt = 1 / settings.camera.rgb_framerate
+    for time, detections, ref_ids, ref_states in reader.iter_frame_range(start, stop):
+        dt = default_dt if previous_time is None else time - previous_time
+        previous_time = time
+        begin = perf_counter_ns()
+        handler.add_frame(np.asarray(detections), dt=dt)
+        handler.associate_real_targets()
+        handler.associate_potential_targets()
+        uids, states, _ = handler.get_track_states()
+        stats.frame_times.record(perf_counter_ns() - begin)
+        stats.update(time, ref_ids.tolist(), ref_states[:, :3], uids, states[:, :3])
+    return stats
+
+
+def segments(path, segment=0.0):
+    """
+    Splits the recording at `path` into [start, stop) frame ranges of `segment` seconds, 0 keeps it whole.
+    """
+    reader = TrajectoryReader(path)
+    if len(reader) == 0:
+        return []
+    if segment <= 0:
+        return [(0, len(reader))]
+    starts = np.arange(reader.start_time, reader.end_time, segment)
+    bounds = [reader.frame_range(t)[0] for t in starts[1:]]
+    edges = [0] + bounds + [len(reader)]
+    return [(a, b) for a, b in zip(edges[:-1], edges[1:]) if b > a]
+
+
+def parse_grid(specs):
+    """
+    Expands 'Section.key=v1,v2,...' specs into the cartesian product of override
+    dicts in the {section: {key: value}} form accepted by CONFIG.setup_config.
+    """
+    axes = []
+    for spec in specs:
+        name, sep, values = spec.partition('=')
+        if not sep or not values:
+            raise ValueError(f'Grid axes must look like Section.key=v1,v2; got {spec!r}')
+        axes.append([f'{name}={value}' for value in values.split(',')])
+    return [list(combination) for combination in itertools.product(*axes)]
+
+
+def sweep(paths, grid, config_path=None, base_overrides=(), segment=0.0, threshold=0.5, workers=None):
+    """
+    Replays every recording in `paths` for each list of 'Section.key=value' overrides
+    in `grid` on a process pool. Returns one merged TrackingStats per grid entry.
+    """
+    overrides = [CONFIG.overrides_from_args(list(base_overrides) + entry) for entry in grid]
+    for override in overrides:
+        # Reject bad values before any work is sent out
+        CONFIG.setup_config(config_path, override)
+    jobs = [(path, start, stop) for path in paths for start, stop in segments(path, segment)]
+    results = [TrackingStats(threshold) for _ in grid]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(replay, path, start, stop, config_path, override, threshold): i
+                   for i, override in enumerate(overrides) for path, start, stop in jobs}
+        for future in as_completed(futures):
+            results[futures[future]].merge(future.result())
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Replay recorded detections through the tracker for a parameter grid')
+    parser.add_argument('recordings', nargs='+', help='session directories written by TrajectoryRecorder')
+    parser.add_argument('--grid', action='append', default=[], metavar='SECTION.KEY=V1,V2',
+                        help='parameter axis to sweep, may be given multiple times')
+    parser.add_argument('--segment', type=float, default=0.0,
+                        help='replay recordings in independent pieces of this many seconds, 0 keeps them whole')
+    parser.add_argument('--threshold', type=float, default=0.5,
+                        help='distance in meters below which a track matches a reference track')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='worker processes')
+    parser.add_argument('--output', default=None, help='CSV file for the results table')
+    CONFIG.add_config_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    grid = parse_grid(args.grid)
+    for path in args.recordings:
+        if not TrajectoryReader(path).uids:
+            print(f'{path} has no reference tracks, it only adds to the false positives and timings')
+    start = perf_counter()
+    results = sweep(args.recordings, grid, args.config, args.overrides, segment=args.segment,
+                    threshold=args.threshold, workers=args.workers)
+    rows = [{'config': ' '.join(entry) or 'default', **stats.summary()} for entry, stats in zip(grid, results)]
+    rows.sort(key=lambda row: -row['mota'] if row['mota'] == row['mota'] else np.inf)
+
+    fields = list(rows[0].keys())
+    width = max(len(row['config']) for row in rows)
+    print(f'{"config":<{width}} ' + ' '.join(f'{f:>15}' for f in fields[1:]))
+    for row in rows:
+        values = [f'{row[f]:>15.4f}' if isinstance(row[f], float) else f'{row[f]:>15}' for f in fields[1:]]
+        print(f'{row["config"]:<{width}} ' + ' '.join(values))
+    print(f'{len(grid)} configurations in {perf_counter() - start:.1f} s')
+    if args.output:
+        with open(args.output, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    main()
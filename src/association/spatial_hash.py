@@ -0,0 +1,112 @@
+"""
+spatial_hash.py
+Uniform voxel grid over 3D points for near-linear neighbour queries.
+
+Points are bucketed by their quantized position. The buckets are a sort of packed
+voxel keys, so a grid is rebuilt from scratch every frame with a couple of
+vectorized passes, and a radius query only looks at the 27 voxels around each
+query point instead of every stored point.
+"""
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+# 21 bits per axis, voxel coordinates are offset to keep them positive
+_BITS = 21
+_OFFSET = 1 << (_BITS - 1)
+_NEIGHBOURS = np.array(np.meshgrid([-1, 0, 1], [-1, 0, 1], [-1, 0, 1], indexing='ij')).reshape(3, -1).T
+
+
+def _pack(cells):
+    cells = cells + _OFFSET
+    return (cells[..., 0] << (2 * _BITS)) | (cells[..., 1] << _BITS) | cells[..., 2]
+
+
+class SpatialHash:
+    """
+    Voxel grid of `points` (n, 3) with cubic cells of `cell_size`. Radius queries
+    up to `cell_size` are exact.
+    """
+    def __init__(self, points, cell_size):
+        self.cell_size = cell_size
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        keys = _pack(self._cells(self.points))
+        self.order = np.argsort(keys, kind='stable')
+        self.keys = keys[self.order]
+
+    def _cells(self, points):
+        return np.floor(points / self.cell_size).astype(np.int64)
+
+    def query_pairs(self, queries, radius=None):
+        """
+        Returns (query index, point index, distance) arrays for every pair closer than
+        `radius` (at most, and by default, the cell size).
+        """
+        radius = self.cell_size if radius is None else radius
+        queries = np.asarray(queries, dtype=np.float64).reshape(-1, 3)
+        if len(queries) == 0 or len(self.points) == 0:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, np.empty(0)
+        # Key of every (query, neighbouring voxel) and the run of stored points in it
+        keys = _pack(self._cells(queries)[:, None, :] + _NEIGHBOURS[None]).ravel()
+        lo = np.searchsorted(self.keys, keys, side='left')
+        hi = np.searchsorted(self.keys, keys, side='right')
+        counts = hi - lo
+        total = int(counts.sum())
+        if total == 0:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, np.empty(0)
+        # Expand every run into one candidate per stored point
+        starts = np.repeat(lo - np.cumsum(counts) + counts, counts)
+        candidates = self.order[starts + np.arange(total)]
+        query_index = np.repeat(np.arange(len(keys)) // len(_NEIGHBOURS), counts)
+        distances = np.linalg.norm(queries[query_index] - self.points[candidates], axis=1)
+        close = distances < radius
+        return query_index[close], candidates[close], distances[close]
+
+    def self_pairs(self, radius=None):
+        """
+        Returns (i, j, distance) for every pair of stored points with i < j closer than `radius`.
+        """
+        i, j, distances = self.query_pairs(self.points, radius)
+        keep = i < j
+        return i[keep], j[keep], distances[keep]
+
+
+def components(n, i, j):
+    """
+    Connected component label of each of `n` nodes joined by the edges (i, j).
+    """
+    graph = coo_matrix((np.ones(len(i), dtype=np.int8), (i, j)), shape=(n, n))
+    return connected_components(graph, directed=False)[1]
+
+
+def dedup(points, radius):
+    """
+    Merges points closer than `radius` to each other (transitively) into their centroid.
+    Returns the (m, 3) merged points.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    if len(points) < 2 or not radius:
+        return points
+    i, j, _ = SpatialHash(points, radius).self_pairs()
+    if len(i) == 0:
+        return points
+    labels = components(len(points), i, j)
+    counts = np.bincount(labels)
+    merged = np.zeros((len(counts), 3))
+    np.add.at(merged, labels, points)
+    return merged / counts[:, None]
+
+
+def near_any(points, others, radius):
+    """
+    Mask of the `points` within `radius` of any of `others`.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    mask = np.zeros(len(points), dtype=bool)
+    if len(points) == 0 or len(others) == 0 or not radius:
+        return mask
+    query, _, _ = SpatialHash(others, radius).query_pairs(points)
+    mask[query] = True
+    return mask
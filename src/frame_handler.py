@@ -1,39 +1,98 @@
-import sys
-sys.path.insert(1,'./association')
-
 import numpy as np
-import uuid
-import hungarian_association as HA
+from association import hungarian_association as HA
+from association.spatial_hash import dedup, near_any
 from target import Target
+from utils import metrics
+from utils.imm import DEFAULT_STAY, IMMBank, transition_matrix
+
+
+class TrackRegistry:
+    """
+    Columnar storage for every track the FrameHandler knows about.
+
+    Each track occupies a slot in a set of parallel arrays: its integer id, whether
+    the slot is in use, whether the track is confirmed (has a Target with a UKF),
+    hit and missed frame counters, the first `history` positions of a tentative
+    track and the filter state of a confirmed one. Freed slots go on a free-list and
+    are reused before the arrays grow, so churn from short-lived clutter tracks
+    neither allocates per track nor lets the registry grow without bound.
+    """
+    def __init__(self, history=3, capacity=64):
+        self.history = history
+        self.capacity = 0
+        self.ids = np.empty(0, dtype=np.int64)
+        self.active = np.empty(0, dtype=bool)
+        self.confirmed = np.empty(0, dtype=bool)
+        self.hits = np.empty(0, dtype=np.int32)
+        self.missed = np.empty(0, dtype=np.int32)
+        self.positions = np.empty((0, history, 3))
+        self.states = np.empty((0, 6))
+        self.covariances = np.empty((0, 6, 6))
+        self.targets = []
+        self._free = []
+        self._next_id = 0
+        self._grow(capacity)
+
+    def _grow(self, capacity):
+        extra = capacity - self.capacity
+        self.ids = np.concatenate([self.ids, np.full(extra, -1, dtype=np.int64)])
+        self.active = np.concatenate([self.active, np.zeros(extra, dtype=bool)])
+        self.confirmed = np.concatenate([self.confirmed, np.zeros(extra, dtype=bool)])
+        self.hits = np.concatenate([self.hits, np.zeros(extra, dtype=np.int32)])
+        self.missed = np.concatenate([self.missed, np.zeros(extra, dtype=np.int32)])
+        self.positions = np.concatenate([self.positions, np.zeros((extra, self.history, 3))])
+        self.states = np.concatenate([self.states, np.zeros((extra, 6))])
+        self.covariances = np.concatenate([self.covariances, np.zeros((extra, 6, 6))])
+        self.targets.extend([None] * extra)
+        # Popped from the end, so low slots are handed out first
+        self._free = list(range(capacity - 1, self.capacity - 1, -1)) + self._free
+        self.capacity = capacity
+
+    def __len__(self):
+        return int(self.active.sum())
+
+    def add(self, points):
+        """
+        Starts a tentative track at each of the (k, 3) `points`. Returns their slots.
+        """
+        k = len(points)
+        if k == 0:
+            return np.empty(0, dtype=int)
+        if k > len(self._free):
+            self._grow(max(2 * self.capacity, self.capacity + k))
+        slots = np.array(self._free[-k:][::-1])
+        del self._free[-k:]
+        self.ids[slots] = np.arange(self._next_id, self._next_id + k)
+        self._next_id += k
+        self.active[slots] = True
+        self.confirmed[slots] = False
+        self.hits[slots] = 1
+        self.missed[slots] = 0
+        self.positions[slots, 0] = points
+        return slots
+
+    def release(self, slots):
+        self.active[slots] = False
+        self.confirmed[slots] = False
+        for slot in slots:
+            self.targets[slot] = None
+        self._free.extend(int(slot) for slot in slots)
+
+    def tentative_slots(self):
+        return np.flatnonzero(self.active & ~self.confirmed)
+
+    def confirmed_slots(self):
+        return np.flatnonzero(self.active & self.confirmed)
+
+    def last_positions(self, slots):
+        """
+        Latest position of the tentative tracks in `slots`.
+        """
+        return self.positions[slots, self.hits[slots] - 1]
+
+    def store_state(self, slot):
+        self.states[slot], self.covariances[slot] = self.targets[slot].get_state()
 
-class PotentialTarget:
-    def __init__(self, initial_pos, min_frames=3, max_missed=3):
-        self.min_frames = min_frames
-        self.max_missed = max_missed
-        self.tracked_frames = 1
-        self.missed_frames = 0
-        self.pos = np.array([initial_pos])
-        self.is_target = False
-        self.invalid_target = False
-        self.uid = uuid.uuid4()
-
-    def add_pos(self, pos):
-        self.pos = np.vstack((self.pos, pos))
-        self.tracked_frames += 1
-        self.missed_frames = 0
-        if self.tracked_frames >= self.min_frames:
-            self.is_target = True
-
-    def no_match(self):
-        self.missed_frames += 1
-        if self.missed_frames >= self.max_missed:
-            self.invalid_target = True
-    
-    def __eq__(self, other):
-        return isinstance(other, PotentialTarget) and self.uid == other.uid
-    
-    def __hash__(self):
-        return hash(self.uid)
 
 """
 You need to associate your real targets before generating/associating your potential targets.
@@ -42,144 +101,275 @@ to generate new potential targets from all of the unassociated points.
 """
 
 class FrameHandler:
-    def __init__(self):
-        self.cur_frame = np.array([[]])
+    def __init__(self, min_frames=3, max_missed=3, max_dist=None, max_vel=None,
+                 process_noise=.1, measurement_noise=.1**2, initial_covariance=.2,
+                 rls_degree=2, rls_forgetting=.9, dedup_dist=None, birth_dist=None, association='auto',
+                 motion_model='cv', imm_q_cv=200., imm_q_ca=5000., imm_q_stationary=.5,
+                 imm_stay=DEFAULT_STAY, verbose=False):
+        if min_frames < 2:
+            # A track is confirmed from its registry history, which needs two positions for a velocity
+            raise ValueError(f'min_frames must be at least 2; got {min_frames}')
+        self.min_frames = min_frames
+        self.max_missed = max_missed
+        # Default association gates, used when associate_* is not given its own
+        self.max_dist = max_dist
+        self.max_vel = max_vel
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.initial_covariance = initial_covariance
+        self.rls_degree = rls_degree
+        self.rls_forgetting = rls_forgetting
+        # Detections closer than dedup_dist are merged, and none closer than birth_dist
+        # to an existing track starts a new one
+        self.dedup_dist = dedup_dist
+        self.birth_dist = birth_dist
+        # Backend of HA.associate_positions
+        self.association = association
+        self.verbose = verbose
+        self.cur_frame = np.empty((0, 3))
         self.frame_dt = None
-        self.potential_targets = []
-        self.real_targets = []
+        self.registry = TrackRegistry(history=min_frames)
+        # 'cv': a constant velocity UKF per Target, 'imm': one batched IMM bank for all of them
+        self.motion_model = motion_model
+        self.imm = None
+        if motion_model == 'imm':
+            # The IMM has noise terms of its own per model, process_noise is the UKF's
+            self.imm = IMMBank(self.registry.capacity, transition=transition_matrix(imm_stay),
+                               measurement_noise=measurement_noise, initial_covariance=initial_covariance,
+                               q_cv=imm_q_cv, q_ca=imm_q_ca, q_stationary=imm_q_stationary)
+        elif motion_model != 'cv':
+            raise ValueError(f"motion_model must be 'cv' or 'imm'; got {motion_model!r}")
+        # Detections of the current frame already taken by a real target
+        self._claimed = np.zeros(0, dtype=bool)
+        self.listeners = []
+
+    @classmethod
+    def from_config(cls, tracker, verbose=False):
+        """
+        Creates a FrameHandler from a CONFIG.TrackerConfig.
+        """
+        return cls(min_frames=tracker.min_frames, max_missed=tracker.max_missed,
+                   max_dist=tracker.max_dist, max_vel=tracker.max_vel,
+                   process_noise=tracker.process_noise, measurement_noise=tracker.measurement_noise,
+                   initial_covariance=tracker.initial_covariance,
+                   rls_degree=tracker.rls_degree, rls_forgetting=tracker.rls_forgetting,
+                   dedup_dist=tracker.dedup_dist, birth_dist=tracker.birth_dist,
+                   association=tracker.association, motion_model=tracker.motion_model,
+                   imm_q_cv=tracker.imm_q_cv, imm_q_ca=tracker.imm_q_ca, imm_q_stationary=tracker.imm_q_stationary,
+                   imm_stay=tracker.imm_stay, verbose=verbose)
+
+    @property
+    def real_targets(self):
+        return [self.registry.targets[slot] for slot in self.registry.confirmed_slots()]
+
+    def add_listener(self, listener):
+        """
+        Registers an object that is told about track lifecycle changes as they happen.
+        It may implement any of on_target_new(target), on_target_updated(target) and
+        on_target_lost(target); missing methods are skipped.
+        """
+        self.listeners.append(listener)
+
+    def _notify(self, event, target):
+        for listener in self.listeners:
+            callback = getattr(listener, event, None)
+            if callback is not None:
+                callback(target)
 
     def add_frame(self, frame, dt=None):
         if not isinstance(frame, (list, tuple, np.ndarray)):
             raise ValueError(f"Frame must be a list, tuple, or ndarray; recieved type {type(frame)}.")
-        
-        if len(self.potential_targets) == 0 and self.cur_frame.size == 0:
-            for point in frame:
-                self.potential_targets.append(PotentialTarget(point))
-        else:
-            if dt is not None and not isinstance(dt, (int, float)):
-                raise ValueError(f"dt must be a valid number (float or int); received type(dt) = {type(dt)}")
-            self.frame_dt = dt
-            self.cur_frame = np.array(frame)
+        if dt is not None and not isinstance(dt, (int, float)):
+            raise ValueError(f"dt must be a valid number (float or int); received type(dt) = {type(dt)}")
+        self.frame_dt = dt
+        self.cur_frame = dedup(np.asarray(frame, dtype=np.float64).reshape(-1, 3), self.dedup_dist)
+        self._claimed = np.zeros(len(self.cur_frame), dtype=bool)
+
+    def _associate(self, old_positions, new_positions, max_dist=None, max_vel=None):
+        """
+        Assigns detections to tracks with the configured HA.associate_positions backend.
+        When a gate bounds the distance a track can move, only pairs inside it are matched.
+        """
+        gates = [g for g in (max_dist, max_vel * self.frame_dt if max_vel is not None and self.frame_dt else None)
+                 if g is not None]
+        with metrics.stage('association'):
+            rows, cols = HA.associate_positions(old_positions, new_positions, min(gates) if gates else None,
+                                                backend=self.association)
+        ok = self._within_limits(old_positions[rows], new_positions[cols], max_dist, max_vel)
+        return rows[ok], cols[ok]
+
+    def _within_limits(self, old_positions, new_positions, max_dist=None, max_vel=None):
+        """
+        Mask of the (old, new) position pairs that pass the distance and velocity gates.
+        """
+        distances = np.linalg.norm(old_positions - new_positions, axis=1)
+        ok = np.ones(len(distances), dtype=bool)
+        if max_vel is not None and self.frame_dt:
+            ok &= distances / self.frame_dt < max_vel
+        if max_dist is not None:
+            ok &= distances < max_dist
+        return ok
 
     def associate_potential_targets(self, assoc_type='dist', max_dist=None, max_vel=None):
-        if self.cur_frame.size == 0: 
-            return []
-        
-        pt_positions = [pt.pos[-1] for pt in self.potential_targets]
-        associations = HA.associate(self.potential_targets, pt_positions, 
-                                    self.cur_frame, return_type='dict', max_dist=max_dist, max_vel=max_vel)
-        new_targets = []
-        pt_to_remove = []
-        unassociated_points = self.cur_frame.copy()
-
-        for pt in self.potential_targets:
-            associated_pos = associations[pt]
-            if associated_pos is not None:
-                if self._is_within_limits_pt(pt, associated_pos, max_dist, max_vel):
-                    pt.add_pos(associated_pos)
-                    if pt.is_target:
-                        new_targets.append(self._convert_to_target(pt))
-                        pt_to_remove.append(pt.uid)
-                    # Remove associated point from unassociated
-                    unassociated_points = np.array([p for p in unassociated_points if not np.array_equal(p, associated_pos)])
-                else:
-                    pt.no_match()
-                    if pt.invalid_target:
-                        pt_to_remove.append(pt.uid)
-        
-        # Cleanup invalid or converted targets
-        #self.potential_targets = [pt for pt in self.potential_targets if pt.uid not in pt_to_remove]
-        new_potential_targets = []
-        for pt in self.potential_targets:
-            if pt.uid not in pt_to_remove:
-                new_potential_targets.append(pt)
-        self.potential_targets = new_potential_targets
-
-        # Create new potential targets for unassociated points
-        #print(unassociated_points)
-        for pos in unassociated_points:
-            if len(self.real_targets) == 0:
-                self.potential_targets.append(PotentialTarget(pos))
-                continue
-            has_assoc = False
-            for rt in self.real_targets:
-                #print(f'Checking for {pos} == {rt._positions[-1]}')
-                #print((rt._positions[-1] == pos).all())
-                if (rt._positions[-1] == pos).all():
-                    has_assoc = True
-                    break
-            if has_assoc == False:
-                self.potential_targets.append(PotentialTarget(pos))
+        """
+        Matches the detections no real target took to the tentative tracks, promotes the
+        ones seen for `min_frames` frames to Targets and starts tentative tracks at the
+        remaining detections. Returns the new Targets.
+        """
+        registry = self.registry
+        max_dist = self.max_dist if max_dist is None else max_dist
+        max_vel = self.max_vel if max_vel is None else max_vel
+        points = self.cur_frame[~self._claimed]
+        slots = registry.tentative_slots()
 
-        for new_target in new_targets:
-            self.real_targets.append(new_target)
+        rows = cols = np.empty(0, dtype=int)
+        if len(slots) and len(points):
+            rows, cols = self._associate(registry.last_positions(slots), points, max_dist, max_vel)
+
+        # Lifecycle of all tentative tracks as mask updates
+        hit = slots[rows]
+        registry.positions[hit, registry.hits[hit]] = points[cols]
+        registry.hits[hit] += 1
+        registry.missed[hit] = 0
+        matched = np.zeros(len(slots), dtype=bool)
+        matched[rows] = True
+        registry.missed[slots[~matched]] += 1
+        registry.release(slots[registry.missed[slots] >= self.max_missed])
+
+        new_targets = [self._convert_to_target(slot) for slot in hit[registry.hits[hit] >= self.min_frames]]
+
+        unassociated = np.ones(len(points), dtype=bool)
+        unassociated[cols] = False
+        births = points[unassociated]
+        if self.birth_dist and len(births):
+            # Near-duplicates of tracks that already exist would only become duplicate tracks
+            tentative = registry.tentative_slots()
+            existing = np.vstack([registry.states[registry.confirmed_slots(), :3], registry.last_positions(tentative)])
+            births = births[~near_any(births, existing, self.birth_dist)]
+        registry.add(births)
 
+        for new_target in new_targets:
+            self._notify('on_target_new', new_target)
         return new_targets
 
     def associate_real_targets(self, assoc_type='dist', max_dist=None, max_vel=None):
-        if len(self.real_targets) == 0:
+        """
+        Matches the current detections to the real targets, updates their filters and
+        drops the ones missed `max_missed` frames in a row. The detections taken here
+        are left out of associate_potential_targets.
+        """
+        registry = self.registry
+        slots = registry.confirmed_slots()
+        if len(slots) == 0:
             return
-        rt_positions = [rt._ukf.x[:3] for rt in self.real_targets]
-        associations = HA.associate(self.real_targets, rt_positions, self.cur_frame, return_type='dict',
-                                    max_dist=max_dist, max_vel=max_vel)
-
-        unassociated_points = []
-        rt_to_remove = []
-        for rt in self.real_targets:
-            associated_pos = associations[rt]
-            if associated_pos is not None:
-                print(f'Comparing distance with {rt._ukf.x[:3]} and {associated_pos}')
-                if self._is_within_limits_rt(rt, associated_pos, assoc_type=assoc_type, max_dist=max_dist, max_vel=max_vel):
-                    rt.add_pos(associated_pos, self.frame_dt)
-                else:
-                    rt.no_match()
-                    if rt.invalid_target:
-                        rt_to_remove.append(rt._uid)
+        max_dist = self.max_dist if max_dist is None else max_dist
+        max_vel = self.max_vel if max_vel is None else max_vel
+        if self.imm is not None:
+            # All tracks coast forward together, and association sees where they should be now
+            with metrics.stage('filtering'):
+                self.imm.predict(slots, self.frame_dt)
+                registry.states[slots], registry.covariances[slots] = self.imm.combined(slots)
+        positions = registry.states[slots, :3]
+
+        rows = cols = np.empty(0, dtype=int)
+        if len(self.cur_frame):
+            rows, cols = self._associate(positions, self.cur_frame, max_dist, max_vel)
+            if self.verbose:
+                for r, c in zip(rows, cols):
+                    print(f'Matched {positions[r]} and {self.cur_frame[c]}')
+        self._claimed[cols] = True
+
+        with metrics.stage('filtering'):
+            if self.imm is not None:
+                self.imm.update(slots[rows], self.cur_frame[cols])
+                states, covariances = self.imm.combined(slots[rows])
+            for i, (slot, c) in enumerate(zip(slots[rows], cols)):
+                target = registry.targets[slot]
+                target.add_pos(self.cur_frame[c], self.frame_dt)
+                if self.imm is not None:
+                    target.set_state(states[i], covariances[i])
+                registry.store_state(slot)
+                self._notify('on_target_updated', target)
+
+        hit = slots[rows]
+        registry.hits[hit] += 1
+        registry.missed[hit] = 0
+        matched = np.zeros(len(slots), dtype=bool)
+        matched[rows] = True
+        registry.missed[slots[~matched]] += 1
 
         # remove targets that have too many missed frames
-        new_real_targets = []
-        for rt in self.real_targets:
-            if rt._uid not in rt_to_remove:
-                new_real_targets.append(rt)
-        self.real_targets = new_real_targets
+        lost = slots[registry.missed[slots] >= self.max_missed]
+        lost_targets = [registry.targets[slot] for slot in lost]
+        registry.release(lost)
+        for target in lost_targets:
+            self._notify('on_target_lost', target)
 
+    def get_track_states(self):
+        """
+        Returns the uids of the real targets with an initialised UKF, their stacked
+        (n, 6) states and (n, 6, 6) covariances, e.g. for utils.intercept.solve_intercept.
+        """
+        slots = self.registry.confirmed_slots()
+        return self.registry.ids[slots].tolist(), self.registry.states[slots], self.registry.covariances[slots]
 
+    def get_track_velocities(self):
+        """
+        Velocities of the real targets' RLS polynomial fits, (n, 3) in get_track_states
+        order. Smoother than the filter velocity, for extrapolating tracks ahead.
+        """
+        slots = self.registry.confirmed_slots()
+        velocities = np.zeros((len(slots), 3))
+        for i, slot in enumerate(slots):
+            velocities[i] = self.registry.targets[slot]._rls.velocity()
+        return velocities
 
+    def get_track_missed(self):
+        """
+        Frames since each real target was last matched, in get_track_states order.
+        """
+        return self.registry.missed[self.registry.confirmed_slots()].copy()
 
-    def _is_within_limits_pt(self, pt, pos, assoc_type='dist', max_dist=None, max_vel=None):
-        if max_vel is not None:
-            velocity = self._compute_velocity(pt.pos[-1], pos, self.frame_dt)
-            if velocity >= max_vel:
-                return False
-        if max_dist is not None:
-            distance = np.linalg.norm(pt.pos[-1] - pos)
-            if distance >= max_dist:
-                return False
-        return True
-    
-    def _is_within_limits_rt(self, rt, pos, assoc_type='dist', max_dist=None, max_vel=None):
-        if max_vel is not None:
-            velocity = self._compute_velocity(rt._ukf.x[:3], pos, self.frame_dt)
-            if velocity >= max_vel:
-                return False
-        if max_dist is not None:
-            distance = np.linalg.norm(rt._ukf.x[:3] - pos)
-            if distance >= max_dist:
-                return False
-        return True
-
-    def _compute_velocity(self, prev_pos, new_pos, dt):
-        dx = np.abs(prev_pos - new_pos)
-        return np.linalg.norm(dx) / dt
-
-    def _convert_to_target(self, potential_target):
-        new_target = Target(_uid=potential_target.uid)
-        for pos in potential_target.pos:
+    def get_poly_predictions(self, predictor, steps=1):
+        """
+        Runs a utils.polyreg.PolyPredictor over the last `predictor.window` positions of
+        every real target with enough history, in one batched call. Returns the uids of
+        those targets and an (n, 3) array of their predicted next positions.
+        """
+        targets = [rt for rt in self.real_targets if len(rt._positions) >= predictor.window]
+        if len(targets) == 0:
+            return [], np.empty((0, 3))
+        histories = np.stack([rt._positions[-predictor.window:] for rt in targets])
+        return [rt._uid for rt in targets], predictor.estimate(histories, steps)
+
+    def make_target(self, uid):
+        """
+        An empty Target with this handler's filter settings.
+        """
+        return Target(_uid=uid, _max_missed_frames=self.max_missed,
+                      _process_noise=self.process_noise, _measurement_noise=self.measurement_noise,
+                      _initial_covariance=self.initial_covariance,
+                      _rls_degree=self.rls_degree, _rls_forgetting=self.rls_forgetting,
+                      _ukf_enabled=self.imm is None)
+
+    def _convert_to_target(self, slot):
+        registry = self.registry
+        new_target = self.make_target(int(registry.ids[slot]))
+        history = registry.positions[slot, :registry.hits[slot]]
+        for pos in history:
             new_target.add_pos(pos, dt=self.frame_dt)
+        if self.imm is not None:
+            velocity = (history[-1] - history[-2]) / self.frame_dt if len(history) > 1 and self.frame_dt else np.zeros(3)
+            self.imm.grow(registry.capacity)
+            self.imm.start([slot], history[-1:], velocity[None])
+            state, covariance = self.imm.combined([slot])
+            new_target.set_state(state[0], covariance[0])
+        registry.targets[slot] = new_target
+        registry.confirmed[slot] = True
+        registry.store_state(slot)
         return new_target
 
 # Example usage (commented out for now)
 # handler = FrameHandler()
 # handler.add_frame([[1, 2], [3, 4]], dt=0.05)
 # targets = handler.associate_frames(max_dist=10, max_vel=2)
-
@@ -0,0 +1,233 @@
+"""
+harness.py
+Closed-loop aiming test without hardware: a ScenarioSource stands in for the
+camera and detector, its detections go through FrameHandler, the
+EngagementScheduler and the intercept solver, and the resulting aim commands
+drive a SimulatedTurret running at its own control rate.
+
+Each run is repeated for every --latency (the delay between a frame being
+captured and its detections reaching the tracker) and every --controller, and
+reports the aiming error against the ideal lead computed from ground truth, plus
+control loop jitter. The 'frame' controller aims once per vision frame, the
+'loop' controller runs utils.control_loop.ControlLoop at --loop-rate and
+extrapolates the track to the current time. --command-latency delays every
+aim command inside the simulated turret, like a slow serial link or servo
+controller would.
+
+--record PATH writes the scenario's detections and ground truth as a recording
+for association.retrack instead of running the trials.
+
+Usage, from src/:
+    python -m sim.harness --duration 10 --latency 0 0.05 0.1 --output errors.csv
+    python -m sim.harness --duration 600 --targets 4 --record recordings/walkers
+"""
+import argparse
+import csv
+from time import perf_counter, sleep
+
+import numpy as np
+
+import CONFIG
+from association.data_tools import TrajectoryRecorder
+from frame_handler import FrameHandler
+from sim.scenario import ScenarioSource
+from sim.turret import SimulatedTurret
+from utils.control_loop import ControlLoop, SnapshotBuffer
+from utils.intercept import solve_intercept
+from utils.scheduler import EngagementScheduler
+
+
+def angular_error(pan_a, tilt_a, pan_b, tilt_b):
+    """
+    Angle in radians between the pointing directions (pan_a, tilt_a) and (pan_b, tilt_b).
+    """
+    cos = np.sin(tilt_a) * np.sin(tilt_b) + np.cos(tilt_a) * np.cos(tilt_b) * np.cos(pan_a - pan_b)
+    return np.arccos(np.clip(cos, -1, 1))
+
+
+class AimController:
+    """
+    Aims once per processed vision frame: picks the scheduler's top track and
+    commands the turret to its intercept angles.
+    """
+    def __init__(self, handler, scheduler, turret, turret_config):
+        self.handler = handler
+        self.scheduler = scheduler
+        self.turret = turret
+        self.turret_config = turret_config
+
+    def on_frame(self, capture_time, now):
+        """
+        Called after a frame was tracked. Returns the engaged track's position or None.
+        """
+        pick = self.scheduler.peek()
+        if pick is None:
+            return None
+        uids, states, covariances = self.handler.get_track_states()
+        if pick[0] not in uids:
+            return None
+        state = states[uids.index(pick[0])]
+        solution = solve_intercept(state[None], projectile_speed=self.turret_config.projectile_speed,
+                                   gravity=self.turret_config.gravity, latency=self.turret_config.latency)
+        if solution.valid[0]:
+            self.turret.command(solution.pan[0], solution.tilt[0], now)
+        return state[:3]
+
+
+class LoopController:
+    """
+    Publishes every tracked frame into a SnapshotBuffer and leaves the aiming to a
+    ControlLoop thread running at `rate` Hz.
+    """
+    def __init__(self, handler, scheduler, turret, turret_config, rate=250):
+        self.handler = handler
+        self.scheduler = scheduler
+        self.buffer = SnapshotBuffer()
+        self.loop = ControlLoop.from_config(self.buffer, turret, turret_config, rate=rate)
+        self.loop.start()
+
+    def on_frame(self, capture_time, now):
+        pick = self.scheduler.peek()
+        uids, states, covariances = self.handler.get_track_states()
+        selected = pick[0] if pick is not None and pick[0] in uids else None
+        # The loop extrapolates with the RLS velocity, the UKF velocity lags turns too much for it
+        states = np.hstack([states[:, :3], self.handler.get_track_velocities()])
+        self.buffer.publish(uids, states, capture_time, selected)
+        if selected is None:
+            return None
+        return states[uids.index(selected), :3]
+
+    def stop(self):
+        self.loop.stop()
+        self.loop.join()
+
+
+CONTROLLERS = {'frame': AimController, 'loop': LoopController}
+
+
+def run_trial(settings, scenario, latency, control_rate=500, controller_type=AimController, command_latency=0.0,
+              **controller_kwargs):
+    """
+    Runs `scenario` in real time with a vision `latency` and a turret `command_latency`,
+    both in seconds. Returns the per-tick (time, aiming error) array and the turret's
+    jitter statistics.
+    """
+    handler = FrameHandler.from_config(settings.tracker)
+    scheduler = EngagementScheduler.from_config(settings.turret)
+    handler.add_listener(scheduler)
+    turret = SimulatedTurret.from_config(settings.turret, control_rate=control_rate, latency=command_latency,
+                                         history=int((scenario.duration + 1) * control_rate))
+    controller = controller_type(handler, scheduler, turret, settings.turret, **controller_kwargs)
+
+    frames = list(scenario.frames())
+    dt = 1 / scenario.fps
+    # (time, truth index) of the target being engaged, for scoring
+    engaged = []
+
+    turret.start()
+    t0 = perf_counter()
+    try:
+        for capture_time, detections in frames:
+            # Detections become available `latency` after the frame was captured
+            sleep(max(0.0, t0 + capture_time + latency - perf_counter()))
+            handler.add_frame(detections, dt=dt)
+            handler.associate_real_targets()
+            handler.associate_potential_targets()
+            position = controller.on_frame(t0 + capture_time, perf_counter())
+            if position is not None:
+                truth, _ = scenario.truth(capture_time)
+                engaged.append((perf_counter() - t0, np.argmin(np.linalg.norm(truth - position, axis=1))))
+        sleep(max(0.0, t0 + scenario.duration - perf_counter()))
+    finally:
+        turret.stop()
+        turret.join()
+        if hasattr(controller, 'stop'):
+            controller.stop()
+
+    log = turret.get_log().copy()
+    log[:, 0] -= t0
+    if len(engaged) == 0:
+        return np.empty((0, 2)), turret.jitter()
+    engaged = np.array(engaged)
+    log = log[(log[:, 0] >= engaged[0, 0]) & (log[:, 0] <= scenario.duration)]
+    target = engaged[np.searchsorted(engaged[:, 0], log[:, 0], side='right') - 1, 1].astype(int)
+    positions, velocities = scenario.truth(log[:, 0])
+    rows = np.arange(len(log))
+    true_states = np.hstack([positions[target, rows], velocities[target, rows]])
+    ideal = solve_intercept(true_states, projectile_speed=settings.turret.projectile_speed,
+                            gravity=settings.turret.gravity, latency=settings.turret.latency)
+    errors = angular_error(log[:, 1], log[:, 2], ideal.pan, ideal.tilt)
+    return np.column_stack([log[:, 0], errors]), turret.jitter()
+
+
+def summarize(controller, latency, errors, jitter):
+    err_deg = np.degrees(errors[:, 1]) if len(errors) else np.array([np.nan])
+    return {
+        'controller': controller,
+        'latency_ms': latency * 1e3,
+        'mean_error_deg': float(np.nanmean(err_deg)),
+        'p95_error_deg': float(np.nanpercentile(err_deg, 95)),
+        'tick_mean_ms': jitter['mean_ms'],
+        'tick_std_ms': jitter['std_ms'],
+        'tick_p99_dev_ms': jitter['p99_dev_ms'],
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Closed-loop simulated aiming test')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per run')
+    parser.add_argument('--latency', type=float, nargs='+', default=[0.0, 0.05, 0.1],
+                        help='vision pipeline latencies to compare, in seconds')
+    parser.add_argument('--fps', type=float, default=30, help='simulated camera frame rate')
+    parser.add_argument('--command-latency', type=float, default=0.0,
+                        help='seconds between an aim command and the turret acting on it')
+    parser.add_argument('--control-rate', type=float, default=500, help='turret control rate in Hz')
+    parser.add_argument('--controller', nargs='+', choices=sorted(CONTROLLERS), default=['frame', 'loop'],
+                        help='aim once per vision frame and/or from the fixed-rate control loop')
+    parser.add_argument('--loop-rate', type=float, default=250, help='control loop rate in Hz')
+    parser.add_argument('--targets', type=int, default=1, help='number of simulated people')
+    parser.add_argument('--noise', type=float, default=0.02, help='detection noise std in meters')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='CSV file for the aiming error time series')
+    parser.add_argument('--record', default=None, metavar='PATH',
+                        help='only write the scenario with its ground truth as a recording to PATH')
+    CONFIG.add_config_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    settings = CONFIG.setup_from_args(args)
+    if args.record:
+        scenario = ScenarioSource(n_targets=args.targets, duration=args.duration, fps=args.fps,
+                                  noise=args.noise, seed=args.seed)
+        # The queue is sized so generating faster than real time never drops a frame
+        with TrajectoryRecorder(args.record, chunk_rows=settings.recording.chunk_rows,
+                                queue_size=int(args.duration * args.fps) + 1) as recorder:
+            scenario.record(recorder)
+        return
+    rows = []
+    series = []
+    for name in args.controller:
+        kwargs = {'rate': args.loop_rate} if name == 'loop' else {}
+        for latency in args.latency:
+            scenario = ScenarioSource(n_targets=args.targets, duration=args.duration, fps=args.fps,
+                                      noise=args.noise, seed=args.seed)
+            errors, jitter = run_trial(settings, scenario, latency, control_rate=args.control_rate,
+                                       command_latency=args.command_latency, controller_type=CONTROLLERS[name], **kwargs)
+            rows.append(summarize(name, latency, errors, jitter))
+            series.extend((name, latency, t, np.degrees(e)) for t, e in errors)
+
+    fields = list(rows[0].keys())
+    print(' '.join(f'{f:>16}' for f in fields))
+    for row in rows:
+        print(' '.join(f'{row[f]:>16.3f}' if isinstance(row[f], float) else f'{row[f] or "-":>16}' for f in fields))
+    if args.output:
+        with open(args.output, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['controller', 'latency_s', 'time_s', 'error_deg'])
+            writer.writerows(series)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+import numpy as np
+
+
+class ScenarioSource:
+    """
+    Synthetic stand-in for the camera and detector: people walking around in front
+    of the turret, observed as noisy 3D chest points.
+
+    Each target walks piecewise constant-velocity segments of `segment_time`
+    seconds, turning back towards the middle of `area` ((xmin, xmax), (zmin, zmax))
+    before it would leave it. Ground truth is analytic, so truth(t) is exact at any
+    time, which the test harness needs to score aiming at the control rate rather
+    than the frame rate. Detections are the truth plus Gaussian `noise`, each one
+    dropped with probability 1 - `detection_probability`, plus on average
+    `clutter_rate` false detections per frame.
+    """
+    def __init__(self, n_targets=3, duration=30.0, fps=30, noise=0.02, detection_probability=0.95,
+                 clutter_rate=0.0, area=((-3.0, 3.0), (1.0, 8.0)), max_speed=2.0, segment_time=1.5, seed=0):
+        self.n_targets = n_targets
+        self.duration = duration
+        self.fps = fps
+        self.noise = noise
+        self.detection_probability = detection_probability
+        self.clutter_rate = clutter_rate
+        self.area = np.asarray(area, dtype=np.float64)
+        self.segment_time = segment_time
+        self.rng = np.random.default_rng(seed)
+
+        n_segments = int(np.ceil(duration / segment_time)) + 1
+        low = np.array([self.area[0, 0], -0.5, self.area[1, 0]])
+        high = np.array([self.area[0, 1], 0.5, self.area[1, 1]])
+        center = (low + high) / 2
+        self._waypoints = np.empty((n_targets, n_segments + 1, 3))
+        self._velocities = np.zeros((n_targets, n_segments, 3))
+        self._waypoints[:, 0] = self.rng.uniform(low, high, (n_targets, 3))
+        for s in range(n_segments):
+            p = self._waypoints[:, s]
+            heading = self.rng.uniform(0, 2 * np.pi, n_targets)
+            speed = self.rng.uniform(0, max_speed, n_targets)
+            v = np.stack([np.cos(heading), np.zeros(n_targets), np.sin(heading)], axis=1) * speed[:, None]
+            end = p + v * segment_time
+            leaving = ((end < low) | (end > high)).any(axis=1)
+            to_center = (center - p) * np.array([1, 0, 1])
+            to_center /= np.maximum(np.linalg.norm(to_center, axis=1, keepdims=True), 1e-9)
+            v[leaving] = to_center[leaving] * speed[leaving, None]
+            self._velocities[:, s] = v
+            self._waypoints[:, s + 1] = p + v * segment_time
+
+    def truth(self, t):
+        """
+        Returns the true positions and velocities at time(s) `t`, each of shape
+        (n_targets, 3) for a scalar t or (n_targets, len(t), 3) for an array.
+        """
+        t = np.asarray(t, dtype=np.float64)
+        segment = np.clip((t // self.segment_time).astype(int), 0, self._velocities.shape[1] - 1)
+        offset = (t - segment * self.segment_time)[..., None]
+        velocities = self._velocities[:, segment]
+        return self._waypoints[:, segment] + velocities * offset, velocities
+
+    def detect(self, t):
+        """
+        Returns the (k, 3) detections of a frame captured at time `t`, in random order.
+        """
+        positions, _ = self.truth(t)
+        seen = self.rng.random(self.n_targets) < self.detection_probability
+        detections = positions[seen] + self.rng.normal(0, self.noise, (int(seen.sum()), 3))
+        n_clutter = self.rng.poisson(self.clutter_rate) if self.clutter_rate > 0 else 0
+        if n_clutter:
+            clutter = np.column_stack([self.rng.uniform(*self.area[0], n_clutter),
+                                       self.rng.uniform(-0.5, 0.5, n_clutter),
+                                       self.rng.uniform(*self.area[1], n_clutter)])
+            detections = np.vstack([detections, clutter])
+        return self.rng.permutation(detections)
+
+    def frames(self):
+        """
+        Yields (capture_time, detections) for every frame of the scenario.
+        """
+        for i in range(int(self.duration * self.fps)):
+            t = i / self.fps
+            yield t, self.detect(t)
+
+    def record(self, recorder):
+        """
+        Writes every frame's detections into an association.data_tools.TrajectoryRecorder,
+        with the ground truth as the reference tracks 'truth0', 'truth1', ...
+        """
+        uids = [f'truth{i}' for i in range(self.n_targets)]
+        for t, detections in self.frames():
+            positions, velocities = self.truth(t)
+            recorder.record(t, detections, uids, np.hstack([positions, velocities]))
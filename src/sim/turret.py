@@ -0,0 +1,112 @@
+import threading
+from collections import deque
+from time import perf_counter, sleep
+
+import numpy as np
+
+
+class SimulatedTurret(threading.Thread):
+    """
+    Pan/tilt turret simulated at a fixed control rate on its own thread.
+
+    Commands are absolute (pan, tilt) setpoints in radians that take effect
+    `latency` seconds after they are sent. Each axis then moves towards its
+    setpoint limited by `max_rate` (rad/s) and `max_acceleration` (rad/s^2),
+    decelerating in time to stop on it. Every control tick is logged into a
+    preallocated (time, pan, tilt) buffer so aiming error and loop jitter can be
+    measured afterwards.
+    """
+    def __init__(self, max_rate=(np.pi, np.pi / 2), max_acceleration=4 * np.pi, latency=0.0,
+                 control_rate=500, history=60000, clock=perf_counter):
+        super().__init__(daemon=True)
+        self.max_rate = np.broadcast_to(np.asarray(max_rate, dtype=np.float64), (2,)).copy()
+        self.max_acceleration = np.broadcast_to(np.asarray(max_acceleration, dtype=np.float64), (2,)).copy()
+        self.latency = latency
+        self.control_rate = control_rate
+        self.period = 1 / control_rate
+        self.clock = clock
+        self.angles = np.zeros(2)
+        self.rates = np.zeros(2)
+        self.setpoint = np.zeros(2)
+        self.stopped = threading.Event()
+        self.log = np.full((history, 3), np.nan)
+        self.n_logged = 0
+        self._commands = deque()
+
+    @classmethod
+    def from_config(cls, turret, control_rate=500, **kwargs):
+        """
+        Creates a turret from a CONFIG.TurretConfig; the slew limits there are in degrees.
+        """
+        return cls(max_rate=np.deg2rad((turret.pan_speed, turret.tilt_speed)),
+                   max_acceleration=np.deg2rad(turret.acceleration), control_rate=control_rate, **kwargs)
+
+    def command(self, pan, tilt, now=None):
+        """
+        Sends a new setpoint, applied `latency` seconds after `now`. Safe to call from any thread.
+        """
+        now = self.clock() if now is None else now
+        self._commands.append((now + self.latency, pan, tilt))
+
+    def get_angles(self):
+        return self.angles.copy()
+
+    def step(self, dt, now):
+        """
+        Advances the simulation by `dt` seconds, applying the commands due by `now`.
+        """
+        while self._commands and self._commands[0][0] <= now:
+            _, pan, tilt = self._commands.popleft()
+            self.setpoint[:] = (pan, tilt)
+        if dt <= 0:
+            return
+        error = self.setpoint - self.angles
+        # Fastest rate from which the axis can still stop on the setpoint
+        target_rate = np.sign(error) * np.minimum(self.max_rate, np.sqrt(2 * self.max_acceleration * np.abs(error)))
+        max_change = self.max_acceleration * dt
+        self.rates += np.clip(target_rate - self.rates, -max_change, max_change)
+        move = self.rates * dt
+        arrived = (np.abs(move) >= np.abs(error)) & (np.sign(move) == np.sign(error))
+        self.angles = np.where(arrived, self.setpoint, self.angles + move)
+        self.rates = np.where(arrived, error / dt, self.rates)
+
+    def run(self):
+        last = self.clock()
+        next_tick = last + self.period
+        while not self.stopped.is_set():
+            sleep(max(0.0, next_tick - self.clock()))
+            now = self.clock()
+            self.step(now - last, now)
+            last = now
+            if self.n_logged < len(self.log):
+                self.log[self.n_logged] = (now, self.angles[0], self.angles[1])
+                self.n_logged += 1
+            next_tick += self.period
+            # Don't try to catch up on ticks missed by a long stall
+            if next_tick < now:
+                next_tick = now + self.period
+
+    def stop(self):
+        self.stopped.set()
+
+    def get_log(self):
+        """
+        Returns the logged (time, pan, tilt) rows.
+        """
+        return self.log[:self.n_logged]
+
+    def jitter(self):
+        """
+        Control loop timing statistics in milliseconds: mean tick interval, its standard
+        deviation and the 99th percentile and max of the deviation from the nominal period.
+        """
+        intervals = np.diff(self.get_log()[:, 0])
+        if len(intervals) == 0:
+            return {'mean_ms': None, 'std_ms': None, 'p99_dev_ms': None, 'max_dev_ms': None}
+        deviation = np.abs(intervals - self.period)
+        return {
+            'mean_ms': intervals.mean() * 1e3,
+            'std_ms': intervals.std() * 1e3,
+            'p99_dev_ms': np.percentile(deviation, 99) * 1e3,
+            'max_dev_ms': deviation.max() * 1e3,
+        }
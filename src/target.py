@@ -1,8 +1,11 @@
 from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
 import numpy as np
-import uuid
-from filterpy.kalman import UnscentedKalmanFilter as UKF, MerweScaledSigmaPoints
 import copy
+from utils.rls import RLSPolyTracker
+
+if TYPE_CHECKING:
+    from filterpy.kalman import UnscentedKalmanFilter as UKF
 
 def fx(state, dt):
     x, y, z, vx, vy, vz = state
@@ -16,12 +19,24 @@ def hx(state):
 class Target:
     _positions: np.ndarray = field(default_factory=lambda: np.empty((0,3)))
     _timestamps: np.ndarray = field(default_factory=lambda: np.array([]))
-    _uid: str = field(default_factory=lambda: str(uuid.uuid4()))
+    # Integer track id from the TrackRegistry, -1 for a Target created outside of it
+    _uid: int = field(default=-1)
     _class: str = field(default_factory=lambda: str('Unknown'))
-    _ukf: UKF = field(init=False)
+    _ukf: 'UKF' = field(init=False)
     _future_prediction: np.ndarray = field(default_factory=lambda: np.empty((0,3))) # why haven't I used this? I don't know
     _n_missed_frames: int = field(default=0)
     _max_missed_frames: int = field(default=3)
+    _process_noise: float = field(default=.1)
+    _measurement_noise: float = field(default=.1**2)
+    _initial_covariance: float = field(default=.2)
+    _rls_degree: int = field(default=2)
+    _rls_forgetting: float = field(default=.9)
+    _rls: RLSPolyTracker = field(init=False)
+    # When False the state is filtered outside the Target (the batched IMM bank of the
+    # FrameHandler) and handed in with set_state; the Target only keeps the history
+    _ukf_enabled: bool = field(default=True)
+    # Positions kept for get_poly_predictions and checkpoints, older ones are dropped
+    _max_history: int = field(default=64)
 
     def __post_init__(self):
         if len(self._timestamps) != len(self._positions):
@@ -32,6 +47,47 @@ class Target:
         else:
             self._pos_initialized = True
         self.invalid_target = False
+        self._state = None
+        self._covariance = None
+        # Incremental polynomial fit alongside the UKF, for smooth derivatives (lead computation)
+        self._rls = RLSPolyTracker(degree=self._rls_degree, forgetting=self._rls_forgetting)
+        for i, pos in enumerate(self._positions):
+            self._rls.update(pos, self._timestamps[i] - self._timestamps[i-1] if i > 0 else 0)
+        self.set_history(self._positions, self._timestamps)
+
+    def set_history(self, positions, timestamps):
+        """
+        Replaces the position history, keeping the newest `_max_history` entries.
+
+        The history lives in buffers twice that size and _positions/_timestamps are
+        views of their newest part. Appending writes past the end and only when a
+        buffer is full is the last `_max_history` - 1 entries moved back to its start,
+        so appends cost O(1) amortized and a long-lived track never grows.
+        """
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)[-self._max_history:]
+        timestamps = np.asarray(timestamps, dtype=np.float64)[-self._max_history:]
+        self._position_buffer = np.empty((2 * self._max_history, 3))
+        self._timestamp_buffer = np.empty(2 * self._max_history)
+        n = len(positions)
+        self._position_buffer[:n] = positions
+        self._timestamp_buffer[:n] = timestamps
+        self._history_start, self._history_end = 0, n
+        self._positions = self._position_buffer[:n]
+        self._timestamps = self._timestamp_buffer[:n]
+
+    def _push_history(self, pos, timestamp):
+        end = self._history_end
+        if end == len(self._position_buffer):
+            keep = self._max_history - 1
+            self._position_buffer[:keep] = self._position_buffer[end - keep:end]
+            self._timestamp_buffer[:keep] = self._timestamp_buffer[end - keep:end]
+            end = keep
+        self._position_buffer[end] = pos
+        self._timestamp_buffer[end] = timestamp
+        self._history_end = end + 1
+        self._history_start = max(0, self._history_end - self._max_history)
+        self._positions = self._position_buffer[self._history_start:self._history_end]
+        self._timestamps = self._timestamp_buffer[self._history_start:self._history_end]
 
 
     def init_ukf(self, dt):
@@ -48,17 +104,36 @@ class Target:
         velocity = np.array([(x1-x0)/dt, (y1-y0)/dt, (z1-z0)/dt])
         x = np.concatenate((p1, velocity), axis=None)
 
-        self.points = MerweScaledSigmaPoints(n=6, alpha=.1, beta=2., kappa=0)
-        self._ukf = UKF(dim_x=6, dim_z=3, fx=fx, hx=hx, points=self.points, dt=dt)
+        self._make_ukf(dt)
         #self._ukf.x = np.array([0.,0.,0.,0.,0.,0.])
         self._ukf.x = x
-        self._ukf.P *= .2
-        self._ukf.R *= np.diag([.1**2, .1**2, .1**2])
-        self._ukf.Q = np.eye(6) * .1
+        self._ukf.P *= self._initial_covariance
 
         self.add_measurement(p2, dt)
         self._ukf_initialized = True
 
+    def _make_ukf(self, dt):
+        # filterpy is only needed once a track is confirmed, keep it off the import path
+        from filterpy.kalman import UnscentedKalmanFilter as UKF, MerweScaledSigmaPoints
+        self.points = MerweScaledSigmaPoints(n=6, alpha=.1, beta=2., kappa=0)
+        self._ukf = UKF(dim_x=6, dim_z=3, fx=fx, hx=hx, points=self.points, dt=dt)
+        self._ukf.R *= np.diag([self._measurement_noise] * 3)
+        self._ukf.Q = np.eye(6) * self._process_noise
+
+    def restore_filter(self, x, P, dt):
+        """
+        Resumes a filter saved from another Target (see utils.checkpoint), without
+        re-initialising it from the first two positions.
+        """
+        self._pos_initialized = True
+        if not self._ukf_enabled:
+            self.set_state(x, P)
+            return
+        self._make_ukf(dt)
+        self._ukf.x = np.array(x, dtype=np.float64)
+        self._ukf.P = np.array(P, dtype=np.float64)
+        self._ukf_initialized = True
+
     # This should ONLY be called by append, add_pos, OR if for some reason
     # you're manually changing _positions and _timestamps and need to call this after
     def add_measurement(self, measurement, dt):
@@ -66,6 +141,18 @@ class Target:
         self._ukf.predict()
         self._ukf.update(measurement)
 
+    def get_state(self):
+        """
+        Returns the filtered (6,) state and (6, 6) covariance.
+        """
+        if self._ukf_enabled:
+            return self._ukf.x, self._ukf.P
+        return self._state, self._covariance
+
+    def set_state(self, state, covariance):
+        self._state = state
+        self._covariance = covariance
+
     def get_prediction(self):
         state_copy = copy.deepcopy(self._ukf)
         state_copy.predict()
@@ -74,6 +161,13 @@ class Target:
     def get_pos(self):
         return self._positions
 
+    def get_derivatives(self, dt=0.0):
+        """
+        Returns the (position, velocity, acceleration) of the RLS polynomial fit,
+        `dt` seconds after the latest measurement.
+        """
+        return self._rls.get_state(dt)
+
     def get_times(self):
         return self._timestamps
 
@@ -97,15 +191,17 @@ class Target:
             if not isinstance(dt, (int, float)):
                 raise ValueError("dt must be a numerical value (int or float)")
             if len(pos) == 3:
-                parr = np.array([pos])
-                self._positions = np.vstack([self._positions, parr])
+                parr = np.array([pos], dtype=np.float64)
+                self._rls.update(parr[0], dt)
 
                 if len(self._timestamps) == 0:
-                    self._timestamps = np.append(self._timestamps, dt) # dt in this case SHOULD be 0
+                    self._push_history(parr[0], dt) # dt in this case SHOULD be 0
                 else:
-                    self._timestamps = np.append(self._timestamps, self._timestamps[-1] + dt)
+                    self._push_history(parr[0], self._timestamps[-1] + dt)
 
-                if self._pos_initialized == True:
+                if not self._ukf_enabled:
+                    self._pos_initialized = True
+                elif self._pos_initialized == True:
                     """
                     x1,y1,z1 = pos
                     x0,y0,z0 = self._positions[-1]
@@ -132,10 +228,9 @@ class Target:
             raise ValueError("Index must be of type int")
         if index < 0 or index >= len(self._positions):
             raise IndexError("Index out of range")
-        pos_pop = self._positions(index)
-        time_pop = self._timestamps(index)
-        self._positions = np.delete(self._positions, index, axis=0)
-        self._timestamps = np.delete(self._timestamps, index)
+        pos_pop = self._positions[index]
+        time_pop = self._timestamps[index]
+        self.set_history(np.delete(self._positions, index, axis=0), np.delete(self._timestamps, index))
 
     def __eq__(self, other):
         return isinstance(other, Target) and self._uid == other._uid
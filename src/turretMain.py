@@ -1,32 +1,42 @@
+import argparse
+import asyncio
+from time import time
 import cv2
 #from realsense_depth import *
 #from camera_view import *
 from viewer.camera_view import *
 from viewer.simulation_view import *
+from viewer.observer import FrameObserver
 import utils.position_calc as pc
-import utils.depthai_depth as dd
+from utils import cameras
+from utils import depthEstimation as de
+from utils import metrics
+from utils.depth_filter import DepthPostProcessor
+from association.data_tools import TrajectoryRecorder
+from frame_handler import FrameHandler
+from utils.runtime import TrackingRuntime, serve_tracks
+from utils.track_publisher import SharedTrackPublisher, serve_binary
+from utils import checkpoint
 import CONFIG
 
-# Prepare CONFIG for use across all other modules
-CONFIG.setup_config()
-conf = CONFIG.config
 
-#CAP_RES = (1280, 720)
-CAP_RESOLUTION = (conf['Camera']['width'], conf['Camera']['height'])
-CAP_RGB_FR = conf['Camera']['rgb_framerate']
-CAP_STEREO_FR = conf['Camera']['stereo_framerate']
-SIM_RESOLUTION = (conf['Simulation']['width'], conf['Simulation']['height'])
+def parse_args():
+    parser = argparse.ArgumentParser(description='Prospiq turret tracking loop')
+    parser.add_argument('--headless', action='store_true',
+                        help='disable annotation, display windows and console output')
+    CONFIG.add_config_arguments(parser)
+    return parser.parse_args()
 
 
-if __name__ == '__main__':
-    cap = dd.OakDepthCam(CAP_RESOLUTION, colorFps=CAP_RGB_FR, stereoFps=CAP_STEREO_FR)
-    detector = PersonDetector(cap, device=conf['YOLO']['Architecture'])
-    simulator = TargetViewer(SIM_RESOLUTION)
-    mtde = pc.MultiTargetDepthEstimator(5)
-    while True:
-        start_time = time()
-
-        detector.update()
+def estimate_positions(detector, mtde, settings, show_output):
+    """
+    Depths, heights, centers and 3D positions of the people in the detector's current frame.
+    """
+    if settings.depth.skeleton:
+        skeletons = detector.getSkeletons(settings.depth.patch_radius)
+        new_depths, heights, centers = detector.getDHCFromSkeletons(skeletons)
+        positions = list(skeletons.centroids[skeletons.has_centroid])
+    else:
         # depths will be an array of depths at time t for n targets (depths[n] = depth of target n)
         # heights will be an array of heights at time t for n targets (heights[n] = height of target n)
         # centers will be an array of center points at time t for n targets (centers[n] = center of target n)
@@ -34,27 +44,198 @@ if __name__ == '__main__':
 
         # Get real depths of targets
         new_depths = []
-        if (len(mtde.position_calcs) != len(depths)):
+        if (len(mtde) != len(depths)):
             mtde.clear_all_targets()
-        print("depths: ", depths)
-        print("heights: ", heights)
-        mtde.add_depth_points(heights, depths)
-        real_depths = mtde.get_real_depths()
+        if show_output:
+            print("depths: ", depths)
+            print("heights: ", heights)
+        with metrics.stage('depth_estimation'):
+            mtde.add_depth_points(heights, depths)
+            real_depths = mtde.get_real_depths()
         for depth, real_depth in zip(depths, real_depths):
             if real_depth is not None:
                 new_depths.append(real_depth)
             else:
                 new_depths.append(depth)
-    
-        # Get the final frame from the camera
+
         # Get the positions of the targets in 3D space
         positions = detector.getTargetPositions(new_depths, centers)
-        simulator.clearPositions()
-        for position in positions:
-            simulator.addPosition(position)
-        simulator_view = simulator.draw()
-        camera_frame = detector.getFinalFrame(new_depths, heights, centers, start_time)
-        cv2.imshow("Camera", camera_frame)
-        cv2.imshow("Simulation", simulator_view)
-        if cv2.waitKey(1) == ord('q'):
-        break
+    return new_depths, heights, centers, positions
+
+
+def checkpoint_depth(checkpointer, mtde):
+    if checkpointer is not None and checkpointer.due('depth'):
+        checkpointer.submit('depth', checkpoint.capture_depth_model(mtde.model))
+
+
+def run_async(settings, detector, mtde, show_output, recorder, observer, checkpointer=None, restored=None):
+    """
+    Runs the vision loop on the asyncio runtime with a tracker, whose tracks go to
+    the TCP streams and shared memory table set up in [Runtime]. Rendering needs the
+    observer thread. The tracks in the `restored` checkpoint are picked up where they
+    were left, and new checkpoints go to `checkpointer`.
+    """
+    runtime = None
+
+    def infer(captured):
+        start_time = time()
+        detector.infer(*captured)
+        new_depths, heights, centers, positions = estimate_positions(detector, mtde, settings, show_output)
+        checkpoint_depth(checkpointer, mtde)
+        if observer is not None:
+            observer.publish(detector.frame, new_depths, heights, centers, positions, start_time, time())
+        return positions
+
+    async def record():
+        with runtime.hub.subscribe(settings.recording.queue_size) as snapshots:
+            async for snapshot in snapshots:
+                recorder.record(snapshot.stamp, snapshot.positions, snapshot.uids, snapshot.states)
+
+    async def publish_shared():
+        with runtime.hub.subscribe() as snapshots:
+            async for snapshot in snapshots:
+                publisher.publish_snapshot(snapshot)
+
+    async def checkpoint_tracks():
+        with runtime.hub.subscribe() as snapshots:
+            async for _ in snapshots:
+                if checkpointer.due('tracker'):
+                    checkpointer.submit('tracker', checkpoint.capture_tracker(runtime.handler, runtime.last_stamp))
+
+    async def watch_observer():
+        while not observer.stopped.is_set():
+            await asyncio.sleep(0.1)
+        runtime.stop()
+
+    handler = FrameHandler.from_config(settings.tracker)
+    runtime = TrackingRuntime(detector.capture, infer, handler)
+    now = time()
+    if restored is not None and checkpoint.restore_tracker(handler, restored, now, settings.checkpoint.max_age):
+        # Filters were predicted up to now, the first frame continues from there
+        runtime.last_stamp = now
+    if checkpointer is not None:
+        runtime.spawn(checkpoint_tracks())
+    if settings.runtime.stream_port > 0:
+        runtime.spawn(serve_tracks(runtime.hub, settings.runtime.stream_host, settings.runtime.stream_port,
+                                   settings.runtime.stream_queue), drain=False)
+    if settings.runtime.binary_port > 0:
+        runtime.spawn(serve_binary(runtime.hub, settings.runtime.stream_host, settings.runtime.binary_port,
+                                   settings.runtime.stream_queue), drain=False)
+    publisher = None
+    if settings.runtime.shared_memory:
+        publisher = SharedTrackPublisher(settings.runtime.shared_memory, settings.runtime.shared_capacity)
+        runtime.spawn(publish_shared())
+    if recorder is not None:
+        runtime.spawn(record())
+    if observer is not None:
+        runtime.spawn(watch_observer(), drain=False)
+    try:
+        asyncio.run(runtime.run())
+    finally:
+        if publisher is not None:
+            publisher.close()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    # Prepare CONFIG for use across all other modules
+    settings = CONFIG.setup_from_args(args)
+    de.configure(settings)
+
+    headless = args.headless or settings.debug.headless
+    show_video = not headless
+    show_output = not headless and settings.debug.show_output
+    render_rate = settings.debug.render_rate
+
+    metrics.METRICS.enabled = settings.metrics.enabled
+    reporter = None
+    if settings.metrics.enabled and settings.metrics.dump_path:
+        reporter = metrics.MetricsReporter(settings.metrics.dump_path, settings.metrics.dump_interval)
+        reporter.start()
+    if settings.metrics.enabled and settings.metrics.http_port > 0:
+        metrics.serve_http(settings.metrics.http_port)
+
+    recorder = None
+    if settings.recording.path:
+        recorder = TrajectoryRecorder(settings.recording.path, chunk_rows=settings.recording.chunk_rows,
+                                      queue_size=settings.recording.queue_size)
+
+    cap = cameras.open_from_config(settings)
+    model = settings.model
+    depthFilter = DepthPostProcessor.from_config(settings.depth) if settings.depth.filter else None
+    detector = PersonDetector(cap, device=model.architecture, weights=model.weights, confidence=model.confidence,
+                              max_det=model.max_detections, keypoint_threshold=model.keypoint_threshold,
+                              depthFilter=depthFilter)
+    mtde = pc.MultiTargetDepthEstimator.from_config(settings.depth, verbose=show_output,
+                                                    max_targets=model.max_detections)
+
+    checkpointer = None
+    restored = None
+    if settings.checkpoint.path:
+        restored = checkpoint.load_checkpoint(settings.checkpoint.path)
+        if restored is not None:
+            checkpoint.restore_depth_model(mtde.model, restored)
+        checkpointer = checkpoint.Checkpointer(settings.checkpoint.path, settings.checkpoint.interval)
+
+    simulator = None
+    observer = None
+    if show_video:
+        simulator = TargetViewer(settings.simulation.resolution, trailLength=settings.simulation.trail_length)
+        if settings.runtime.asyncio and render_rate <= 0:
+            # The event loop owns the main thread, so windows are drawn by the observer
+            render_rate = 15
+        if render_rate > 0:
+            observer = FrameObserver(detector, simulator, rate=render_rate)
+            observer.start()
+
+    try:
+        if settings.runtime.asyncio:
+            run_async(settings, detector, mtde, show_output, recorder, observer, checkpointer, restored)
+        else:
+            # Only the recording needs tracks here, as the reference association.retrack scores against
+            recordHandler = FrameHandler.from_config(settings.tracker) if recorder is not None else None
+            lastTime = None
+            while True:
+                start_time = time()
+
+                detector.update()
+                new_depths, heights, centers, positions = estimate_positions(detector, mtde, settings, show_output)
+                checkpoint_depth(checkpointer, mtde)
+                if recorder is not None:
+                    with metrics.stage('tracking'):
+                        recordHandler.add_frame(positions, dt=None if lastTime is None else start_time - lastTime)
+                        recordHandler.associate_real_targets()
+                        recordHandler.associate_potential_targets()
+                        uids, states, _ = recordHandler.get_track_states()
+                    lastTime = start_time
+                    recorder.record(start_time, positions, uids, states)
+
+                if not show_video:
+                    continue
+                if observer is not None:
+                    # Rendering happens on the observer thread from this snapshot
+                    observer.publish(detector.frame, new_depths, heights, centers, positions, start_time, time())
+                    if observer.stopped.is_set():
+                        break
+                    continue
+
+                # Get the final frame from the camera
+                with metrics.stage('render'):
+                    simulator.setPositions(positions)
+                    simulator_view = simulator.draw()
+                    camera_frame = detector.getFinalFrame(new_depths, heights, centers, start_time)
+                    cv2.imshow("Camera", camera_frame)
+                    cv2.imshow("Simulation", simulator_view)
+                if cv2.waitKey(1) == ord('q'):
+                    break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if observer is not None:
+            observer.stop()
+        if reporter is not None:
+            reporter.stop()
+        if recorder is not None:
+            recorder.close()
+        if checkpointer is not None:
+            checkpointer.close()
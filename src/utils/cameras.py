@@ -0,0 +1,30 @@
+"""
+cameras.py
+Factory for the camera backends. Each backend's SDK (depthai, pyrealsense2) is
+only imported when that backend is opened, so code that never touches a camera
+does not need the hardware SDKs installed.
+"""
+
+
+def open_camera(backend, resolution, color_fps=30, depth_fps=30, queue_size=4):
+    """
+    Opens the camera `backend` ('oak' or 'realsense'). Every backend exposes
+    get_frame() -> (ret, infrared, depth, color), get3d(x, y, depth) and the
+    colorRes/depthRes attributes used by PersonDetector.
+    """
+    if backend == 'oak':
+        from utils.depthai_depth import OakDepthCam
+        return OakDepthCam(resolution, colorFps=color_fps, depthFps=depth_fps, queueSize=queue_size)
+    if backend == 'realsense':
+        from realsense_depth import DepthCamera
+        return DepthCamera(resolution, color_fps, depth_fps)
+    raise ValueError(f"Unknown camera backend '{backend}'")
+
+
+def open_from_config(settings):
+    """
+    Opens the camera described by a CONFIG.Settings.
+    """
+    camera = settings.camera
+    return open_camera(camera.backend, camera.resolution, color_fps=camera.rgb_framerate,
+                       depth_fps=camera.stereo_framerate, queue_size=settings.pipeline.queue_size)
@@ -0,0 +1,231 @@
+"""
+checkpoint.py
+Periodic snapshots of the tracker and depth calibration, for warm restarts.
+
+The full tracker state (the TrackRegistry columns, the IMM bank or every real
+target's UKF, each target's RLS fit and recent positions) and the
+HeightDepthModel sample buffers are flattened into plain numpy arrays. Taking a snapshot is only a handful of array
+copies on the thread that owns the state; a Checkpointer thread merges the
+newest snapshot of every section and writes them as one .npz file, through a
+temporary file and os.replace so a crash mid-write never leaves a truncated
+checkpoint behind.
+
+On startup load_checkpoint reads the file back, restore_tracker rebuilds the
+tracks and runs every filter forward over the time the process was down (unless
+that was too long for the tracks to still mean anything), and
+restore_depth_model puts the calibration samples and fits back, so the turret
+neither waits `min_frames` to re-confirm its targets nor re-learns depth.
+"""
+import os
+import threading
+from time import time
+
+import numpy as np
+
+from frame_handler import TrackRegistry
+
+CHECKPOINT_VERSION = 1
+
+
+def capture_tracker(handler, stamp, history=32):
+    """
+    Copies the state of a FrameHandler at time `stamp` into a dict of arrays. Up to
+    `history` recent positions of each real target are kept.
+    """
+    registry = handler.registry
+    slots = registry.confirmed_slots()
+    targets = [registry.targets[slot] for slot in slots]
+    n = len(targets)
+    positions = np.zeros((n, history, 3))
+    timestamps = np.zeros((n, history))
+    counts = np.zeros(n, dtype=np.int64)
+    for i, target in enumerate(targets):
+        recent = target._positions[-history:]
+        counts[i] = len(recent)
+        positions[i, :counts[i]] = recent
+        timestamps[i, :counts[i]] = target._timestamps[-history:]
+    degree = targets[0]._rls.degree if n else handler.rls_degree
+    arrays = {
+        'tracker.version': np.array(CHECKPOINT_VERSION),
+        'tracker.stamp': np.array(stamp, dtype=np.float64),
+        'tracker.next_id': np.array(registry._next_id),
+        'tracker.ids': registry.ids.copy(),
+        'tracker.active': registry.active.copy(),
+        'tracker.confirmed': registry.confirmed.copy(),
+        'tracker.hits': registry.hits.copy(),
+        'tracker.missed': registry.missed.copy(),
+        'tracker.positions': registry.positions.copy(),
+        'tracker.states': registry.states.copy(),
+        'tracker.covariances': registry.covariances.copy(),
+        'tracker.slots': slots,
+        # 0 for targets filtered by the handler's IMM bank, which have no UKF
+        'tracker.ukf_dt': np.array([target._ukf._dt if target._ukf_enabled else 0.0 for target in targets],
+                                   dtype=np.float64),
+        'tracker.rls_theta': np.array([target._rls.theta for target in targets]).reshape(n, degree + 1, 3),
+        'tracker.rls_P': np.array([target._rls.P for target in targets]).reshape(n, degree + 1, degree + 1),
+        'tracker.rls_t': np.array([target._rls.t for target in targets], dtype=np.float64),
+        'tracker.rls_updates': np.array([target._rls.n_updates for target in targets], dtype=np.int64),
+        'tracker.history_positions': positions,
+        'tracker.history_timestamps': timestamps,
+        'tracker.history_counts': counts,
+    }
+    if handler.imm is not None:
+        capacity = registry.capacity
+        arrays['tracker.imm_x'] = handler.imm.x[:capacity].copy()
+        arrays['tracker.imm_P'] = handler.imm.P[:capacity].copy()
+        arrays['tracker.imm_mu'] = handler.imm.mu[:capacity].copy()
+    return arrays
+
+
+def restore_tracker(handler, arrays, now=None, max_age=None):
+    """
+    Replaces the tracks of `handler` with the ones captured in `arrays`, with every
+    filter predicted forward to `now` (default: the current time). Returns False,
+    leaving the handler untouched, if the checkpoint holds no tracker, does not fit
+    the handler's settings or its tracks are more than `max_age` seconds old.
+    """
+    if 'tracker.version' not in arrays or int(arrays['tracker.version']) != CHECKPOINT_VERSION:
+        return False
+    if arrays['tracker.positions'].shape[1] != handler.min_frames:
+        return False
+    elapsed = max(0.0, (time() if now is None else now) - float(arrays['tracker.stamp']))
+    if max_age is not None and elapsed > max_age:
+        return False
+
+    registry = TrackRegistry(history=handler.min_frames, capacity=len(arrays['tracker.ids']))
+    for name in ('ids', 'active', 'confirmed', 'hits', 'missed', 'positions', 'states', 'covariances'):
+        getattr(registry, name)[...] = arrays['tracker.' + name]
+    registry._next_id = int(arrays['tracker.next_id'])
+    registry._free = [slot for slot in range(registry.capacity - 1, -1, -1) if not registry.active[slot]]
+
+    slots = arrays['tracker.slots']
+    if handler.imm is not None:
+        _restore_imm(handler.imm, registry, arrays, slots, elapsed)
+
+    theta, P = arrays['tracker.rls_theta'], arrays['tracker.rls_P']
+    for i, slot in enumerate(slots):
+        target = handler.make_target(int(registry.ids[slot]))
+        count = arrays['tracker.history_counts'][i]
+        target.set_history(arrays['tracker.history_positions'][i, :count],
+                           arrays['tracker.history_timestamps'][i, :count])
+        # Tracks saved from an IMM bank have no UKF step, start one at the nominal frame rate
+        dt = float(arrays['tracker.ukf_dt'][i]) or handler.frame_dt or 1 / 30
+        target.restore_filter(registry.states[slot], registry.covariances[slot], dt)
+        if elapsed > 0 and handler.imm is None:
+            target._ukf.predict(dt=elapsed)
+        # A fit of another degree can't be carried over, it restarts from the next measurement
+        if theta.shape[1] == target._rls.degree + 1:
+            target._rls.theta = theta[i].copy()
+            target._rls.P = P[i].copy()
+            target._rls.t = float(arrays['tracker.rls_t'][i]) + elapsed
+            target._rls.n_updates = int(arrays['tracker.rls_updates'][i])
+        registry.targets[slot] = target
+        registry.store_state(slot)
+    handler.registry = registry
+    return True
+
+
+def _restore_imm(bank, registry, arrays, slots, elapsed):
+    # The bank is indexed by registry slot, like the registry columns restored with it
+    bank.grow(registry.capacity)
+    if 'tracker.imm_x' in arrays and arrays['tracker.imm_x'].shape[1:] == bank.x.shape[1:]:
+        count = len(arrays['tracker.imm_x'])
+        bank.x[:count] = arrays['tracker.imm_x']
+        bank.P[:count] = arrays['tracker.imm_P']
+        bank.mu[:count] = arrays['tracker.imm_mu']
+    else:
+        # Saved from per-target UKFs: start the bank from their states
+        bank.start(slots, registry.states[slots, :3], registry.states[slots, 3:])
+    bank.predict(slots, elapsed)
+    registry.states[slots], registry.covariances[slots] = bank.combined(slots)
+
+
+def capture_depth_model(model):
+    """
+    Copies the samples and fits of a depthEstimation.HeightDepthModel into a dict of arrays.
+    """
+    return {'depth.' + name: getattr(model, name).copy()
+            for name in ('inv_heights', 'depths', 'counts', 'params', 'scales')}
+
+
+def restore_depth_model(model, arrays):
+    """
+    Puts captured samples and fits back into `model`. Returns False if the checkpoint
+    has none or was taken with a different model size.
+    """
+    if 'depth.depths' not in arrays or arrays['depth.depths'].shape != model.depths.shape:
+        return False
+    for name in ('inv_heights', 'depths', 'counts', 'params', 'scales'):
+        getattr(model, name)[...] = arrays['depth.' + name]
+    return True
+
+
+def load_checkpoint(path):
+    """
+    Reads a checkpoint written by Checkpointer into a dict of arrays, or returns None
+    if there is none or it can't be read.
+    """
+    try:
+        with np.load(path) as data:
+            return {name: data[name] for name in data.files}
+    except (OSError, ValueError):
+        return None
+
+
+class Checkpointer(threading.Thread):
+    """
+    Writes the newest submitted snapshot of every section to `path` every `interval`
+    seconds, atomically, and once more on close.
+
+    Producers call `due(section)` first and only capture and `submit` a snapshot when it
+    returns True, so the capture cost is paid once per interval rather than every frame.
+    Sections are submitted from whichever thread owns their state.
+    """
+    def __init__(self, path, interval=1.0):
+        super().__init__(daemon=True)
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.interval = interval
+        self.writes = 0
+        self._sections = {}
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self.start()
+
+    def due(self, section):
+        with self._lock:
+            return section not in self._pending
+
+    def submit(self, section, arrays):
+        """
+        Hands over the arrays of `section`, which the caller must not modify afterwards.
+        """
+        with self._lock:
+            self._sections[section] = arrays
+            self._pending.add(section)
+
+    def _write(self):
+        with self._lock:
+            if not self._pending:
+                return
+            arrays = {name: value for section in self._sections.values() for name, value in section.items()}
+            self._pending.clear()
+        arrays['stamp'] = np.array(time())
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.writes += 1
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self._write()
+
+    def close(self):
+        self._stopped.set()
+        self.join()
+        self._write()
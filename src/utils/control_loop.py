@@ -0,0 +1,153 @@
+"""
+control_loop.py
+Fixed-rate turret control decoupled from the camera frame rate.
+
+The vision loop publishes the latest committed track states into a
+SnapshotBuffer after every frame. A ControlLoop thread reads the newest
+snapshot at its own rate (typically 200-500 Hz), extrapolates the engaged
+track from its measurement timestamp to "now" with the published velocity, and
+sends latency-compensated aim commands to the actuator. Slow or uneven vision
+frames then only reduce the accuracy of the extrapolation, never the command
+rate.
+"""
+import threading
+from time import perf_counter, sleep
+
+import numpy as np
+
+from utils import metrics
+from utils.intercept import solve_intercept
+
+
+class _Slot:
+    __slots__ = ('states', 'uids', 'count', 'stamp', 'selected', 'version')
+
+    def __init__(self, capacity):
+        self.states = np.zeros((capacity, 6))
+        self.uids = [None] * capacity
+        self.count = 0
+        self.stamp = 0.0
+        self.selected = None
+        self.version = 0
+
+
+class SnapshotBuffer:
+    """
+    Double-buffered track snapshot for one writer and any number of readers.
+
+    The writer fills the back slot's preallocated arrays and then flips which slot
+    is in front, so publishing never allocates or blocks. Each slot carries a
+    version that is odd while it is being written; readers copy out of the front
+    slot and retry if the version changed underneath them, which only happens when
+    the writer laps a reader twice.
+    """
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self._slots = (_Slot(capacity), _Slot(capacity))
+        self._front = 0
+
+    def publish(self, uids, states, stamp, selected=None):
+        """
+        Publishes the (n, 6) `states` of tracks `uids` measured at time `stamp`.
+        `selected` is the uid the turret should engage, if any.
+        """
+        n = min(len(uids), self.capacity)
+        slot = self._slots[1 - self._front]
+        slot.version += 1
+        slot.states[:n] = states[:n]
+        slot.uids[:n] = uids[:n]
+        slot.count = n
+        slot.stamp = stamp
+        slot.selected = selected
+        slot.version += 1
+        self._front = 1 - self._front
+
+    def read(self, out=None):
+        """
+        Returns (uids, states, stamp, selected) of the newest consistent snapshot.
+        `out` may be a preallocated (capacity, 6) array to copy the states into.
+        """
+        if out is None:
+            out = np.empty((self.capacity, 6))
+        while True:
+            slot = self._slots[self._front]
+            version = slot.version
+            if version % 2:
+                # The writer is mid-publish, let it run
+                sleep(0)
+                continue
+            n = slot.count
+            out[:n] = slot.states[:n]
+            uids = slot.uids[:n]
+            stamp = slot.stamp
+            selected = slot.selected
+            if slot.version == version:
+                return uids, out[:n], stamp, selected
+
+
+class ControlLoop(threading.Thread):
+    """
+    Commands `actuator` (anything with command(pan, tilt, now)) at `rate` Hz from the
+    newest snapshot in `buffer`. The selected track is extrapolated with constant
+    velocity from its measurement stamp to the current time plus `command_latency`
+    before the intercept is solved, so publish the short-window RLS velocity
+    (FrameHandler.get_track_velocities) rather than the UKF's, which lags turns by
+    a second or more. Snapshots older than `max_age` seconds are ignored so a
+    stalled vision pipeline doesn't send the turret chasing a stale extrapolation.
+    """
+    def __init__(self, buffer, actuator, rate=250, projectile_speed=30.0, gravity=0.0, command_latency=0.0,
+                 max_age=0.5, clock=perf_counter, history=0):
+        super().__init__(daemon=True)
+        self.buffer = buffer
+        self.actuator = actuator
+        self.rate = rate
+        self.period = 1 / rate
+        self.projectile_speed = projectile_speed
+        self.gravity = gravity
+        self.command_latency = command_latency
+        self.max_age = max_age
+        self.clock = clock
+        self.stopped = threading.Event()
+        self.tick_times = np.full(history, np.nan)
+        self.n_ticks = 0
+        self._states = np.empty((buffer.capacity, 6))
+
+    @classmethod
+    def from_config(cls, buffer, actuator, turret, rate=250, **kwargs):
+        """
+        Creates a control loop from a CONFIG.TurretConfig.
+        """
+        return cls(buffer, actuator, rate=rate, projectile_speed=turret.projectile_speed,
+                   gravity=turret.gravity, command_latency=turret.latency, **kwargs)
+
+    def tick(self, now):
+        uids, states, stamp, selected = self.buffer.read(self._states)
+        if selected is None or selected not in uids:
+            return False
+        age = now - stamp
+        if age > self.max_age:
+            return False
+        state = states[uids.index(selected)]
+        solution = solve_intercept(state[None], projectile_speed=self.projectile_speed,
+                                   gravity=self.gravity, latency=age + self.command_latency)
+        if not solution.valid[0]:
+            return False
+        self.actuator.command(solution.pan[0], solution.tilt[0], now)
+        return True
+
+    def run(self):
+        next_tick = self.clock()
+        while not self.stopped.is_set():
+            sleep(max(0.0, next_tick - self.clock()))
+            now = self.clock()
+            with metrics.stage('control'):
+                self.tick(now)
+            if self.n_ticks < len(self.tick_times):
+                self.tick_times[self.n_ticks] = now
+                self.n_ticks += 1
+            next_tick += self.period
+            if next_tick < now:
+                next_tick = now + self.period
+
+    def stop(self):
+        self.stopped.set()
@@ -1,15 +1,8 @@
 import numpy as np
 
-pixel_heights = []
-depth_points = []
 
-MAX_K_SIZE = 100
-k_final = []
-
-
-## TODO: Initialize these constants with either CONFIG.py or via cmd line options
-
-# Constants for the camera. We're using an OAK-D Lite(s) for the project
+# Constants for the camera. We're using an OAK-D Lite(s) for the project.
+# These are the defaults, configure() replaces them with the values from CONFIG.
 #
 # The FOV is in degrees converted to radians - works better with numpy
 CAMERA_DFOV = np.deg2rad(86)
@@ -23,46 +16,189 @@ CAMERA_DISTANCE = 150
 CAMERA_WIDTH = 480
 
 
-def estimate(pixel_h, depth_c):
+def configure(settings):
     """
-    Estimates a new value for k_final and appends it
-    to the current k_final list. Will maintain MAX_K_SIZE
-    and remove the oldest value in k_final if the size of k_final
-    is MAX_K_SIZE.
+    Loads the camera constants from a CONFIG.Settings.
+    Note that stereo_depth then uses the configured Camera.Width and Camera.Distance
+    (640 px and 100 mm in config.ini) instead of the 480 px and 150 mm defaults above.
     """
-    global k_final
-    k = []
-    for height, depth in zip(pixel_h, depth_c):
-        k.append(height*depth)
-    k_avg = np.mean(k)
-    k_final.append(k_avg)
-    if len(k_final) > MAX_K_SIZE:
-        k_final.pop(0)
-    return 
-
-
-def get_real_depth(pixel_h, depth_c, resolution=0.1):
+    global CAMERA_DFOV, CAMERA_HFOV, CAMERA_VFOV, CAMERA_DISTANCE, CAMERA_WIDTH
+    CAMERA_DFOV = np.deg2rad(settings.camera.dfov)
+    CAMERA_HFOV = np.deg2rad(settings.camera.hfov)
+    CAMERA_VFOV = np.deg2rad(settings.camera.vfov)
+    CAMERA_DISTANCE = settings.camera.distance
+    CAMERA_WIDTH = settings.camera.width
+
+
+class HeightDepthModel:
     """
-    This gets the depth of an object with an error within the value
-    of resolution. Using the values in k_final, it calculates the depth
-    of an object and returns a number for distance.
+    Per-target monocular depth models, depth ~ k / pixel_height + bias, for when the
+    stereo depth is missing or out of range.
+
+    Every target has a ring buffer of `capacity` (chest pixel height, sensor depth)
+    pairs; one extra row pools the samples of all targets and survives `clear`, so
+    a new target is covered by the pooled model until it has `min_samples` of its
+    own. All rows are fitted together by iteratively reweighted least squares with
+    Huber weights (`huber` robust standard deviations), so a few bad depth samples
+    don't bend the fit, and prediction is one vectorized expression.
     """
-    global k_final
-    if np.std(depth_c) < resolution:
-        estimate(pixel_h, depth_c)
-        return depth_c[-1]
-    elif len(k_final) != 0:
-        depths = []
-        k = np.mean(k_final)
-        for h in pixel_h:
-            depths.append(k/h)
-        if np.std(depths) < resolution:
-            return np.mean(depths)
-        else:
-            return None
-    else:
-        return None
+    def __init__(self, max_targets=16, capacity=100, min_samples=5, huber=1.345, iterations=5,
+                 min_scale=10.0, bias_ridge=1e-3):
+        self.max_targets = max_targets
+        self.capacity = capacity
+        self.min_samples = min_samples
+        self.huber = huber
+        self.iterations = iterations
+        # Floor of the residual scale, in depth units, so perfect fits keep sane weights
+        self.min_scale = min_scale
+        self.bias_ridge = bias_ridge
+        rows = max_targets + 1
+        self.inv_heights = np.zeros((rows, capacity))
+        self.depths = np.zeros((rows, capacity))
+        self.counts = np.zeros(rows, dtype=np.int64)
+        self.params = np.full((rows, 2), np.nan)
+        self.scales = np.full(rows, np.nan)
+        self._dirty = False
+
+    @property
+    def pooled(self):
+        return self.max_targets
+
+    def clear(self, targets=None):
+        """
+        Forgets the samples of `targets` (default: all targets, but not the pooled row).
+        """
+        targets = np.arange(self.max_targets) if targets is None else np.asarray(targets)
+        self.counts[targets] = 0
+        self.params[targets] = np.nan
+        self.scales[targets] = np.nan
+
+    def add(self, targets, heights, depths):
+        """
+        Adds one (height, depth) sample for each of `targets`. Samples without a
+        positive height and depth are ignored.
+        """
+        targets = np.asarray(targets, dtype=np.int64)
+        heights = np.asarray(heights, dtype=np.float64)
+        depths = np.asarray(depths, dtype=np.float64)
+        ok = (heights > 0) & (depths > 0) & np.isfinite(heights) & np.isfinite(depths)
+        targets, heights, depths = targets[ok], heights[ok], depths[ok]
+        if len(targets) == 0:
+            return
+        rows = np.concatenate([targets, np.full(len(targets), self.pooled)])
+        # The pooled row takes several samples per frame, give each its own position
+        offsets = np.concatenate([np.zeros(len(targets), dtype=np.int64), np.arange(len(targets))])
+        columns = (self.counts[rows] + offsets) % self.capacity
+        self.inv_heights[rows, columns] = np.tile(1 / heights, 2)
+        self.depths[rows, columns] = np.tile(depths, 2)
+        np.add.at(self.counts, rows, 1)
+        self._dirty = True
+
+    def fit(self):
+        """
+        Refits every row with enough samples. Called lazily by predict.
+        """
+        self._dirty = False
+        used = np.minimum(self.counts, self.capacity)
+        rows = np.flatnonzero(used >= self.min_samples)
+        self.params[:] = np.nan
+        self.scales[:] = np.nan
+        if len(rows) == 0:
+            return
+        mask = np.arange(self.capacity) < used[rows, None]
+        x, y = self.inv_heights[rows], self.depths[rows]
+        weights = mask.astype(np.float64)
+        for _ in range(self.iterations + 1):
+            sw = weights.sum(axis=1)
+            sx = (weights * x).sum(axis=1)
+            sxx = (weights * x * x).sum(axis=1)
+            sy = (weights * y).sum(axis=1)
+            sxy = (weights * x * y).sum(axis=1)
+            # A small ridge on the bias keeps the fit k / h when the heights barely vary
+            sb = sw * (1 + self.bias_ridge)
+            det = sxx * sb - sx * sx
+            with np.errstate(divide='ignore', invalid='ignore'):
+                k = (sxy * sb - sx * sy) / det
+                b = (sxx * sy - sx * sxy) / det
+                residuals = np.abs(y - (k[:, None] * x + b[:, None]))
+                scale = np.maximum(1.4826 * np.nanmedian(np.where(mask, residuals, np.nan), axis=1), self.min_scale)
+                weights = mask * np.minimum(1.0, self.huber * scale[:, None] / residuals)
+        fitted = det > 0
+        self.params[rows[fitted]] = np.column_stack([k, b])[fitted]
+        self.scales[rows[fitted]] = scale[fitted]
+
+    def predict(self, targets, heights):
+        """
+        Depths for `targets` at chest `heights`, from their own model or the pooled one;
+        nan where neither is fitted yet.
+        """
+        if self._dirty:
+            self.fit()
+        targets = np.asarray(targets, dtype=np.int64)
+        params = self.params[targets]
+        own = ~np.isnan(params[:, 0])
+        params[~own] = self.params[self.pooled]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return params[:, 0] / np.asarray(heights, dtype=np.float64) + params[:, 1]
+
+
+def focal_length_px(hfov=None, width=None):
+    """
+    Focal length in pixels of a pinhole camera spanning `hfov` radians over `width`
+    pixels, by default the configured camera's.
+    """
+    hfov = CAMERA_HFOV if hfov is None else hfov
+    width = CAMERA_WIDTH if width is None else width
+    return width / (2 * np.tan(hfov / 2))
+
 
 def stereo_depth(x_1, x_2):
-    D = (CAMERA_DISTANCE * CAMERA_WIDTH)/(2 * np.tan(CAMERA_HFOV / 2) * (x_1 - x_2))
-    return D
+    """
+    Depth in millimeters of a point seen at columns x_1 and x_2 (scalars or arrays)
+    by the left and right cameras.
+    """
+    return (CAMERA_DISTANCE * focal_length_px()) / (np.asarray(x_1) - np.asarray(x_2))
+
+
+class DisparityDepthConverter:
+    """
+    Converts disparity frames into depth frames with one table lookup per pixel.
+
+    Disparities arrive as integer codes with `subpixel_bits` fractional bits, so
+    every possible code's depth, focal_px * baseline_mm / disparity, is computed
+    once up front. Both `min_disparity` and `max_disparity` are in pixels and
+    scaled to codes here; codes below the minimum (including 0, "no match") and
+    above the maximum map to 0, the invalid depth, like the RealSense depth
+    frames. The default uint16 table gives millimeters.
+    """
+    def __init__(self, focal_px, baseline_mm, max_disparity, subpixel_bits=0, min_disparity=1.0, dtype=np.uint16):
+        self.focal_px = focal_px
+        self.baseline_mm = baseline_mm
+        self.constant = focal_px * baseline_mm
+        scale = 2 ** subpixel_bits
+        max_code = int(np.ceil(max_disparity * scale))
+        # One extra entry past max_code so out of range codes clip onto an invalid depth
+        codes = np.arange(max_code + 2, dtype=np.float64)
+        valid = (codes >= min_disparity * scale) & (codes <= max_code)
+        depth = np.zeros(len(codes))
+        depth[valid] = self.constant * scale / codes[valid]
+        if np.issubdtype(dtype, np.integer):
+            depth = np.minimum(np.rint(depth), np.iinfo(dtype).max)
+        self.lut = depth.astype(dtype)
+
+    @classmethod
+    def from_config(cls, camera, max_disparity=95, subpixel_bits=0, **kwargs):
+        """
+        Uses the FOV, width and camera separation of a CONFIG.CameraConfig when no device
+        calibration is available. `max_disparity` is in pixels, like the search range of
+        the stereo matcher.
+        """
+        focal = focal_length_px(np.deg2rad(camera.hfov), camera.width)
+        return cls(focal, camera.distance, max_disparity, subpixel_bits=subpixel_bits, **kwargs)
+
+    def convert(self, disparity, out=None):
+        """
+        Converts an integer disparity frame. `out`, if given, must have the disparity
+        frame's shape and the table's dtype and is filled in place.
+        """
+        return np.take(self.lut, disparity, out=out, mode='clip')
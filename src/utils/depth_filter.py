@@ -0,0 +1,154 @@
+"""
+depth_filter.py
+Optional temporal filtering and hole filling of depth frames, restricted to the
+regions the detector is about to sample.
+
+Only the ROIs passed to `process` are touched, so the cost scales with the size
+of the people in view rather than the frame. Inside each ROI:
+
+1. An exponential moving average runs in a preallocated full-frame accumulator.
+   Pixels whose new depth differs from the average by more than `delta` restart
+   from the new value (an edge, not noise), and pixels that drop out keep their
+   average for up to `persistence` frames.
+2. The holes that remain are filled from a 2x downsampled pyramid of the ROI's
+   valid depths, taking each hole from the finest level that has data for it.
+
+Depths are in the frame's units (millimeters for both camera backends), 0 is invalid.
+"""
+import numpy as np
+
+
+def pyramid_buffers(shape, levels, dtype=np.float32):
+    """
+    Preallocated (values, counts) pairs for fill_holes on regions up to `shape`, one
+    per pyramid level from 0 (full resolution) to `levels`.
+    """
+    h, w = shape
+    buffers = []
+    for level in range(levels + 1):
+        size = ((h + (1 << level) - 1) >> level, (w + (1 << level) - 1) >> level)
+        buffers.append((np.empty(size, dtype=dtype), np.empty(size, dtype=dtype)))
+    return buffers
+
+
+def _pool(source, out):
+    # 2x2 sum pooling into `out`; odd edges just sum fewer pixels, as if zero padded
+    h, w = source.shape
+    out = out[:(h + 1) // 2, :(w + 1) // 2]
+    np.copyto(out, source[0::2, 0::2])
+    out[:, :w // 2] += source[0::2, 1::2]
+    out[:h // 2, :] += source[1::2, 0::2]
+    out[:h // 2, :w // 2] += source[1::2, 1::2]
+    return out
+
+
+def fill_holes(region, levels=3, buffers=None):
+    """
+    Fills the zero pixels of the float `region` in place from the mean of the valid
+    pixels in their 2^level block, for the smallest level up to `levels` that has any.
+    `buffers` from pyramid_buffers, at least the region's size, avoid allocating the
+    pyramid on every call.
+    """
+    holes = region <= 0
+    if not holes.any() or holes.all():
+        return region
+    if buffers is None:
+        buffers = pyramid_buffers(region.shape, levels, region.dtype)
+    ys, xs = np.nonzero(holes)
+    h, w = region.shape
+    values, counts = buffers[0][0][:h, :w], buffers[0][1][:h, :w]
+    np.copyto(values, region)
+    values[holes] = 0
+    np.logical_not(holes, out=counts, casting='unsafe')
+    pending = np.ones(len(ys), dtype=bool)
+    for level in range(1, levels + 1):
+        values = _pool(values, buffers[level][0])
+        counts = _pool(counts, buffers[level][1])
+        by, bx = ys[pending] >> level, xs[pending] >> level
+        n = counts[by, bx]
+        found = n > 0
+        idx = np.flatnonzero(pending)[found]
+        region[ys[idx], xs[idx]] = values[by[found], bx[found]] / n[found]
+        pending[idx] = False
+        if not pending.any():
+            break
+    return region
+
+
+class DepthPostProcessor:
+    """
+    Filters depth frames in place, see the module docstring. `alpha` is the weight of
+    the new measurement in the moving average.
+    """
+    def __init__(self, alpha=0.4, delta=250.0, persistence=3, levels=3):
+        self.alpha = alpha
+        self.delta = delta
+        self.persistence = persistence
+        self.levels = levels
+        self.frame_index = 0
+        self._average = None
+        self._stamp = None
+        self._updated = None
+        self._scratch = None
+        self._pyramid = None
+
+    @classmethod
+    def from_config(cls, depth):
+        """
+        Creates the post-processor from a CONFIG.DepthConfig.
+        """
+        return cls(alpha=depth.filter_alpha, delta=depth.filter_delta, persistence=depth.filter_persistence,
+                   levels=depth.fill_levels)
+
+    def _allocate(self, shape):
+        self._average = np.zeros(shape, dtype=np.float32)
+        # Frame index of each pixel's last valid measurement
+        self._stamp = np.full(shape, np.iinfo(np.int32).min // 2, dtype=np.int32)
+        self._updated = np.zeros(shape, dtype=np.int32)
+        # Working copy of each ROI's depths, then its output, and the hole filling pyramid
+        self._scratch = np.zeros(shape, dtype=np.float32)
+        self._pyramid = pyramid_buffers(shape, self.levels)
+
+    def process(self, depth_frame, rois):
+        """
+        Filters the (x0, y0, x1, y1) `rois` of `depth_frame` in place and returns the frame
+        (a writable copy if the camera's buffer was read-only).
+        """
+        self.frame_index += 1
+        if depth_frame is None:
+            return None
+        if not depth_frame.flags.writeable:
+            depth_frame = depth_frame.copy()
+        if self._average is None or self._average.shape != depth_frame.shape[:2]:
+            self._allocate(depth_frame.shape[:2])
+        height, width = depth_frame.shape[:2]
+        for x0, y0, x1, y1 in rois:
+            x0, x1 = max(int(x0), 0), min(int(x1), width)
+            y0, y1 = max(int(y0), 0), min(int(y1), height)
+            if x1 <= x0 or y1 <= y0:
+                continue
+            depth = depth_frame[y0:y1, x0:x1]
+            average = self._average[y0:y1, x0:x1]
+            stamp = self._stamp[y0:y1, x0:x1]
+            # Overlapping ROIs: pixels already filtered this frame are only written out again
+            fresh = self._updated[y0:y1, x0:x1] != self.frame_index
+            self._updated[y0:y1, x0:x1] = self.frame_index
+            new = self._scratch[y0:y1, x0:x1]
+            np.copyto(new, depth, casting='unsafe')
+            valid = fresh & (new > 0)
+            # The average only carries over while it is recent
+            recent = self.frame_index - stamp <= self.persistence
+            blend = valid & recent & (np.abs(new - average) <= self.delta)
+            average[blend] += self.alpha * (new[blend] - average[blend])
+            restart = valid & ~blend
+            average[restart] = new[restart]
+            stamp[valid] = self.frame_index
+            average[fresh & ~valid & ~recent] = 0
+            # The new depths are no longer needed, their scratch takes the output
+            result = new
+            np.copyto(result, average)
+            if self.levels > 0:
+                fill_holes(result, self.levels, self._pyramid)
+            np.rint(result, out=result)
+            np.copyto(depth, result, casting='unsafe')
+        return depth_frame
@@ -1,15 +1,20 @@
 # Write a class that gets the depth and RGB frames from an OAK-D camera and processes them to get the depth of a target.
 import depthai as dai
 import numpy as np
+from utils import depthEstimation as de
+
+# Resolution the stereo pair runs at, disparities are in these pixels
+MONO_RES = (640, 400)
 
 class OakDepthCam:
-    def __init__(self, res=(1280, 720), colorFps=30, depthFps=30):
+    def __init__(self, res=(1280, 720), colorFps=30, depthFps=30, queueSize=4):
         self.depthRes = res
         self.colorRes = res
         fps = max(colorFps, depthFps)
         self.pipeline = dai.Pipeline()
         self.device = dai.Device()
         self.queueNames = []
+        self.queueSize = queueSize
         # self.depthQueue = device.getOutputQueue(name="depth", maxSize=4, blocking=False)
         # self.colorQueue = device.getOutputQueue(name="color", maxSize=4, blocking=False)
         self.camRgb = self.pipeline.create(dai.node.Camera)
@@ -50,19 +55,33 @@ class OakDepthCam:
 
         self.camRgb.setMeshSource(dai.CameraProperties.WarpMeshSource.CALIBRATION)
 
+        # Depth from the device's own calibration instead of nominal constants
+        calib = self.device.readCalibration()
+        focal = calib.getCameraIntrinsics(dai.CameraBoardSocket.RIGHT, *MONO_RES)[0][0]
+        baselineMm = calib.getBaselineDistance() * 10
+        algorithm = self.stereo.initialConfig.get().algorithmControl
+        subpixelBits = algorithm.subpixelFractionalBits if algorithm.enableSubpixel else 0
+        # getMaxDisparity() is in disparity codes, the converter takes pixels
+        maxDisparity = self.stereo.initialConfig.getMaxDisparity() / 2 ** subpixelBits
+        self.depthConverter = de.DisparityDepthConverter(focal, baselineMm, maxDisparity, subpixel_bits=subpixelBits)
+        self.colorIntrinsics = np.array(calib.getCameraIntrinsics(dai.CameraBoardSocket.RGB, res[0], res[1]))
+        self.depthFrame = None
+
         # Connect to device and start pipeline
         self.device.startPipeline(self.pipeline)
+        self.queues = {name: self.device.getOutputQueue(name=name, maxSize=queueSize, blocking=False)
+                       for name in self.queueNames}
 
     def get_frame(self):
         latestPacket = {}
         latestPacket["rgb"] = None
         latestPacket["disp"] = None
         frameRgb = None
-        frameDisp = None
+        frameDepth = None
 
         queueEvents = self.device.getQueueEvents(("rgb", "disp"))
         for queueName in queueEvents:
-            packets = self.device.getOutputQueue(queueName).tryGetAll()
+            packets = self.queues[queueName].tryGetAll()
             if len(packets) > 0:
                 latestPacket[queueName] = packets[-1]
 
@@ -71,16 +90,25 @@ class OakDepthCam:
             frameRgb = np.ascontiguousarray(frameRgb)
 
         if latestPacket["disp"] is not None:
-            frameDisp = latestPacket["disp"].getCvFrame()
-            maxDisparity = self.stereo.initialConfig.getMaxDisparity()
-            # Optional, extend range 0..95 -> 0..255, for a better visualisation
-            frameDisp = (frameDisp * 255. / maxDisparity).astype(np.uint8)
-            frameDisp = np.ascontiguousarray(frameDisp)
-        
-        return True, None, frameDisp, frameRgb
-    
-    # Write a function that gets the 3D point of a pixel in the depth frame
+            frameDisp = latestPacket["disp"].getFrame()
+            # Depth in millimeters like the RealSense frames, 0 where the disparity is invalid.
+            # The buffer is reused, so the frame is only valid until the next get_frame
+            if self.depthFrame is None or self.depthFrame.shape != frameDisp.shape:
+                self.depthFrame = np.empty(frameDisp.shape, dtype=self.depthConverter.lut.dtype)
+            frameDepth = self.depthConverter.convert(frameDisp, out=self.depthFrame)
+
+        return True, None, frameDepth, frameRgb
+
     def get3d(self, x, y, distance):
-        return (0, 0, 0)
+        """
+        Deprojects pixel (x, y) of the color frame at `distance` millimeters into a
+        point in meters in the camera frame, None when the depth is invalid.
+        """
+        if not distance:
+            return None
+        z = distance / 1000
+        fx, fy = self.colorIntrinsics[0, 0], self.colorIntrinsics[1, 1]
+        cx, cy = self.colorIntrinsics[0, 2], self.colorIntrinsics[1, 2]
+        return [(x - cx) * z / fx, (y - cy) * z / fy, z]
         
 
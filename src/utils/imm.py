@@ -0,0 +1,173 @@
+"""
+imm.py
+Batched interacting multiple model (IMM) filter for all tracks at once.
+
+Every track runs a bank of linear Kalman filters over a shared
+(x, y, z, vx, vy, vz, ax, ay, az) state, one per motion model:
+
+- constant velocity, with white acceleration noise,
+- constant acceleration, with white jerk noise, for people speeding up, slowing
+  down and turning,
+- near stationary, where velocity and acceleration decay to zero.
+
+Each step the model estimates are mixed according to a Markov model switching
+matrix and the current mode probabilities, predicted with their own dynamics,
+updated with the position measurement, and the mode probabilities are
+reweighted by each model's measurement likelihood. All of this is done for every
+track in a handful of batched numpy operations over (tracks, models, ...)
+arrays, so the cost per frame barely depends on the number of tracks.
+
+The combined (position, velocity) estimate and its covariance are the moment
+matched mixture of the models, in the same 6-state layout as the UKF.
+"""
+import numpy as np
+
+MODELS = ('cv', 'ca', 'stationary')
+DIM = 9
+# Probability of staying in each model between frames
+DEFAULT_STAY = (0.95, 0.7, 0.95)
+
+
+def transition_matrix(stay):
+    """
+    (3, 3) model switching matrix with the `stay` probabilities of the MODELS on the
+    diagonal and the rest of each row split evenly over the other models.
+    """
+    stay = np.asarray(stay, dtype=np.float64)
+    transition = np.repeat(((1 - stay) / (len(stay) - 1))[:, None], len(stay), axis=1)
+    np.fill_diagonal(transition, stay)
+    return transition
+
+
+DEFAULT_TRANSITION = transition_matrix(DEFAULT_STAY)
+
+
+def _block(matrix):
+    # Per-axis 3x3 (position, velocity, acceleration) matrix to the 9-state layout
+    return np.kron(matrix, np.eye(3))
+
+
+def model_matrices(dt, q_cv=200.0, q_ca=5000.0, q_stationary=0.5, decay=0.5):
+    """
+    Transition matrices F and process noise Q, both (3, 9, 9), of the MODELS for a
+    step of `dt` seconds. `q_cv`, `q_ca` and `q_stationary` are the spectral densities
+    of the acceleration, jerk and position noise; `decay` is the time constant (s)
+    with which a stationary target's velocity dies out.
+    """
+    dt2, dt3, dt4, dt5 = dt ** 2, dt ** 3, dt ** 4, dt ** 5
+    F = np.empty((3, DIM, DIM))
+    Q = np.empty((3, DIM, DIM))
+    F[0] = _block(np.array([[1, dt, 0], [0, 1, 0], [0, 0, 0]]))
+    Q[0] = _block(q_cv * np.array([[dt3 / 3, dt2 / 2, 0], [dt2 / 2, dt, 0], [0, 0, 1e-6]]))
+    F[1] = _block(np.array([[1, dt, dt2 / 2], [0, 1, dt], [0, 0, 1]]))
+    Q[1] = _block(q_ca * np.array([[dt5 / 20, dt4 / 8, dt3 / 6], [dt4 / 8, dt3 / 3, dt2 / 2], [dt3 / 6, dt2 / 2, dt]]))
+    keep = np.exp(-dt / decay)
+    F[2] = _block(np.array([[1, 0, 0], [0, keep, 0], [0, 0, 0]]))
+    Q[2] = _block(np.diag([q_stationary * dt, q_stationary * dt, 1e-6]))
+    return F, Q
+
+
+class IMMBank:
+    """
+    IMM filter state for up to `capacity` tracks, indexed by the same slots as the
+    TrackRegistry and grown with it. `measurement_noise` is the position variance
+    (m^2) and `transition` the (3, 3) model switching matrix, rows summing to 1.
+    """
+    def __init__(self, capacity=64, transition=DEFAULT_TRANSITION, measurement_noise=0.01,
+                 initial_covariance=0.2, initial_probabilities=(0.6, 0.2, 0.2),
+                 q_cv=200.0, q_ca=5000.0, q_stationary=0.5):
+        self.transition = np.asarray(transition, dtype=np.float64)
+        self.measurement_noise = measurement_noise
+        self.initial_covariance = initial_covariance
+        self.initial_probabilities = np.asarray(initial_probabilities, dtype=np.float64)
+        self.noise = dict(q_cv=q_cv, q_ca=q_ca, q_stationary=q_stationary)
+        self.capacity = 0
+        self.x = np.zeros((0, 3, DIM))
+        self.P = np.zeros((0, 3, DIM, DIM))
+        self.mu = np.zeros((0, 3))
+        self._matrices = {}
+        self.grow(capacity)
+
+    def grow(self, capacity):
+        if capacity <= self.capacity:
+            return
+        extra = capacity - self.capacity
+        self.x = np.concatenate([self.x, np.zeros((extra, 3, DIM))])
+        self.P = np.concatenate([self.P, np.zeros((extra, 3, DIM, DIM))])
+        self.mu = np.concatenate([self.mu, np.zeros((extra, 3))])
+        self.capacity = capacity
+
+    def _model_matrices(self, dt):
+        # Frame rates are steady, so the same few dt values come up again and again
+        key = round(dt, 6)
+        if key not in self._matrices:
+            if len(self._matrices) > 64:
+                self._matrices.clear()
+            self._matrices[key] = model_matrices(key, **self.noise)
+        return self._matrices[key]
+
+    def start(self, slots, positions, velocities):
+        """
+        Starts the filters of `slots` at (k, 3) `positions` and `velocities`.
+        """
+        slots = np.asarray(slots, dtype=np.intp)
+        self.x[slots] = 0
+        self.x[slots, :, :3] = np.asarray(positions)[:, None]
+        self.x[slots, :, 3:6] = np.asarray(velocities)[:, None]
+        self.P[slots] = np.eye(DIM) * self.initial_covariance
+        self.mu[slots] = self.initial_probabilities
+
+    def predict(self, slots, dt):
+        """
+        Mixes and predicts the filters of `slots` `dt` seconds ahead.
+        """
+        if len(slots) == 0 or not dt:
+            return
+        F, Q = self._model_matrices(dt)
+        x, P, mu = self.x[slots], self.P[slots], self.mu[slots]
+        # Mixing: weight of model i in the input of model j
+        predicted_mu = mu @ self.transition
+        weights = self.transition[None] * mu[:, :, None] / np.maximum(predicted_mu[:, None, :], 1e-300)
+        x0 = np.einsum('kij,kid->kjd', weights, x)
+        spread = x[:, :, None, :] - x0[:, None, :, :]
+        P0 = np.einsum('kij,kiab->kjab', weights, P) + np.einsum('kij,kija,kijb->kjab', weights, spread, spread)
+        # Every model through its own dynamics
+        self.x[slots] = np.einsum('jab,kjb->kja', F, x0)
+        self.P[slots] = np.einsum('jab,kjbc,jdc->kjad', F, P0, F) + Q[None]
+        self.mu[slots] = predicted_mu
+
+    def update(self, slots, measurements):
+        """
+        Updates the filters of `slots` with their (k, 3) position `measurements`.
+        """
+        if len(slots) == 0:
+            return
+        x, P, mu = self.x[slots], self.P[slots], self.mu[slots]
+        z = np.asarray(measurements, dtype=np.float64)[:, None, :]
+        innovation = z - x[..., :3]
+        S = P[..., :3, :3] + np.eye(3) * self.measurement_noise
+        S_inv = np.linalg.inv(S)
+        K = P[..., :, :3] @ S_inv
+        x = x + np.einsum('kjab,kjb->kja', K, innovation)
+        # Joseph form keeps P symmetric positive definite
+        I_KH = np.broadcast_to(np.eye(DIM), K.shape[:2] + (DIM, DIM)).copy()
+        I_KH[..., :, :3] -= K
+        P = I_KH @ P @ np.swapaxes(I_KH, -1, -2) + self.measurement_noise * K @ np.swapaxes(K, -1, -2)
+        # Mode probabilities from the log likelihoods, shifted to avoid underflow
+        mahalanobis = np.einsum('kja,kjab,kjb->kj', innovation, S_inv, innovation)
+        log_likelihood = -0.5 * (mahalanobis + np.log(np.linalg.det(S)))
+        log_mu = np.log(np.maximum(mu, 1e-300)) + log_likelihood
+        mu = np.exp(log_mu - log_mu.max(axis=1, keepdims=True))
+        self.x[slots] = x
+        self.P[slots] = P
+        self.mu[slots] = mu / mu.sum(axis=1, keepdims=True)
+
+    def combined(self, slots):
+        """
+        Mixture (k, 6) position/velocity estimates of `slots` and their (k, 6, 6) covariances.
+        """
+        x, P, mu = self.x[slots, :, :6], self.P[slots, :, :6, :6], self.mu[slots]
+        mean = np.einsum('kj,kja->ka', mu, x)
+        spread = x - mean[:, None]
+        covariance = np.einsum('kj,kjab->kab', mu, P) + np.einsum('kj,kja,kjb->kab', mu, spread, spread)
+        return mean, covariance
@@ -0,0 +1,257 @@
+"""
+metrics.py
+Low-overhead per-stage latency instrumentation for the hot loop.
+
+Stages are timed with `stage(name)` as a context manager or `timed(name)` as a
+decorator, and every sample lands in a fixed log-spaced histogram. Each stage is
+only ever written by the thread that runs it, so recording is a couple of list
+increments with no locks; readers copy the counts and may be one sample stale.
+
+Usage:
+    with metrics.stage('inference'):
+        results = model(frame)
+
+    metrics.METRICS.dump_json('metrics.json')
+    metrics.serve_http(8088)   # GET /metrics (JSON) or /metrics.csv
+"""
+import csv
+import io
+import json
+import os
+import threading
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from math import log2
+from time import perf_counter_ns
+
+
+class LatencyHistogram:
+    """
+    Latency histogram with `buckets_per_octave` log-spaced buckets starting at
+    `min_ns`. The defaults cover 1us to ~30s with a resolution of about 19%.
+    """
+    def __init__(self, name, min_ns=1000, buckets_per_octave=4, n_buckets=100):
+        self.name = name
+        self.min_ns = min_ns
+        self.buckets_per_octave = buckets_per_octave
+        self.n_buckets = n_buckets
+        self.counts = [0] * n_buckets
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def record(self, elapsed_ns):
+        if elapsed_ns <= self.min_ns:
+            i = 0
+        else:
+            i = min(int(log2(elapsed_ns / self.min_ns) * self.buckets_per_octave), self.n_buckets - 1)
+        self.counts[i] += 1
+        self.count += 1
+        self.total_ns += elapsed_ns
+        if elapsed_ns > self.max_ns:
+            self.max_ns = elapsed_ns
+
+    def merge(self, other):
+        """
+        Adds the samples of `other`, a histogram with the same bucket layout.
+        """
+        if (other.min_ns, other.buckets_per_octave, other.n_buckets) != (self.min_ns, self.buckets_per_octave, self.n_buckets):
+            raise ValueError('Histograms with different bucket layouts cannot be merged')
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total_ns += other.total_ns
+        self.max_ns = max(self.max_ns, other.max_ns)
+
+    def bucket_upper_ns(self, i):
+        return self.min_ns * 2 ** ((i + 1) / self.buckets_per_octave)
+
+    def percentiles(self, qs=(50, 95, 99)):
+        """
+        Returns the upper bucket edge (in ns) below which q percent of the samples fall.
+        """
+        counts = list(self.counts)
+        total = sum(counts)
+        if total == 0:
+            return [None for q in qs]
+        results = []
+        for q in qs:
+            threshold = total * q / 100
+            running = 0
+            for i, c in enumerate(counts):
+                running += c
+                if running >= threshold:
+                    results.append(min(self.bucket_upper_ns(i), self.max_ns))
+                    break
+        return results
+
+    def summary(self):
+        p50, p95, p99 = self.percentiles((50, 95, 99))
+        to_ms = lambda ns: None if ns is None else ns / 1e6
+        return {
+            'count': self.count,
+            'mean_ms': to_ms(self.total_ns / self.count) if self.count else None,
+            'p50_ms': to_ms(p50),
+            'p95_ms': to_ms(p95),
+            'p99_ms': to_ms(p99),
+            'max_ms': to_ms(self.max_ns) if self.count else None,
+        }
+
+    def reset(self):
+        self.counts = [0] * self.n_buckets
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+
+class Stage:
+    """
+    Reusable timer for a single stage. Not reentrant: a stage must not be
+    nested inside itself or entered from two threads at once.
+    """
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self._start = 0
+
+    def __enter__(self):
+        self._start = perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.record(perf_counter_ns() - self._start)
+        return False
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_STAGE = _NullStage()
+
+
+class Metrics:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def _get_stage(self, name):
+        stage = self.stages.get(name)
+        if stage is None:
+            # Only stage creation is locked, recording never is
+            with self._lock:
+                stage = self.stages.setdefault(name, Stage(LatencyHistogram(name)))
+        return stage
+
+    def stage(self, name):
+        if not self.enabled:
+            return NULL_STAGE
+        return self._get_stage(name)
+
+    def timed(self, name):
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self._get_stage(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, name, elapsed_ns):
+        if self.enabled:
+            self._get_stage(name).histogram.record(elapsed_ns)
+
+    def snapshot(self):
+        return {name: stage.histogram.summary() for name, stage in list(self.stages.items())}
+
+    def reset(self):
+        for stage in list(self.stages.values()):
+            stage.histogram.reset()
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_csv(self):
+        buffer = io.StringIO()
+        fields = ['stage', 'count', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms']
+        writer = csv.DictWriter(buffer, fieldnames=fields)
+        writer.writeheader()
+        for name, summary in self.snapshot().items():
+            writer.writerow({'stage': name, **summary})
+        return buffer.getvalue()
+
+    def dump(self, path):
+        """
+        Writes the current summary to `path` as CSV if it ends in .csv and JSON otherwise.
+        The file is replaced atomically so readers never see a partial dump.
+        """
+        content = self.to_csv() if path.endswith('.csv') else self.to_json()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def dump_json(self, path):
+        self.dump(path if path.endswith('.json') else path + '.json')
+
+    def dump_csv(self, path):
+        self.dump(path if path.endswith('.csv') else path + '.csv')
+
+
+METRICS = Metrics()
+stage = METRICS.stage
+timed = METRICS.timed
+
+
+class MetricsReporter(threading.Thread):
+    """
+    Periodically dumps `metrics` to `path` from a daemon thread.
+    """
+    def __init__(self, path, interval=10.0, metrics=METRICS):
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.metrics = metrics
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.metrics.dump(self.path)
+
+    def stop(self):
+        self.stopped.set()
+        self.metrics.dump(self.path)
+
+
+def serve_http(port, host='127.0.0.1', metrics=METRICS):
+    """
+    Serves the metrics summary on http://host:port/metrics (JSON) and
+    /metrics.csv from a daemon thread. Returns the server so it can be shut down.
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics.csv':
+                body, content_type = metrics.to_csv(), 'text/csv'
+            elif self.path in ('/', '/metrics'):
+                body, content_type = metrics.to_json(), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            body = body.encode()
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
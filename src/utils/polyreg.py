@@ -1,95 +1,104 @@
 import numpy as np
-from points import Point, Points
+from functools import lru_cache
 
 # FRAME_RATE = 30
 # TIME_DELTA = float(1/FRAME_RATE)
 
 
-def regress(pts:Points, degree=2):
+class PolyPredictor:
     """
-    This function assumes pts is a class Points containing points with a dimension of 2 and a time t
-    """
-    """
-    Need the coefficients from 0 to t-1 and from 1 to t.
-    This will produce two polynomials fitted from the positions which will be used to 
-    get a prediction
+    Sliding-window polynomial predictor for any number of tracks and axes at once.
 
-    The coefs will be stored as such: {"x":(poly1, poly2), "y":(poly1, poly2) ... "n":(poly1, poly2)}
-    """
-    if len(pts.keys()) != 2:
-        raise ValueError
-    coefs = dict()
-    k1 = pts.keys()[0]
-    k2 = pts.keys()[1]
-    time = pts._time
-    t1 = time[0:len(time)-1]
-    t2 = time[1:len(time)]
-    coefs[k1] = (
-            np.polyfit(
-                t1,
-                pts[k1][0:len(pts)-1],
-                degree
-                ),
-            np.polyfit(
-                t2,
-                pts[k1][1:len(pts)],
-                degree
-                )
-            )
-    coefs[k2] = (
-            np.polyfit(
-                t1,
-                pts[k2][0:len(pts)-1],
-                degree
-                ),
-            np.polyfit(
-                t2,
-                pts[k2][1:len(pts)],
-                degree
-                )
-            )
-
-    model_time = np.array(time + [time[-1]+1])
-    model_k1 = (
-            np.polyval(coefs[k1][0], model_time),
-            np.polyval(coefs[k1][1], model_time)
-            )
-    model_k2 = (
-            np.polyval(coefs[k2][0], model_time),
-            np.polyval(coefs[k2][1], model_time)
-            )
-    print(model_k1)
-    print(model_k2)
-    print(coefs[k1])
-    print(coefs[k2])
-    
-    return {'mk1': model_k1, 'mk2': model_k2, 'k1':k1, 'k2':k2, 'len': len(time), 'time': time}
-
-def estimate(model):
-    """
-    The regression model retrned from regress contains the two models for
-    the first two axis lines supplied in Points.
-
-    The model for point estimation is presented as such:
-    E = (2 * xfinal_2 - xfinal_1, 2 * yfinal_2 - yfinal_1)
-    where E is a point (or vector) in space and xfinal, yfinal
-    are the end points from the regression models with
-    their respective model numbers
+    For a history of `window` evenly spaced samples y(0) .. y(W-1), two polynomials
+    of `degree` are fitted: Q1 over y(0) .. y(W-2) and Q2 over y(1) .. y(W-1). The
+    next point is estimated as
+
+        E = 2 * Q2(W) - Q1(W)
+
+    Both fits share the same Vandermonde matrix (Q2 is just Q1's fit shifted by one
+    sample), so its pseudo-inverse is computed once in __init__. Fitting is then a
+    single matrix product, and because E is linear in the samples it collapses to a
+    precomputed weight vector dotted with the history.
+
+    Time is measured in samples, so histories must be evenly spaced (one per frame).
     """
-    next_time = model['time'][-1] + 1
+    def __init__(self, window=10, degree=2):
+        if window - 1 <= degree:
+            raise ValueError(f"window must be larger than degree + 1 to fit; got window={window}, degree={degree}")
+        self.window = window
+        self.degree = degree
+        self._powers = np.arange(degree + 1)
+        t = np.arange(window - 1)
+        self._vandermonde = t[:, None] ** self._powers
+        # (degree + 1, window - 1), maps samples to ascending polynomial coefficients
+        self._pinv = np.linalg.pinv(self._vandermonde)
+        self._weights = {}
+
+    def _basis(self, t):
+        return float(t) ** self._powers
+
+    def weights(self, steps=1):
+        """
+        Returns the length `window` vector w such that w @ history is the
+        2*Q2 - Q1 estimate `steps` samples past the end of the history.
+        """
+        w = self._weights.get(steps)
+        if w is None:
+            t = self.window - 1 + steps
+            w = np.zeros(self.window)
+            # Q2 is fitted on samples shifted by one, so it is evaluated one step earlier
+            w[1:] += 2 * self._basis(t - 1) @ self._pinv
+            w[:-1] -= self._basis(t) @ self._pinv
+            self._weights[steps] = w
+        return w
 
+    def _check(self, histories):
+        histories = np.asarray(histories, dtype=np.float64)
+        if histories.ndim == 2:
+            histories = histories[None]
+        if histories.ndim != 3 or histories.shape[1] != self.window:
+            raise ValueError(f"histories must have shape (n, {self.window}, dims); got {histories.shape}")
+        return histories
 
-    y_Quad_2 = model['mk2'][1][-1]
-    y_Quad_1 = model['mk2'][0][-1]
-    x_Quad_2 = model['mk1'][1][-1]
-    x_Quad_1 = model['mk1'][0][-1]
-    prediction = Point(
-            {
-            model['k1']:2*x_Quad_2 - x_Quad_1,
-            model['k2']:2*y_Quad_2 - y_Quad_1
-            },
-        next_time
-        )
+    def fit(self, histories):
+        """
+        Fits Q1 and Q2 for every track and axis. `histories` is (n, window, dims)
+        and the result is two (n, degree + 1, dims) arrays of ascending coefficients.
+        """
+        histories = self._check(histories)
+        return self._pinv @ histories[:, :-1], self._pinv @ histories[:, 1:]
 
-    return prediction
+    def estimate(self, histories, steps=1):
+        """
+        Returns the (n, dims) 2*Q2 - Q1 estimates for all tracks in one call.
+        """
+        histories = self._check(histories)
+        return np.einsum('w,nwd->nd', self.weights(steps), histories)
 
+
+@lru_cache(maxsize=None)
+def get_predictor(window, degree=2):
+    return PolyPredictor(window, degree)
+
+
+def regress(histories, degree=2):
+    """
+    Fits the two sliding-window models for an (n, window, dims) or (window, dims)
+    array of evenly spaced positions. Returns a model for `estimate`.
+    """
+    histories = np.asarray(histories, dtype=np.float64)
+    predictor = get_predictor(histories.shape[-2], degree)
+    q1, q2 = predictor.fit(histories)
+    return {'q1': q1, 'q2': q2, 'predictor': predictor}
+
+
+def estimate(model, steps=1):
+    """
+    Returns the 2*Q2 - Q1 estimate for every track in a model from `regress`.
+    For repeated predictions PolyPredictor.estimate skips the coefficients entirely.
+    """
+    predictor = model['predictor']
+    t = predictor.window - 1 + steps
+    q2_next = np.einsum('k,nkd->nd', predictor._basis(t - 1), model['q2'])
+    q1_next = np.einsum('k,nkd->nd', predictor._basis(t), model['q1'])
+    return 2 * q2_next - q1_next
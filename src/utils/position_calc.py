@@ -1,52 +1,67 @@
-import depthEstimation as de
+import numpy as np
+
+from utils import depthEstimation as de
 
-class PositionCalc:
-    def __init__(self, max_pos_size=20):
-        self.pixel_heights = []
-        self.depth_points = []
-        self.final_depth = None
-        self.MAX_POS_SIZE = max_pos_size
-    
-    def add_depth_point(self, pixel_h, depth_c):
-        self.pixel_heights.append(pixel_h)
-        self.depth_points.append(depth_c)
-        if len(self.pixel_heights) > self.MAX_POS_SIZE:
-            self.pixel_heights.pop(0)
-            self.depth_points.pop(0)
-    
-    
-    def clear_depth_points(self):
-        self.pixel_heights = []
-        self.depth_points = []
-
-    def get_real_depth(self):
-        if len(self.pixel_heights) < self.MAX_POS_SIZE:
-            return self.final_depth
-        self.final_depth = de.get_real_depth(self.pixel_heights, self.depth_points)
-        self.clear_depth_points()
-        return self.final_depth
-    
 class MultiTargetDepthEstimator:
-    def __init__(self, max_pos_size=20):
-        self.position_calcs = []
+    """
+    Sensor depths for the targets of the current frame, with a monocular fallback.
+
+    Targets are identified by their index in the frame, as before. Every valid
+    (chest height, sensor depth) pair trains the target's depthEstimation.HeightDepthModel;
+    a target whose sensor depth is missing or beyond `max_depth` gets the model's
+    k / h + bias estimate instead, or None while no model is fitted yet. Targets past
+    the first `max_targets` (size it from YOLOv8.max_detections) have no model and
+    only ever get their sensor depth.
+    """
+    def __init__(self, max_pos_size=20, verbose=False, capacity=100, max_depth=None, huber=1.345, max_targets=16):
         self.MAX_POS_SIZE = max_pos_size
-    
-    def add_depth_point(self, pixel_h, depth_c, target_num):
-        if len(self.position_calcs) < target_num + 1:
-            self.position_calcs.append(PositionCalc(self.MAX_POS_SIZE))
-        self.position_calcs[target_num].add_depth_point(pixel_h, depth_c)
+        self.verbose = verbose
+        self.max_depth = max_depth
+        self.model = de.HeightDepthModel(max_targets=max_targets, capacity=capacity, min_samples=max_pos_size,
+                                         huber=huber)
+        self.heights = np.empty(0)
+        self.depths = np.empty(0)
+
+    @classmethod
+    def from_config(cls, depth, verbose=False, max_targets=16):
+        """
+        Creates the estimator from a CONFIG.DepthConfig.
+        """
+        return cls(depth.max_pos_size, verbose=verbose, capacity=depth.max_k_size, max_depth=depth.max_stereo_depth,
+                   huber=depth.huber, max_targets=max_targets)
+
+    def __len__(self):
+        return len(self.heights)
+
+    def _sensor_valid(self, depths):
+        valid = np.isfinite(depths) & (depths > 0)
+        if self.max_depth is not None:
+            valid &= depths <= self.max_depth
+        return valid
 
     def add_depth_points(self, pixel_hs, depth_cs):
-        print(len(pixel_hs), len(depth_cs))
-        for i, (pixel_h, depth_c) in enumerate(zip(pixel_hs, depth_cs)):
-            self.add_depth_point(pixel_h, depth_c, i)
-    
+        if self.verbose:
+            print(len(pixel_hs), len(depth_cs))
+        self.heights = np.asarray(pixel_hs, dtype=np.float64)
+        self.depths = np.asarray([np.nan if d is None else d for d in depth_cs], dtype=np.float64)
+        # Targets beyond the model bank only get their sensor depths
+        valid = self._sensor_valid(self.depths)
+        valid[self.model.max_targets:] = False
+        self.model.add(np.flatnonzero(valid), self.heights[valid], self.depths[valid])
+
     def clear_all_targets(self):
-        self.position_calcs = []
-    
+        self.model.clear()
+        self.heights = np.empty(0)
+        self.depths = np.empty(0)
+
     def get_real_depths(self):
-        real_depths = []
-        for position_calc in self.position_calcs:
-            real_depths.append(position_calc.get_real_depth())
-        return real_depths
-        
\ No newline at end of file
+        """
+        Returns one depth (or None) per target of the last add_depth_points call.
+        """
+        if len(self.heights) == 0:
+            return []
+        n = min(len(self.heights), self.model.max_targets)
+        depths = self.depths.copy()
+        modelled = ~self._sensor_valid(depths[:n])
+        depths[:n][modelled] = self.model.predict(np.flatnonzero(modelled), self.heights[:n][modelled])
+        return [None if np.isnan(d) else float(d) for d in depths]
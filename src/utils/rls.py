@@ -0,0 +1,92 @@
+import numpy as np
+from math import comb, perm
+
+
+class RLSPolyTracker:
+    """
+    Incremental polynomial trajectory fit using recursive least squares with an
+    exponential forgetting factor.
+
+    Each measurement updates the coefficients in O(degree^2) regardless of how long
+    the history is, and position, velocity and acceleration are read straight off
+    the fitted polynomial. A forgetting factor `forgetting` weighs a sample k frames
+    old by forgetting**k, so the effective window is about 1 / (1 - forgetting)
+    samples (0.9 is about a third of a second at 30 fps, 0.99 about 3 seconds).
+
+    The polynomial is in time relative to a local origin that is moved up to the
+    latest measurement every `recenter_interval` seconds, which keeps the powers of
+    t small and the covariance well conditioned over arbitrarily long runs.
+    """
+    def __init__(self, degree=2, forgetting=0.9, dims=3, initial_covariance=1e4, recenter_interval=1.0):
+        if degree < 1:
+            raise ValueError(f"degree must be at least 1; got {degree}")
+        if not 0 < forgetting <= 1:
+            raise ValueError(f"forgetting must be in (0, 1]; got {forgetting}")
+        self.degree = degree
+        self.forgetting = forgetting
+        self.recenter_interval = recenter_interval
+        self._powers = np.arange(degree + 1)
+        # Binomial coefficients C(j, i) for moving the polynomial origin
+        self._binom = np.array([[comb(j, i) for j in range(degree + 1)] for i in range(degree + 1)], dtype=np.float64)
+        self._shift_exp = np.maximum(self._powers[None, :] - self._powers[:, None], 0)
+        # d^n/dt^n t^k = k! / (k - n)! t^(k - n), per derivative order n
+        self._deriv_factors = [np.array([perm(k, n) for k in range(n, degree + 1)], dtype=np.float64)
+                               for n in range(degree + 1)]
+        self.theta = np.zeros((degree + 1, dims))
+        self.P = np.eye(degree + 1) * initial_covariance
+        self.t = 0.0
+        self.n_updates = 0
+
+    def _recenter(self):
+        """
+        Re-expresses the polynomial around the current time: p(t' + t) in powers of t'.
+        """
+        S = self._binom * self.t ** self._shift_exp
+        self.theta = S @ self.theta
+        self.P = S @ self.P @ S.T
+        self.t = 0.0
+
+    def update(self, measurement, dt):
+        """
+        Adds a measurement taken `dt` seconds after the previous one.
+        """
+        if self.n_updates > 0:
+            self.t += dt
+        if self.t > self.recenter_interval:
+            self._recenter()
+        phi = self.t ** self._powers
+        P_phi = self.P @ phi
+        gain = P_phi / (self.forgetting + phi @ P_phi)
+        error = np.asarray(measurement, dtype=np.float64) - phi @ self.theta
+        self.theta += np.outer(gain, error)
+        P = (self.P - np.outer(gain, P_phi)) / self.forgetting
+        # Dividing by the forgetting factor amplifies rounding every update; without
+        # re-symmetrizing, P drifts away from symmetric and the fit diverges
+        self.P = (P + P.T) / 2
+        self.n_updates += 1
+
+    def derivative(self, order, dt=0.0):
+        """
+        Returns the `order`-th time derivative of the fitted trajectory `dt` seconds
+        after the latest measurement.
+        """
+        if order > self.degree:
+            return np.zeros(self.theta.shape[1])
+        t = self.t + dt
+        basis = self._deriv_factors[order] * t ** (self._powers[order:] - order)
+        return basis @ self.theta[order:]
+
+    def position(self, dt=0.0):
+        return self.derivative(0, dt)
+
+    def velocity(self, dt=0.0):
+        return self.derivative(1, dt)
+
+    def acceleration(self, dt=0.0):
+        return self.derivative(2, dt)
+
+    def get_state(self, dt=0.0):
+        """
+        Returns (position, velocity, acceleration) at `dt` seconds after the latest measurement.
+        """
+        return self.position(dt), self.velocity(dt), self.acceleration(dt)
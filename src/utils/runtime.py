@@ -0,0 +1,273 @@
+"""
+runtime.py
+asyncio runtime for the vision loop and everything that runs alongside it.
+
+Camera reads and inference are blocking calls, so each gets its own
+single-thread executor: while frame N is in inference the camera thread is
+already waiting for frame N+1, and only the newest captured frame is kept for
+inference. Tracker updates run as a coroutine on the event loop and publish a
+TrackSnapshot to a SnapshotHub after every frame. Each subscriber has its own
+small queue that drops its oldest snapshot when the subscriber falls behind, so
+publishing never waits, and any number of consumers (telemetry, the trajectory
+recorder, TCP clients of serve_tracks, health checks, control commands) share
+the loop without adding latency to the vision path.
+
+Usage:
+    runtime = TrackingRuntime(detector.capture, estimate_positions, handler)
+    runtime.spawn(serve_tracks(runtime.hub, port=8765), drain=False)
+    asyncio.run(runtime.run())
+
+    $ nc 127.0.0.1 8765    # one JSON snapshot per line
+"""
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from typing import NamedTuple
+
+import numpy as np
+
+from utils import metrics
+
+
+class TrackSnapshot(NamedTuple):
+    frame: int
+    stamp: float
+    # (k, 3) detections the tracker was fed this frame
+    positions: np.ndarray
+    uids: list
+    # (n, 6) states and (n, 6, 6) covariances of the real targets
+    states: np.ndarray
+    covariances: np.ndarray
+    # Frames since each real target was last matched
+    missed: np.ndarray = None
+
+    def to_json(self):
+        return json.dumps({'frame': self.frame, 'stamp': self.stamp, 'positions': self.positions.tolist(),
+                           'tracks': [{'uid': uid, 'state': state} for uid, state in zip(self.uids, self.states.tolist())]})
+
+
+class Subscription:
+    """
+    A subscriber's view of a SnapshotHub, iterated with `async for`. Holds at most
+    `maxsize` snapshots; when it is full the oldest is dropped and counted in `dropped`.
+    Iteration ends when the hub closes. Use as a context manager to unsubscribe.
+    """
+    def __init__(self, hub, maxsize=1):
+        self._hub = hub
+        self._queue = asyncio.Queue()
+        self.maxsize = maxsize
+        self.dropped = 0
+
+    def put(self, snapshot):
+        while self._queue.qsize() >= self.maxsize:
+            self._queue.get_nowait()
+            self.dropped += 1
+        self._queue.put_nowait(snapshot)
+
+    def end(self):
+        self._queue.put_nowait(None)
+
+    def close(self):
+        self._hub.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        snapshot = await self._queue.get()
+        if snapshot is None:
+            raise StopAsyncIteration
+        return snapshot
+
+
+class SnapshotHub:
+    """
+    Fans TrackSnapshots out to Subscriptions. Only used from the event loop thread.
+    """
+    def __init__(self):
+        self.latest = None
+        self.closed = False
+        self._subscribers = set()
+
+    def subscribe(self, maxsize=1):
+        """
+        Returns a Subscription that starts with the latest snapshot, if there is one.
+        """
+        subscription = Subscription(self, maxsize)
+        if self.closed:
+            subscription.end()
+            return subscription
+        if self.latest is not None:
+            subscription.put(self.latest)
+        self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self._subscribers.discard(subscription)
+
+    def publish(self, snapshot):
+        self.latest = snapshot
+        for subscription in self._subscribers:
+            subscription.put(snapshot)
+
+    def close(self):
+        """
+        Ends every subscriber's iteration, after the snapshots it still holds.
+        """
+        self.closed = True
+        for subscription in self._subscribers:
+            subscription.end()
+        self._subscribers.clear()
+
+
+async def serve_tracks(hub, host='127.0.0.1', port=8765, maxsize=4):
+    """
+    Streams every snapshot of `hub` to each TCP client as one JSON line
+    (TrackSnapshot.to_json). A slow client only drops snapshots of its own.
+    Serves until cancelled, e.g. as a TrackingRuntime.spawn(..., drain=False) task.
+    """
+    encoded = {}
+
+    def encode(snapshot):
+        # Serialized once per snapshot however many clients there are
+        if encoded.get('frame') != snapshot.frame:
+            encoded['frame'] = snapshot.frame
+            encoded['line'] = snapshot.to_json().encode() + b'\n'
+        return encoded['line']
+
+    async def stream(reader, writer):
+        try:
+            with hub.subscribe(maxsize) as subscription:
+                async for snapshot in subscription:
+                    writer.write(encode(snapshot))
+                    await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(stream, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+class TrackingRuntime:
+    """
+    Runs capture, inference and tracking as a pipeline on an asyncio loop.
+
+    `capture()` blocks until the next camera frame and returns it, or None at the end
+    of the stream. `infer(captured)` turns it into the (k, 3) detected positions.
+    They run on their own executor threads; the FrameHandler update runs on the
+    loop, and its result is published to `hub`. Frames captured while inference is
+    busy replace each other and the replaced ones are counted in `skipped`.
+    When the runtime stops, hub subscribers get up to `drain_timeout` seconds to
+    handle the snapshots they still hold.
+    """
+    def __init__(self, capture, infer, handler, hub=None, clock=time, drain_timeout=2.0):
+        self.capture = capture
+        self.infer = infer
+        self.handler = handler
+        self.hub = SnapshotHub() if hub is None else hub
+        self.clock = clock
+        self.drain_timeout = drain_timeout
+        self.frames = 0
+        self.skipped = 0
+        self.last_stamp = None
+        self._running = False
+        self._tasks = []
+        self._services = []
+        self._camera = ThreadPoolExecutor(1, thread_name_prefix='camera')
+        self._inference = ThreadPoolExecutor(1, thread_name_prefix='inference')
+
+    def spawn(self, coroutine, drain=True):
+        """
+        Runs `coroutine` next to the vision loop. May be called before run().
+        With `drain` it is a hub consumer: when the runtime stops it is given
+        `drain_timeout` seconds to finish after the hub closes before it is cancelled.
+        Services that never end on their own, like serve_tracks, pass drain=False
+        and are cancelled right away.
+        """
+        if self._running:
+            task = asyncio.ensure_future(coroutine)
+        else:
+            task = coroutine
+        (self._tasks if drain else self._services).append(task)
+        return task
+
+    def stop(self):
+        """
+        Stops after the frame being captured. Safe to call from any thread.
+        """
+        self._running = False
+
+    async def _capture_frames(self, frames):
+        loop = asyncio.get_running_loop()
+        while self._running:
+            captured = await loop.run_in_executor(self._camera, self.capture)
+            if captured is None:
+                break
+            stamp = self.clock()
+            # Only the newest frame waits for inference
+            while not frames.empty():
+                frames.get_nowait()
+                self.skipped += 1
+            frames.put_nowait((stamp, captured))
+        frames.put_nowait(None)
+
+    async def update_tracks(self, stamp, positions):
+        """
+        Feeds one frame of positions to the tracker and publishes the resulting snapshot.
+        """
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        dt = None if self.last_stamp is None else stamp - self.last_stamp
+        self.last_stamp = stamp
+        with metrics.stage('tracking'):
+            self.handler.add_frame(positions, dt=dt)
+            self.handler.associate_real_targets()
+            self.handler.associate_potential_targets()
+            uids, states, covariances = self.handler.get_track_states()
+            missed = self.handler.get_track_missed()
+        snapshot = TrackSnapshot(self.frames, stamp, positions, uids, states, covariances, missed)
+        self.frames += 1
+        self.hub.publish(snapshot)
+        return snapshot
+
+    async def run(self):
+        """
+        Runs until the camera runs out of frames or stop() is called.
+        """
+        loop = asyncio.get_running_loop()
+        self._running = True
+        self._tasks = [asyncio.ensure_future(task) for task in self._tasks]
+        self._services = [asyncio.ensure_future(task) for task in self._services]
+        frames = asyncio.Queue()
+        capturing = asyncio.ensure_future(self._capture_frames(frames))
+        try:
+            while True:
+                item = await frames.get()
+                if item is None:
+                    break
+                stamp, captured = item
+                positions = await loop.run_in_executor(self._inference, self.infer, captured)
+                await self.update_tracks(stamp, positions)
+        finally:
+            self._running = False
+            self.hub.close()
+            capturing.cancel()
+            for task in self._services:
+                task.cancel()
+            # Consumers end by themselves once they are through the snapshots they hold
+            if self._tasks:
+                await asyncio.wait(self._tasks, timeout=self.drain_timeout)
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(capturing, *self._services, *self._tasks, return_exceptions=True)
+            self._camera.shutdown(wait=False)
+            self._inference.shutdown(wait=False)
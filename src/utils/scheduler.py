@@ -0,0 +1,225 @@
+"""
+scheduler.py
+Target prioritization and engagement scheduling for the turret.
+
+EngagementScheduler keeps a priority queue of tracks that is updated incrementally:
+register it with FrameHandler.add_listener and only the tracks that were created,
+updated or lost in a frame are rescored. Removed and superseded heap entries are
+discarded lazily when they reach the top, and engagement cooldowns expire from
+their own small heap, so nothing is ever rescored from scratch.
+"""
+import heapq
+from itertools import permutations
+from time import monotonic
+
+import numpy as np
+
+from utils.intercept import aim_angles
+
+
+def score_tracks(states, covariances, w_distance=1.0, w_closing=0.5, w_confidence=1.0):
+    """
+    Scores (n, 6) states with (n, 6, 6) covariances, higher is more urgent.
+    Nearby targets, targets closing in on the turret and targets with a tight
+    position covariance all score higher.
+    """
+    states = np.asarray(states, dtype=np.float64).reshape(-1, 6)
+    covariances = np.asarray(covariances, dtype=np.float64).reshape(-1, 6, 6)
+    p = states[:, :3]
+    v = states[:, 3:]
+    distance = np.linalg.norm(p, axis=1)
+    closing_speed = -np.einsum('ij,ij->i', p, v) / np.maximum(distance, 1e-6)
+    confidence = 1 / (1 + np.trace(covariances[:, :3, :3], axis1=1, axis2=2))
+    return w_distance / (1 + distance) + w_closing * closing_speed + w_confidence * confidence
+
+
+def _axis_time(distance, speed, acceleration):
+    # Trapezoidal profile from rest to rest: accelerate, cruise at `speed`, decelerate.
+    # Moves shorter than speed^2 / acceleration never reach the cruise speed
+    if acceleration is None:
+        return distance / speed
+    return np.where(distance * acceleration < speed ** 2, 2 * np.sqrt(distance / acceleration),
+                    distance / speed + speed / acceleration)
+
+
+def slew_times(pan_from, tilt_from, pan_to, tilt_to, pan_speed, tilt_speed, acceleration=None):
+    """
+    Time to slew between angles when pan and tilt move simultaneously, each from rest
+    to rest at up to its max speed and `acceleration` (rad/s^2). Without an
+    acceleration the axes reach their max speeds instantly.
+    """
+    return np.maximum(_axis_time(np.abs(pan_to - pan_from), pan_speed, acceleration),
+                      _axis_time(np.abs(tilt_to - tilt_from), tilt_speed, acceleration))
+
+
+class _Track:
+    __slots__ = ('uid', 'state', 'score', 'version', 'pan', 'tilt', 'penalty_until')
+
+    def __init__(self, uid):
+        self.uid = uid
+        self.state = None
+        self.score = 0.0
+        self.version = 0
+        self.pan = 0.0
+        self.tilt = 0.0
+        self.penalty_until = None
+
+
+class EngagementScheduler:
+    """
+    Decides which track the turret should engage and in what order.
+
+    `cooldown` seconds after a track is engaged its priority is lowered by
+    `engagement_penalty`, so other targets get a turn. `pan_speed` and
+    `tilt_speed` (rad/s) and `acceleration` (rad/s^2, None for instant) are the
+    turret's slew limits used to plan a slew-minimizing visiting order.
+    """
+    def __init__(self, pan_speed=np.pi, tilt_speed=np.pi / 2, acceleration=None, cooldown=2.0, engagement_penalty=10.0,
+                 w_distance=1.0, w_closing=0.5, w_confidence=1.0, exact_plan_size=7, clock=monotonic):
+        self.pan_speed = pan_speed
+        self.tilt_speed = tilt_speed
+        self.acceleration = acceleration
+        self.cooldown = cooldown
+        self.engagement_penalty = engagement_penalty
+        self.weights = dict(w_distance=w_distance, w_closing=w_closing, w_confidence=w_confidence)
+        self.exact_plan_size = exact_plan_size
+        self.clock = clock
+        self.tracks = {}
+        self._heap = []
+        self._cooldowns = []
+
+    @classmethod
+    def from_config(cls, turret, **kwargs):
+        """
+        Creates a scheduler from a CONFIG.TurretConfig.
+        """
+        return cls(pan_speed=np.deg2rad(turret.pan_speed), tilt_speed=np.deg2rad(turret.tilt_speed),
+                   acceleration=np.deg2rad(turret.acceleration), cooldown=turret.engagement_cooldown, **kwargs)
+
+    def __len__(self):
+        return len(self.tracks)
+
+    # FrameHandler listener interface
+    def on_target_new(self, target):
+        self.update_track(target._uid, *target.get_state())
+
+    def on_target_updated(self, target):
+        self.update_track(target._uid, *target.get_state())
+
+    def on_target_lost(self, target):
+        self.remove_track(target._uid)
+
+    def _push(self, track):
+        track.version += 1
+        key = track.score - (self.engagement_penalty if track.penalty_until is not None else 0)
+        heapq.heappush(self._heap, (-key, track.version, track.uid))
+        # Compact once stale entries dominate, amortized O(1) per push
+        if len(self._heap) > 4 * max(len(self.tracks), 16):
+            self._heap = [entry for entry in self._heap if self._is_current(entry)]
+            heapq.heapify(self._heap)
+
+    def update_tracks(self, uids, states, covariances):
+        """
+        Rescores a batch of tracks in one vectorized call.
+        """
+        if len(uids) == 0:
+            return
+        states = np.asarray(states, dtype=np.float64).reshape(-1, 6)
+        scores = score_tracks(states, covariances, **self.weights)
+        pans, tilts = aim_angles(states[:, :3])
+        for uid, state, score, pan, tilt in zip(uids, states, scores, pans, tilts):
+            track = self.tracks.get(uid)
+            if track is None:
+                track = self.tracks[uid] = _Track(uid)
+            track.state = state
+            track.score = float(score)
+            track.pan = float(pan)
+            track.tilt = float(tilt)
+            self._push(track)
+
+    def update_track(self, uid, state, covariance):
+        self.update_tracks([uid], [state], [covariance])
+
+    def remove_track(self, uid):
+        # Its heap entries become stale and are dropped when they surface
+        self.tracks.pop(uid, None)
+
+    def mark_engaged(self, uid, now=None):
+        """
+        Records that `uid` was just engaged, lowering its priority for `cooldown` seconds.
+        """
+        track = self.tracks.get(uid)
+        if track is None:
+            return
+        now = self.clock() if now is None else now
+        track.penalty_until = now + self.cooldown
+        heapq.heappush(self._cooldowns, (track.penalty_until, uid))
+        self._push(track)
+
+    def _expire_cooldowns(self, now):
+        while self._cooldowns and self._cooldowns[0][0] <= now:
+            until, uid = heapq.heappop(self._cooldowns)
+            track = self.tracks.get(uid)
+            # Skip tracks that were lost or engaged again since
+            if track is not None and track.penalty_until == until:
+                track.penalty_until = None
+                self._push(track)
+
+    def _is_current(self, entry):
+        track = self.tracks.get(entry[2])
+        return track is not None and track.version == entry[1]
+
+    def peek(self, now=None):
+        """
+        Returns (uid, score) of the highest priority track, or None when nothing is tracked.
+        """
+        self._expire_cooldowns(self.clock() if now is None else now)
+        while self._heap and not self._is_current(self._heap[0]):
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return None
+        key, _, uid = self._heap[0]
+        return uid, -key
+
+    def top(self, k, now=None):
+        """
+        Returns the uids of the `k` highest priority tracks, best first.
+        """
+        self._expire_cooldowns(self.clock() if now is None else now)
+        current = (entry for entry in self._heap if self._is_current(entry))
+        return [entry[2] for entry in heapq.nsmallest(k, current)]
+
+    def plan(self, k, pan=0.0, tilt=0.0, now=None):
+        """
+        Plans the order in which to visit the `k` highest priority tracks starting from
+        the turret's current (pan, tilt), minimizing the total slew time. Orders of up
+        to `exact_plan_size` tracks are solved exactly, larger ones greedily by nearest
+        neighbour. Returns (uids in visiting order, total slew time in seconds).
+        """
+        uids = self.top(k, now)
+        if len(uids) == 0:
+            return [], 0.0
+        pans = np.array([self.tracks[uid].pan for uid in uids])
+        tilts = np.array([self.tracks[uid].tilt for uid in uids])
+        start = slew_times(pan, tilt, pans, tilts, self.pan_speed, self.tilt_speed, self.acceleration)
+        between = slew_times(pans[:, None], tilts[:, None], pans[None, :], tilts[None, :],
+                             self.pan_speed, self.tilt_speed, self.acceleration)
+
+        n = len(uids)
+        if n <= self.exact_plan_size:
+            orders = np.array(list(permutations(range(n))))
+            costs = start[orders[:, 0]] + between[orders[:, :-1], orders[:, 1:]].sum(axis=1)
+            best = np.argmin(costs)
+            order, cost = orders[best], costs[best]
+        else:
+            order = [int(np.argmin(start))]
+            cost = start[order[0]]
+            remaining = np.ones(n, dtype=bool)
+            remaining[order[0]] = False
+            while remaining.any():
+                candidates = np.where(remaining, between[order[-1]], np.inf)
+                nxt = int(np.argmin(candidates))
+                cost += candidates[nxt]
+                remaining[nxt] = False
+                order.append(nxt)
+        return [uids[i] for i in order], float(cost)
@@ -0,0 +1,122 @@
+"""
+skeleton.py
+Lifts 2D pose keypoints into 3D skeletons.
+
+Every confident keypoint of every person gets a depth from a small patch of the
+depth frame around it, gathered for all of them in one fancy-indexing operation,
+and is deprojected through the camera intrinsics in one batched call. The robust
+centroid of a skeleton is taken from its torso keypoints, after dropping the ones
+whose depth strays from the person's median depth (patches that bled into the
+background), which puts the aim point on center mass instead of the head.
+"""
+from typing import NamedTuple
+
+import numpy as np
+
+# COCO keypoint order used by the YOLOv8 pose models
+KEYPOINT_NAMES = ('nose', 'left_eye', 'right_eye', 'left_ear', 'right_ear',
+                  'left_shoulder', 'right_shoulder', 'left_elbow', 'right_elbow',
+                  'left_wrist', 'right_wrist', 'left_hip', 'right_hip',
+                  'left_knee', 'right_knee', 'left_ankle', 'right_ankle')
+TORSO = np.array([5, 6, 11, 12])
+
+
+class CameraIntrinsics(NamedTuple):
+    fx: float
+    fy: float
+    cx: float
+    cy: float
+
+    @classmethod
+    def from_matrix(cls, matrix):
+        matrix = np.asarray(matrix)
+        return cls(matrix[0, 0], matrix[1, 1], matrix[0, 2], matrix[1, 2])
+
+    @classmethod
+    def from_fov(cls, hfov, vfov, width, height):
+        """
+        Ideal pinhole intrinsics for FOVs in radians over a width x height image.
+        """
+        return cls(width / (2 * np.tan(hfov / 2)), height / (2 * np.tan(vfov / 2)), width / 2, height / 2)
+
+
+class Skeletons(NamedTuple):
+    # (n, k, 3) keypoints in meters in the camera frame, nan where not lifted
+    points: np.ndarray
+    valid: np.ndarray
+    # (n, 3) robust torso centroids, nan for people without one
+    centroids: np.ndarray
+    has_centroid: np.ndarray
+
+
+def patch_offsets(radius):
+    r = np.arange(-radius, radius + 1)
+    dy, dx = np.meshgrid(r, r, indexing='ij')
+    return dy.ravel(), dx.ravel()
+
+
+def sample_depths(depth_frame, pixels, radius=2, depth_scale=0.001):
+    """
+    Median of the valid (non-zero) depths in the (2 * radius + 1)^2 patch around each
+    of the (..., 2) (x, y) `pixels`, converted to meters with `depth_scale`. Patches
+    are clipped to the frame; pixels without any valid depth get nan.
+    """
+    dy, dx = patch_offsets(radius)
+    height, width = depth_frame.shape[:2]
+    xs = np.clip(np.rint(pixels[..., 0]).astype(np.intp)[..., None] + dx, 0, width - 1)
+    ys = np.clip(np.rint(pixels[..., 1]).astype(np.intp)[..., None] + dy, 0, height - 1)
+    patches = depth_frame[ys, xs].astype(np.float64)
+    patches[patches <= 0] = np.nan
+    depths = np.full(patches.shape[:-1], np.nan)
+    has_depth = ~np.isnan(patches).all(axis=-1)
+    depths[has_depth] = np.nanmedian(patches[has_depth], axis=-1)
+    return depths * depth_scale
+
+
+def deproject(pixels, depths, intrinsics):
+    """
+    Deprojects (..., 2) pixels at `depths` meters into (..., 3) camera frame points.
+    """
+    fx, fy, cx, cy = intrinsics
+    return np.stack([(pixels[..., 0] - cx) * depths / fx, (pixels[..., 1] - cy) * depths / fy, depths], axis=-1)
+
+
+def project(points, intrinsics):
+    """
+    Projects (..., 3) camera frame points back to (..., 2) pixels.
+    """
+    fx, fy, cx, cy = intrinsics
+    return np.stack([points[..., 0] * fx / points[..., 2] + cx, points[..., 1] * fy / points[..., 2] + cy], axis=-1)
+
+
+def lift_skeletons(keypoints, depth_frame, intrinsics, threshold=0.6, radius=2, depth_scale=0.001,
+                   depth_to_color=(1.0, 1.0), max_spread=0.4):
+    """
+    Lifts (n, k, 3) keypoints, (x, y, confidence) in color pixels, into Skeletons.
+    `depth_to_color` scales color pixels to depth frame pixels. Keypoints further
+    than `max_spread` meters from their person's median depth are treated as outliers.
+    """
+    keypoints = np.asarray(keypoints, dtype=np.float64).reshape(-1, len(KEYPOINT_NAMES), 3)
+    n, k = keypoints.shape[:2]
+    pixels = keypoints[..., :2]
+    depths = sample_depths(depth_frame, pixels * np.asarray(depth_to_color), radius, depth_scale)
+    depths[keypoints[..., 2] < threshold] = np.nan
+    if n:
+        with np.errstate(invalid='ignore'):
+            person_depth = np.full(n, np.nan)
+            seen = ~np.isnan(depths).all(axis=1)
+            person_depth[seen] = np.nanmedian(depths[seen], axis=1)
+            depths[np.abs(depths - person_depth[:, None]) > max_spread] = np.nan
+    valid = ~np.isnan(depths)
+    points = deproject(pixels, depths, intrinsics)
+
+    # Torso keypoints when there are any, any lifted keypoint otherwise
+    torso = np.zeros_like(valid)
+    torso[:, TORSO] = valid[:, TORSO]
+    use = np.where(torso.any(axis=1, keepdims=True), torso, valid)
+    counts = use.sum(axis=1)
+    has_centroid = counts > 0
+    centroids = np.full((n, 3), np.nan)
+    centroids[has_centroid] = (np.where(use[..., None], points, 0).sum(axis=1)[has_centroid]
+                               / counts[has_centroid, None])
+    return Skeletons(points, valid, centroids, has_centroid)
@@ -0,0 +1,248 @@
+"""
+track_publisher.py
+Publishes each frame's track table to other processes as packed binary records.
+
+Every track is one TRACK_DTYPE record: a fixed, packed, little-endian layout that
+any language can read with a struct definition. The table is written into a
+shared memory block guarded by a seqlock: the writer bumps the sequence number
+to an odd value, writes the records and the frame header, and bumps it to even
+again. A reader copies the header and the records it needs and only accepts
+them if the sequence was even and unchanged around the copy, so it never sees a
+half-written frame, never blocks the writer and never unpickles anything. The
+same records can also be streamed over TCP, one length-prefixed frame per
+message, for consumers on other machines.
+
+Block layout (little-endian):
+    0   u4  magic        'PQTR'
+    4   u4  capacity     records in the block
+    8   u8  sequence     odd while a frame is being written
+    16  u8  frame
+    24  f8  stamp        seconds
+    32  u4  count        valid records
+    64  TRACK_DTYPE[capacity]
+
+Usage:
+    publisher = SharedTrackPublisher('prospiq-tracks')
+    publisher.publish_snapshot(snapshot)    # a utils.runtime.TrackSnapshot, every frame
+
+    reader = SharedTrackReader('prospiq-tracks')    # in another process
+    frame, stamp, tracks = reader.read()
+"""
+import asyncio
+import struct
+from multiprocessing import resource_tracker, shared_memory
+from time import perf_counter, sleep
+
+import numpy as np
+
+TRACK_DTYPE = np.dtype([
+    ('uid', '<i8'),
+    ('stamp', '<f8'),
+    ('position', '<f8', 3),
+    ('velocity', '<f8', 3),
+    # Diagonal of the (x, y, z, vx, vy, vz) covariance
+    ('variance', '<f8', 6),
+    ('status', 'u1'),
+])
+# Track status codes
+STATUS_TRACKING = 1
+STATUS_COASTING = 2
+
+MAGIC = 0x52545150  # 'PQTR'
+HEADER_DTYPE = np.dtype([('magic', '<u4'), ('capacity', '<u4'), ('sequence', '<u8'), ('frame', '<u8'),
+                         ('stamp', '<f8'), ('count', '<u4')])
+HEADER_SIZE = 64
+# Stream message header: magic, frame, stamp, record count
+MESSAGE = struct.Struct('<IQdI')
+# Blocks created by publishers of this process, their resource tracker entry is the publisher's
+_published = set()
+
+
+def pack_tracks(uids, states, covariances, missed=None, stamp=0.0, out=None):
+    """
+    Fills TRACK_DTYPE records from FrameHandler.get_track_states output. Tracks with
+    `missed` frames are marked as coasting. Returns the (n,) records, a view into
+    `out` when a preallocated record array is given.
+    """
+    n = len(uids)
+    records = np.empty(n, dtype=TRACK_DTYPE) if out is None else out[:n]
+    if n == 0:
+        return records
+    states = np.asarray(states).reshape(n, 6)
+    records['uid'] = uids
+    records['stamp'] = stamp
+    records['position'] = states[:, :3]
+    records['velocity'] = states[:, 3:]
+    records['variance'] = np.diagonal(np.asarray(covariances).reshape(n, 6, 6), axis1=1, axis2=2)
+    records['status'] = STATUS_TRACKING
+    if missed is not None:
+        records['status'][np.asarray(missed) > 0] = STATUS_COASTING
+    return records
+
+
+def _views(buffer, capacity):
+    header = np.ndarray((), dtype=HEADER_DTYPE, buffer=buffer)
+    records = np.ndarray((capacity,), dtype=TRACK_DTYPE, buffer=buffer, offset=HEADER_SIZE)
+    return header, records
+
+
+class SharedTrackPublisher:
+    """
+    Single writer of a shared memory track table named `name`, holding up to
+    `capacity` tracks per frame. The block is removed on close().
+    """
+    def __init__(self, name='prospiq-tracks', capacity=64):
+        self.name = name
+        self.capacity = capacity
+        size = HEADER_SIZE + capacity * TRACK_DTYPE.itemsize
+        try:
+            self._shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            # Left behind by a publisher that did not shut down cleanly
+            stale = shared_memory.SharedMemory(name)
+            stale.close()
+            stale.unlink()
+            self._shm = shared_memory.SharedMemory(name, create=True, size=size)
+        _published.add(self._shm._name)
+        self._header, self.records = _views(self._shm.buf, capacity)
+        self._header['capacity'] = capacity
+        self._header['sequence'] = 0
+        self._header['count'] = 0
+        self._header['magic'] = MAGIC
+
+    def publish(self, frame, stamp, records):
+        """
+        Writes one frame's TRACK_DTYPE `records`, past `capacity` ones are left out.
+        """
+        n = min(len(records), self.capacity)
+        header = self._header
+        header['sequence'] += 1
+        self.records[:n] = records[:n]
+        header['frame'] = frame
+        header['stamp'] = stamp
+        header['count'] = n
+        header['sequence'] += 1
+
+    def publish_snapshot(self, snapshot):
+        """
+        Publishes a utils.runtime.TrackSnapshot.
+        """
+        self.publish(snapshot.frame, snapshot.stamp,
+                     pack_tracks(snapshot.uids, snapshot.states, snapshot.covariances, snapshot.missed, snapshot.stamp))
+
+    def close(self):
+        self._header = self.records = None
+        _published.discard(self._shm._name)
+        self._shm.close()
+        self._shm.unlink()
+
+
+class SharedTrackReader:
+    """
+    Attaches to the table of a SharedTrackPublisher in this or another process.
+    """
+    def __init__(self, name='prospiq-tracks'):
+        # The publisher owns the block, a reader exiting must not unlink it
+        try:
+            self._shm = shared_memory.SharedMemory(name, track=False)
+        except TypeError:
+            # Python < 3.13 always tracks attached blocks. The tracker holds one entry per
+            # name, so next to a publisher of this process it stays for the publisher's unlink
+            self._shm = shared_memory.SharedMemory(name)
+            if self._shm._name not in _published:
+                resource_tracker.unregister(self._shm._name, 'shared_memory')
+        header = np.ndarray((), dtype=HEADER_DTYPE, buffer=self._shm.buf)
+        if header['magic'] != MAGIC:
+            self._shm.close()
+            raise ValueError(f'Shared memory block {name!r} is not a track table')
+        self.capacity = int(header['capacity'])
+        self._header, self._records = _views(self._shm.buf, self.capacity)
+        self._out = np.empty(self.capacity, dtype=TRACK_DTYPE)
+
+    @property
+    def frame(self):
+        """
+        The newest published frame number, cheap enough to poll for changes.
+        """
+        return int(self._header['frame'])
+
+    def read(self, out=None, timeout=0.5):
+        """
+        Returns (frame, stamp, records) of the newest complete frame. The records are a
+        view into `out` (or a buffer reused by every call), which is only overwritten
+        by the next read. Raises TimeoutError if no consistent frame could be read
+        within `timeout` seconds, i.e. the writer died halfway through one.
+        """
+        out = self._out if out is None else out
+        header = self._header
+        deadline = perf_counter() + timeout
+        while True:
+            sequence = int(header['sequence'])
+            if sequence % 2 == 0:
+                frame, stamp, count = int(header['frame']), float(header['stamp']), int(header['count'])
+                out[:count] = self._records[:count]
+                if int(header['sequence']) == sequence:
+                    return frame, stamp, out[:count]
+            if perf_counter() > deadline:
+                raise TimeoutError(f'No consistent track table within {timeout} s')
+            # The writer is mid-frame, let it run
+            sleep(0)
+
+    def close(self):
+        self._header = self._records = None
+        self._shm.close()
+
+
+def encode_message(frame, stamp, records):
+    """
+    One stream message: a MESSAGE header followed by the raw TRACK_DTYPE records.
+    """
+    return MESSAGE.pack(MAGIC, frame, stamp, len(records)) + np.ascontiguousarray(records, dtype=TRACK_DTYPE).tobytes()
+
+
+async def serve_binary(hub, host='127.0.0.1', port=8766, maxsize=4):
+    """
+    Streams every snapshot of a utils.runtime.SnapshotHub to each TCP client as binary
+    messages (encode_message). Serves until cancelled, like runtime.serve_tracks.
+    """
+    encoded = {}
+
+    def encode(snapshot):
+        if encoded.get('frame') != snapshot.frame:
+            encoded['frame'] = snapshot.frame
+            encoded['message'] = encode_message(snapshot.frame, snapshot.stamp, pack_tracks(
+                snapshot.uids, snapshot.states, snapshot.covariances, snapshot.missed, snapshot.stamp))
+        return encoded['message']
+
+    async def stream(reader, writer):
+        try:
+            with hub.subscribe(maxsize) as subscription:
+                async for snapshot in subscription:
+                    writer.write(encode(snapshot))
+                    await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(stream, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def iter_stream(sock):
+    """
+    Yields (frame, stamp, records) from a connected socket of serve_binary until it closes.
+    """
+    stream = sock.makefile('rb')
+    while True:
+        head = stream.read(MESSAGE.size)
+        if len(head) < MESSAGE.size:
+            return
+        magic, frame, stamp, count = MESSAGE.unpack(head)
+        if magic != MAGIC:
+            raise ValueError('Corrupt track stream')
+        body = stream.read(count * TRACK_DTYPE.itemsize)
+        if len(body) < count * TRACK_DTYPE.itemsize:
+            return
+        yield frame, stamp, np.frombuffer(body, dtype=TRACK_DTYPE)
@@ -1,7 +1,5 @@
 import cv2
 import numpy as np
-from ultralytics import YOLO
-import torch
 
 #import pyrealsense2 as rs
 #from realsense_depth import *
@@ -21,23 +19,56 @@ from time import time
 
 # Rewrite above code to be in separate functions
 # Create a class that contains the functions
-import depthEstimation as de
+from utils import depthEstimation as de
+from utils import metrics
+from utils import skeleton
 
 
 class PersonDetector:
-    def __init__(self, cap, device='cpu'):
-        global model
-        model = YOLO('yolov8x-pose.pt')
-        model.to(device)
+    def __init__(self, cap, device='cpu', weights='yolov8x-pose.pt', confidence=0.7, max_det=6, keypoint_threshold=0.6,
+                 depthFilter=None):
+        # ultralytics pulls in torch, only pay for it when a detector is actually built
+        from ultralytics import YOLO
+        self.model = YOLO(weights)
+        self.model.to(device)
+        self.confidence = confidence
+        self.max_det = max_det
+        self.keypoint_threshold = keypoint_threshold
         self.cap = cap
+        # Optional utils.depth_filter.DepthPostProcessor run over the sampled regions
+        self.depthFilter = depthFilter
         self.depthToColorRes = (cap.depthRes[0] / cap.colorRes[0], cap.depthRes[1] / cap.colorRes[1])
+        # Calibrated intrinsics when the camera provides them, the nominal FOV otherwise
+        if getattr(cap, 'colorIntrinsics', None) is not None:
+            self.intrinsics = skeleton.CameraIntrinsics.from_matrix(cap.colorIntrinsics)
+        else:
+            self.intrinsics = skeleton.CameraIntrinsics.from_fov(de.CAMERA_HFOV, de.CAMERA_VFOV, *cap.colorRes)
+        self.keypoints = np.empty((0, len(skeleton.KEYPOINT_NAMES), 3))
         self.results = None
         self.frame = None
         self.depth_frame = None
 
     def update(self):
-        ret, infrared_frame, depth_frame, frame = self.cap.get_frame()
-        self.results = model(frame, conf=0.7, verbose=False, max_det=6, half=False)
+        self.infer(*self.capture())
+
+    def capture(self):
+        """
+        Reads the next (color frame, depth frame) from the camera. The depth frame is a
+        copy: cameras may reuse their depth buffer on the next get_frame, which the
+        runtime calls while this frame is still being sampled and filtered.
+        """
+        with metrics.stage('capture'):
+            ret, infrared_frame, depth_frame, frame = self.cap.get_frame()
+            if depth_frame is not None:
+                depth_frame = np.array(depth_frame)
+        return frame, depth_frame
+
+    def infer(self, frame, depth_frame):
+        """
+        Runs the pose model on a captured frame, which becomes the detector's current frame.
+        """
+        with metrics.stage('inference'):
+            self.results = self.model(frame, conf=self.confidence, verbose=False, max_det=self.max_det, half=False)
         self.frame = frame
         self.depth_frame = depth_frame
     
@@ -47,12 +78,23 @@ class PersonDetector:
         return np.sqrt((shoulder_midpoint[0] - waist_midpoint[0]) ** 2 + (shoulder_midpoint[1] - waist_midpoint[1]) ** 2)
         #return chest_bound[3] - chest_bound[1]
     
+    @metrics.timed('depth_sampling')
     def getDepth(self, chest_bound, depth_frame):
-        distances = []
-        for i in range(chest_bound[0], chest_bound[2]):
-            for j in range(chest_bound[1], chest_bound[3]):
-                distances.append(depth_frame[j][i])
+        patch = depth_frame[max(chest_bound[1], 0):chest_bound[3], max(chest_bound[0], 0):chest_bound[2]]
+        # 0 is no depth, it would drag the median towards the camera
+        distances = patch[patch > 0]
         return np.median(distances) if len(distances) > 0 else 0
+
+    def filterDepth(self, rois):
+        """
+        Runs the depth post-processor, if any, over the (x0, y0, x1, y1) color pixel `rois`.
+        """
+        if self.depthFilter is None or self.depth_frame is None:
+            return
+        sx, sy = self.depthToColorRes
+        with metrics.stage('depth_filter'):
+            self.depth_frame = self.depthFilter.process(
+                self.depth_frame, [(x0 * sx, y0 * sy, x1 * sx + 1, y1 * sy + 1) for x0, y0, x1, y1 in rois])
     
     def getChestBound(self, chest_points):
         xmin = min(chest_points[0][0], chest_points[1][0])
@@ -62,7 +104,9 @@ class PersonDetector:
         chestBound = (int(xmin), int(ymin), int(xmax), int(ymax))
         return chestBound
     
-    def getChestKeyPoints(self, result, threshold=0.6):
+    def getChestKeyPoints(self, result, threshold=None):
+        if threshold is None:
+            threshold = self.keypoint_threshold
         keypoints = result.keypoints.data.cpu().numpy()
         chest_points = [keypoints[0][5], keypoints[0][6], keypoints[0][11], keypoints[0][12]]
         for chestPoint in chest_points:
@@ -71,20 +115,58 @@ class PersonDetector:
         return chest_points
     
     # Depth Height ChestCenter = DHCT
+    @metrics.timed('keypoints')
     def getDHCPerTarget(self):
         sensorDepths = []
         sensorHeights = []
         chestCenters = []
+        chests = []
         for result in self.results[0]:
             chestPoints = self.getChestKeyPoints(result)
             if chestPoints is not None:
-                chestBound = self.getChestBound(chestPoints)
-                chestCenter = (int((chestBound[0] + chestBound[2]) / 2), int((chestBound[1] + chestBound[3]) / 2))
-                chestCenters.append(chestCenter)
-                sensorDepths.append(self.getDepth(chestBound, self.depth_frame))
-                sensorHeights.append(self.getChestHeight(chestPoints))
+                chests.append((chestPoints, self.getChestBound(chestPoints)))
+        self.filterDepth([chestBound for _, chestBound in chests])
+        for chestPoints, chestBound in chests:
+            chestCenter = (int((chestBound[0] + chestBound[2]) / 2), int((chestBound[1] + chestBound[3]) / 2))
+            chestCenters.append(chestCenter)
+            sensorDepths.append(self.getDepth(chestBound, self.depth_frame))
+            sensorHeights.append(self.getChestHeight(chestPoints))
         return sensorDepths, sensorHeights, chestCenters
     
+    @metrics.timed('keypoints')
+    def getSkeletons(self, radius=2):
+        """
+        Lifts the confident keypoints of every detected person into 3D in one batch.
+        Returns a utils.skeleton.Skeletons with positions in meters.
+        """
+        keypoints = self.results[0].keypoints
+        if keypoints is None or len(keypoints.data) == 0:
+            self.keypoints = np.empty((0, len(skeleton.KEYPOINT_NAMES), 3))
+        else:
+            self.keypoints = keypoints.data.cpu().numpy()
+        confident = self.keypoints[..., 2] >= self.keypoint_threshold
+        rois = []
+        for points, mask in zip(self.keypoints, confident):
+            if mask.any():
+                (x0, y0), (x1, y1) = points[mask, :2].min(axis=0) - radius, points[mask, :2].max(axis=0) + radius
+                rois.append((x0, y0, x1, y1))
+        self.filterDepth(rois)
+        return skeleton.lift_skeletons(self.keypoints, self.depth_frame, self.intrinsics,
+                                       threshold=self.keypoint_threshold, radius=radius,
+                                       depth_to_color=self.depthToColorRes)
+
+    def getDHCFromSkeletons(self, skeletons):
+        """
+        Depths (mm), torso heights (px) and centroid pixels of the people with a
+        centroid, for the same annotations as getDHCPerTarget.
+        """
+        people = np.flatnonzero(skeletons.has_centroid)
+        centroids = skeletons.centroids[people]
+        chest = self.keypoints[people][:, skeleton.TORSO, :2]
+        heights = np.linalg.norm((chest[:, 0] + chest[:, 1]) / 2 - (chest[:, 2] + chest[:, 3]) / 2, axis=1)
+        centers = np.rint(skeleton.project(centroids, self.intrinsics)).astype(int)
+        return (centroids[:, 2] * 1000).tolist(), heights.tolist(), [tuple(center) for center in centers.tolist()]
+
     def getDHCFrame(self, d, h, c, frame):
         annotated_frame = frame
         for i, (depth, height, center) in enumerate(zip(d, h, c)):
@@ -95,9 +177,12 @@ class PersonDetector:
                 cv2.putText(annotated_frame, "Target ID: {}".format(i), (center[0], center[1] + 80), cv2.FONT_HERSHEY_PLAIN, 3, (100, 0, 200), 2, cv2.LINE_AA)
         return annotated_frame
     
-    def getFinalFrame(self, d, h, c, start_time):
-        annotated_frame = self.getDHCFrame(d, h, c, self.frame)
-        annotated_frame = self.calcFrameRate(annotated_frame, start_time)
+    def getFinalFrame(self, d, h, c, start_time, frame=None, end_time=None):
+        # frame/end_time let a render thread annotate a snapshot after the fact
+        if frame is None:
+            frame = self.frame
+        annotated_frame = self.getDHCFrame(d, h, c, frame)
+        annotated_frame = self.calcFrameRate(annotated_frame, start_time, end_time)
         return annotated_frame
     
     def getTargetPositions(self, d, c):
@@ -109,8 +194,8 @@ class PersonDetector:
                     targetPositions.append(point3d)
         return targetPositions
     
-    def calcFrameRate(self, frame, start_time):
-        current_time = time()
+    def calcFrameRate(self, frame, start_time, end_time=None):
+        current_time = time() if end_time is None else end_time
         elapsed_time = current_time - start_time
         frame_rate = 1 / elapsed_time
         cv2.putText(frame, "FPS: {0:.2f}".format(frame_rate), (50, 50), cv2.FONT_HERSHEY_PLAIN, 3, (0, 0, 100), 2, cv2.LINE_AA)
@@ -0,0 +1,46 @@
+import threading
+from time import time, sleep
+import cv2
+from utils import metrics
+
+
+class FrameObserver(threading.Thread):
+    """
+    Renders the camera and simulation windows from snapshots published by the
+    main loop, at a decimated rate and off the hot path. Publishing only swaps
+    a reference, so annotation, TargetViewer.draw and cv2.imshow all happen on
+    this thread. Snapshots that arrive faster than `rate` are dropped, only the
+    latest one is ever drawn.
+    """
+    def __init__(self, detector, simulator, rate=15):
+        super().__init__(daemon=True)
+        self.detector = detector
+        self.simulator = simulator
+        self.period = 1 / rate
+        self.stopped = threading.Event()
+        self._snapshot = None
+
+    def publish(self, frame, depths, heights, centers, positions, start_time, end_time):
+        # The frame must not be drawn on by the caller after it is published
+        self._snapshot = (frame, depths, heights, centers, positions, start_time, end_time)
+
+    def render(self, frame, depths, heights, centers, positions, start_time, end_time):
+        self.simulator.setPositions(positions)
+        simulator_view = self.simulator.draw()
+        camera_frame = self.detector.getFinalFrame(depths, heights, centers, start_time, frame=frame, end_time=end_time)
+        cv2.imshow("Camera", camera_frame)
+        cv2.imshow("Simulation", simulator_view)
+
+    def run(self):
+        while not self.stopped.is_set():
+            next_time = time() + self.period
+            snapshot, self._snapshot = self._snapshot, None
+            if snapshot is not None:
+                with metrics.stage('render'):
+                    self.render(*snapshot)
+            if cv2.waitKey(1) == ord('q'):
+                self.stopped.set()
+            sleep(max(0, next_time - time()))
+
+    def stop(self):
+        self.stopped.set()
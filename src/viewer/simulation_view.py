@@ -1,33 +1,136 @@
 import cv2
 import numpy as np
 
+
+def diskOffsets(radius):
+    """
+    Returns the (dy, dx) pixel offsets of a filled disk of `radius`, used to stamp
+    every target dot onto the frame in one fancy-indexing assignment.
+    """
+    r = np.arange(-radius, radius + 1)
+    dy, dx = np.meshgrid(r, r, indexing='ij')
+    inside = dy ** 2 + dx ** 2 <= radius ** 2
+    return dy[inside], dx[inside]
+
+
 class TargetViewer:
-    def __init__(self, windowSize=(640, 480), xRange=(-4.0, 4.0), yRange=(0, 8.0)):
+    """
+    Top-down view of the tracked targets with the turret at (0, 0).
+
+    The static layer (grid, range rings and turret marker) is rendered once in
+    __init__ and copied into a reused frame buffer on every draw, so draw()
+    never allocates an image. The returned frame is that buffer; copy it if it
+    has to outlive the next draw() call.
+
+    With trailLength > 0 the pixel positions of the last trailLength frames are
+    kept in a ring buffer and drawn as fading trails behind the targets.
+    """
+    def __init__(self, windowSize=(640, 480), xRange=(-4.0, 4.0), yRange=(0, 8.0),
+                 gridStep=1.0, trailLength=0, maxTargets=64):
         self.targetPositions = []
         self.windowSize = windowSize
         self.yRange = yRange
         self.xRange = xRange
-    
+        self.gridStep = gridStep
+        self._scale = np.array([windowSize[0] / (xRange[1] - xRange[0]),
+                                windowSize[1] / (yRange[1] - yRange[0])])
+        self._offset = np.array([xRange[0], yRange[0]])
+        self._bounds = np.array([windowSize[0] - 1, windowSize[1] - 1])
+        self._dotDy, self._dotDx = diskOffsets(3)
+
+        self._background = self.drawBackground()
+        self._frame = np.empty_like(self._background)
+
+        self.trailLength = trailLength
+        self.maxTargets = maxTargets
+        if trailLength > 0:
+            self._trail = np.zeros((trailLength, maxTargets, 2), np.intp)
+            self._trailCounts = np.zeros(trailLength, np.intp)
+            self._trailHead = -1
+            # Trail colour by age, newest (age 0) brightest
+            fade = np.linspace(1.0, 0.1, trailLength)
+            self._trailColors = (fade[:, None] * np.array([0, 0, 255])).astype(np.uint8)
+            self._trailSlots = np.repeat(np.arange(trailLength), maxTargets)
+            self._trailIndex = np.tile(np.arange(maxTargets), trailLength)
+
     def addPosition(self, position):
         self.targetPositions.append(position)
 
+    def setPositions(self, positions):
+        """
+        Replaces the current positions with an (n, 3) array in one call.
+        """
+        self.targetPositions = positions
+
     def clearPositions(self):
         self.targetPositions = []
-    
+
     def posToPixel(self, pos):
         x = int((pos[0] - self.xRange[0]) / (self.xRange[1] - self.xRange[0]) * self.windowSize[0])
         y = int((pos[1] - self.yRange[0]) / (self.yRange[1] - self.yRange[0]) * self.windowSize[1])
         return x, y
-    
-    def draw(self):
+
+    def posToPixels(self, positions):
+        """
+        Vectorized posToPixel for an (n, 3) array of target positions, using the
+        x and z (depth) axes. Returns an (n, 2) integer array of pixel coordinates.
+        """
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        return ((positions[:, (0, 2)] - self._offset) * self._scale).astype(np.intp)
+
+    def drawBackground(self):
         img = np.zeros((self.windowSize[1], self.windowSize[0], 3), np.uint8)
         x0, y0 = self.posToPixel((0, 0))
-        for pos in self.targetPositions:
-            temp_pos = (pos[0], pos[2])
-            x, y = self.posToPixel(temp_pos)
-            cv2.circle(img, (x, y), 3, (0, 0, 255), -1)
-            cv2.line(img, (x0, y0), (x, y), (255, 255, 0), 1)
+        for x in np.arange(np.ceil(self.xRange[0] / self.gridStep) * self.gridStep, self.xRange[1], self.gridStep):
+            px, _ = self.posToPixel((x, 0))
+            cv2.line(img, (px, 0), (px, self.windowSize[1] - 1), (40, 40, 40), 1)
+        for y in np.arange(np.ceil(self.yRange[0] / self.gridStep) * self.gridStep, self.yRange[1], self.gridStep):
+            _, py = self.posToPixel((0, y))
+            cv2.line(img, (0, py), (self.windowSize[0] - 1, py), (40, 40, 40), 1)
+        # Range rings around the turret, one per grid step
+        max_range = np.hypot(max(abs(self.xRange[0]), abs(self.xRange[1])),
+                             max(abs(self.yRange[0]), abs(self.yRange[1])))
+        for r in np.arange(self.gridStep, max_range + self.gridStep, self.gridStep):
+            axes = (int(r * self._scale[0]), int(r * self._scale[1]))
+            cv2.ellipse(img, (x0, y0), axes, 0, 0, 360, (0, 90, 0), 1)
         # Draw turret position at 0, 0
-        x, y = self.posToPixel((0, 0))
-        cv2.circle(img, (x, y), 4, (255, 255, 255), -1)
-        return img
\ No newline at end of file
+        cv2.circle(img, (x0, y0), 4, (255, 255, 255), -1)
+        return img
+
+    def _pushTrail(self, pixels):
+        self._trailHead = (self._trailHead + 1) % self.trailLength
+        n = min(len(pixels), self.maxTargets)
+        self._trail[self._trailHead, :n] = pixels[:n]
+        self._trailCounts[self._trailHead] = n
+
+    def _drawTrail(self, img):
+        ages = (self._trailHead - self._trailSlots) % self.trailLength
+        valid = (self._trailIndex < self._trailCounts[self._trailSlots]) & (ages > 0)
+        # Oldest first so newer points overwrite older ones
+        order = np.argsort(-ages[valid], kind='stable')
+        slots = self._trailSlots[valid][order]
+        points = self._trail[slots, self._trailIndex[valid][order]]
+        colors = self._trailColors[ages[valid][order]]
+        inside = ((points >= 0) & (points <= self._bounds)).all(axis=1)
+        img[points[inside, 1], points[inside, 0]] = colors[inside]
+
+    def draw(self):
+        img = self._frame
+        np.copyto(img, self._background)
+        pixels = self.posToPixels(self.targetPositions)
+        if self.trailLength > 0:
+            self._pushTrail(pixels)
+            self._drawTrail(img)
+        if len(pixels) == 0:
+            return img
+        x0, y0 = self.posToPixel((0, 0))
+        segments = np.empty((len(pixels), 2, 2), np.int32)
+        segments[:, 0] = (x0, y0)
+        segments[:, 1] = pixels
+        cv2.polylines(img, segments, False, (255, 255, 0), 1)
+        # Stamp every target dot at once
+        ys = pixels[:, 1, None] + self._dotDy
+        xs = pixels[:, 0, None] + self._dotDx
+        inside = (ys >= 0) & (ys <= self._bounds[1]) & (xs >= 0) & (xs <= self._bounds[0])
+        img[ys[inside], xs[inside]] = (0, 0, 255)
+        return img